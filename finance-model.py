@@ -3,16 +3,69 @@ import numpy as np
 import numpy_financial as npf
 import pandas as pd
 import plotly.graph_objects as go
-from datetime import datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
+import os
+import io
+import json
+import hashlib
+import multiprocessing
+import pickle
+import itertools
+import math
+import re
+import sqlite3
+import time
+import threading
+import subprocess
+import sys
+from contextlib import closing
+from functools import lru_cache
+from multiprocessing import shared_memory
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, date
+from openpyxl import Workbook, load_workbook
 import streamlit_authenticator as stauth
 from htbuilder import HtmlElement, div, ul, li, br, hr, a, p, i, img, styles, classes, fonts
 from htbuilder.units import percent, px
 from htbuilder.funcs import rgba, rgb
 
+def format_scaled(values, tiers, prefix='', magnitudes=None):
+    """
+    Format a whole array at once. tiers are (threshold, divisor, format spec, suffix), tried
+    in order against magnitudes (abs(values) by default). Only numbers that still need
+    thousands separators after scaling are formatted one by one.
+    """
+    values = np.asarray(values, dtype=float)
+    magnitudes = np.abs(values) if magnitudes is None else np.asarray(magnitudes, dtype=float)
+    formatted = np.empty(values.shape, dtype=object)
+    remaining = np.ones(values.shape, dtype=bool)
+    for threshold, divisor, format_spec, suffix in tiers:
+        selected = remaining & (magnitudes >= threshold)
+        remaining &= ~selected
+        if not selected.any():
+            continue
+        scaled = values[selected] / divisor
+        strings = np.char.mod('%' + format_spec.lstrip(','), scaled).astype(object)
+        if format_spec.startswith(','):
+            needs_separator = np.abs(scaled) >= 999.5
+            strings[needs_separator] = [format(value, format_spec) for value in scaled[needs_separator]]
+        formatted[selected] = prefix + strings + suffix
+    return formatted
+
+
 def format_number(value):
     """
     Format a number with appropriate units (K, M, B) and precision.
+    Arrays are formatted element-wise and return an array of strings.
     """
+    if np.ndim(value) > 0:
+        return format_scaled(
+            value,
+            [(1_000_000_000, 1_000_000_000, '.2f', 'B'), (1_000_000, 1_000_000, '.2f', 'M'),
+             (10_000, 1_000, '.0f', 'K'), (1_000, 1_000, '.1f', 'K'), (-np.inf, 1, ',.0f', '')],
+            magnitudes=value
+        )
     if value >= 1_000_000_000:
         return f"{value/1_000_000_000:.2f}B"
     elif value >= 1_000_000:
@@ -128,17 +181,10 @@ merchant_price_curves = {
 }
 
 
-def calculate_carbon_offsets(revenue_df, project_data):
-    # Sum total net production over the project lifetime (in MWh)
-    total_net_production_mwh = revenue_df.loc[revenue_df['Year'] != 'Total', 'Net Production (MWh)'].sum()
-    
-    # Get emissions factor based on the state (lbs CO₂ per MWh)
-    state = project_data['state']
-    emissions_factor_lbs_per_mwh = state_emissions_factors.get(state, 1000)  # Default to 1000 if state not found
-    
-    # Total CO₂ emissions avoided (in pounds)
-    total_co2_avoided_lbs = total_net_production_mwh * emissions_factor_lbs_per_mwh
-    
+def carbon_offset_equivalents(total_net_production_mwh, total_co2_avoided_lbs):
+    """
+    Equivalents for lifetime production and avoided CO₂; works on scalars or arrays of projects.
+    """
     # Convert pounds to metric tons (1 metric ton = 2204.62 pounds)
     total_co2_avoided_metric_tons = total_co2_avoided_lbs / 2204.62
     
@@ -167,412 +213,3827 @@ def calculate_carbon_offsets(revenue_df, project_data):
     }
 
 
-def format_hover_value(value):
-    if abs(value) >= 1e6:
-        return f"${value/1e6:,.2f}MM"
-    elif abs(value) >= 1e3:
-        return f"${value/1e3:,.2f}k"
-    else:
-        return f"${value:,.2f}"
+def format_hover_value(value):
+    # Arrays are formatted element-wise and return an array of strings
+    if np.ndim(value) > 0:
+        return format_scaled(value, [(1e6, 1e6, ',.2f', 'MM'), (1e3, 1e3, ',.2f', 'k'), (-np.inf, 1, ',.2f', '')], '$')
+    if abs(value) >= 1e6:
+        return f"${value/1e6:,.2f}MM"
+    elif abs(value) >= 1e3:
+        return f"${value/1e3:,.2f}k"
+    else:
+        return f"${value:,.2f}"
+
+def plot_stacked_savings_chart(df):
+    df = df[df['Year'] != 'Total']  # Exclude 'Total' row
+
+    # Calculate total avoided cost in dollars
+    df['Total Avoided Cost ($)'] = df['Avoided Cost Price ($/MWh)'] * df['Net Production (MWh)']
+    df['Our Cost ($)'] = df['Our Price ($/MWh)'] * df['Net Production (MWh)']
+    df['Savings ($)'] = df['Savings Unlocked ($)']
+
+    # Create the stacked bar chart
+    fig = go.Figure()
+
+    # Our Cost
+    fig.add_trace(go.Bar(
+        x=df['Year'],
+        y=df['Our Cost ($)'],
+        name='Our Cost',
+        marker_color='green',
+        hovertemplate='Year: %{x}<br>Our Cost: $%{y:,.2f}<extra></extra>'
+    ))
+
+    # Savings
+    fig.add_trace(go.Bar(
+        x=df['Year'],
+        y=df['Savings ($)'],
+        name='Savings',
+        marker_color='lightgreen',
+        hovertemplate='Year: %{x}<br>Savings: $%{y:,.2f}<extra></extra>'
+    ))
+
+    fig.update_layout(
+        barmode='stack',
+        title='Total Avoided Cost Breakdown',
+        xaxis_title='Year',
+        yaxis_title='Cost ($)',
+        hovermode='x unified',
+        yaxis=dict(
+            tickformat='$,',
+            tickprefix='',
+        ),
+        legend=dict(
+            orientation="h",
+            yanchor="bottom",
+            y=1.02,
+            xanchor="right",
+            x=1
+        )
+    )
+
+    return fig
+
+# Calculation functions
+def calculate_irr(cash_flows):
+    return npf.irr(cash_flows)
+
+
+IRR_COLD_START = 0.10
+IRR_TOLERANCE = 1e-10
+IRR_MAX_ITERATIONS = 50
+
+
+def solve_irr(cash_flows, guess=None, lengths=None):
+    """
+    Newton's method on NPV(rate) = 0 for every row of a (projects x years) cash flow array at
+    once, starting from guess (scalar or one per row; IRR_COLD_START when missing). Newton only
+    runs on rows whose cash flows change sign exactly once, where the IRR is the only root, so
+    the guess never changes which IRR is found. Other rows, and rows that do not converge, use
+    npf.irr on their first `lengths` years.
+    Returns the IRRs and the number of Newton iterations each row took.
+    """
+    cash_flows = np.atleast_2d(np.asarray(cash_flows, dtype=float))
+    count, total_years = cash_flows.shape
+    years = np.arange(total_years)
+
+    # Sign changes within each row's life, skipping zero years
+    in_life = years < (total_years if lengths is None else np.asarray(lengths).reshape(count, 1))
+    signs = np.where(in_life, np.sign(cash_flows), 0.0)
+    last_nonzero = np.maximum.accumulate(np.where(signs != 0, years, 0), axis=1)
+    signs = np.take_along_axis(signs, last_nonzero, axis=1)
+    sign_changes = (signs[:, 1:] * signs[:, :-1] < 0).sum(axis=1)
+
+    rate = np.full(count, IRR_COLD_START) if guess is None else np.array(np.broadcast_to(guess, (count,)), dtype=float)
+    rate = np.where(np.isfinite(rate) & (rate > -0.99), rate, IRR_COLD_START)
+    iterations = np.zeros(count, dtype=int)
+    converged = np.zeros(count, dtype=bool)
+    pending = np.flatnonzero(sign_changes == 1)
+
+    for _ in range(IRR_MAX_ITERATIONS):
+        if pending.size == 0:
+            break
+        pending_rate = rate[pending]
+        discount_factors = (1 + pending_rate[:, None]) ** -years
+        npv = (cash_flows[pending] * discount_factors).sum(axis=1)
+        slope = (-years * cash_flows[pending] * discount_factors).sum(axis=1) / (1 + pending_rate)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            step = npv / slope
+        new_rate = pending_rate - step
+        iterations[pending] += 1
+
+        # Rows that diverge (non-finite or at/below -100%) stop here and use the fallback
+        valid = np.isfinite(new_rate) & (new_rate > -1)
+        rate[pending] = np.where(valid, new_rate, np.nan)
+        done = valid & (np.abs(step) < IRR_TOLERANCE)
+        converged[pending[done]] = True
+        pending = pending[valid & ~done]
+
+    for row in np.flatnonzero(~converged):
+        length = total_years if lengths is None else int(lengths[row])
+        rate[row] = calculate_irr(cash_flows[row, :length])
+    return rate, iterations
+
+def plot_cash_flows(df):
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=df['Year'], y=df['Cash Flow'], mode='lines+markers', name='Annual Cash Flow'))
+    fig.add_trace(go.Scatter(x=df['Year'], y=df['Cumulative Cash Flow'], mode='lines+markers', name='Cumulative Cash Flow'))
+    fig.update_layout(
+        title='Project Cash Flows',
+        xaxis_title='Year',
+        yaxis_title='Cash Flow ($)',
+        hovermode='x unified'
+    )
+    return fig
+
+
+def append_totals_row(revenue_df):
+    # Add totals row
+    totals = revenue_df.select_dtypes(include=[np.number]).sum()
+    totals['Year'] = 'Total'
+    totals['Revenue Type'] = ''
+    return pd.concat([revenue_df, totals.to_frame().T], ignore_index=True)
+
+
+# Model stages
+# The model is split into stages that each declare the project_data fields they read and
+# the stages they depend on. Every stage works on a batch of projects at once: field values
+# are column vectors (one row per project) and annual values are (projects x years) arrays.
+
+# Merchant price curves as one padded table, so prices can be looked up for many projects at once
+MERCHANT_PRICE_STATES = list(merchant_price_curves)
+MERCHANT_PRICE_STATE_INDEX = {state: index for index, state in enumerate(MERCHANT_PRICE_STATES)}
+MERCHANT_PRICE_FIRST_YEARS = np.array([merchant_price_curves[state]['years'][0] for state in MERCHANT_PRICE_STATES])
+MERCHANT_PRICE_LENGTHS = np.array([len(merchant_price_curves[state]['prices']) for state in MERCHANT_PRICE_STATES])
+MERCHANT_PRICE_TABLE = np.array([
+    merchant_price_curves[state]['prices'] +
+    [merchant_price_curves[state]['prices'][-1]] * (MERCHANT_PRICE_LENGTHS.max() - len(merchant_price_curves[state]['prices']))
+    for state in MERCHANT_PRICE_STATES
+])
+
+
+def merchant_price_lookup(state_index, calendar_years):
+    """
+    Merchant price from each state's curve, or its last price for years outside the curve.
+    """
+    curve_index = calendar_years - MERCHANT_PRICE_FIRST_YEARS[state_index]
+    curve_length = MERCHANT_PRICE_LENGTHS[state_index]
+    curve_index = np.where((curve_index >= 0) & (curve_index < curve_length), curve_index, curve_length - 1)
+    return MERCHANT_PRICE_TABLE[state_index, curve_index]
+
+
+# Defaults for model inputs added after scenarios were first saved, so older project_data
+# snapshots (saved scenarios, imported deals) can still be evaluated
+MODEL_FIELD_DEFAULTS = {
+    'after_tax': False,
+    'bonus_depreciation': 0.0,
+    'include_debt': False,
+    'debt_tenor': 15,
+    'debt_rate': 0.06,
+    'target_dscr': 1.30,
+    'te_structure': 'Fixed Buyout',
+    'te_target_yield': 0.07,
+    'pre_flip_cash_share': 0.30,
+    'pre_flip_tax_share': 0.99,
+    'post_flip_share': 0.05,
+    'discount_curve': None,
+    'grid_region': None,
+}
+
+
+def project_value(project_data, field):
+    return project_data[field] if field in project_data else MODEL_FIELD_DEFAULTS[field]
+
+
+def project_arrays(projects, fields):
+    """
+    Stack the given project_data fields of several projects into column vectors.
+    Date fields are reduced to their calendar year.
+    """
+    arrays = {}
+    for field in fields:
+        values = [project_value(project, field) for project in projects]
+        if isinstance(values[0], date):
+            values = [value.year for value in values]
+        if any(isinstance(value, (list, tuple, np.ndarray)) for value in values):
+            # Per-project sequences (e.g. discount curves) stay one object per row
+            column = np.empty((len(values), 1), dtype=object)
+            column[:, 0] = [tuple(value) if isinstance(value, (list, tuple, np.ndarray)) else value for value in values]
+            arrays[field] = column
+            continue
+        arrays[field] = np.asarray(values)[:, None]
+    return arrays
+
+
+def stage_capex(p, upstream):
+    capex = (p['epc_cost'] + p['interconnection_cost'] + p['developer_fee'] + p['transaction_costs']) * p['project_size_dc'] * 1e6
+    return {'capex': capex}
+
+
+def stage_tax_equity(p, upstream):
+    # ITC Eligible CapEx excludes Transaction Costs
+    itc_eligible_capex = (p['epc_cost'] + p['interconnection_cost'] + p['developer_fee']) * p['project_size_dc'] * 1e6
+    itc = itc_eligible_capex * p['itc_amount'] * p['itc_eligible_portion']
+    fmv = itc * (1 + p['fmv_step_up'])  # FMV Step-up applied on ITC
+    te_investment = itc * p['te_investment']
+    return {'itc': itc, 'fmv': fmv, 'te_investment': te_investment}
+
+
+def stage_production(p, upstream):
+    # The production stage also owns the project timeline (construction year + PPA + post-PPA)
+    total_years = 1 + p['ppa_tenor'] + p['post_ppa_tenor']
+    years = np.arange(total_years.max())
+    active = years < total_years
+    operating = active & (years >= 1)
+
+    initial_production = p['project_size_dc'] * p['production_yield'] * 1000
+    degradation_factor = np.where(
+        years >= p['degradation_start_year'],
+        (1 - p['degradation_rate']) ** (years - p['degradation_start_year']),
+        1.0
+    )
+    production = np.where(operating, initial_production * degradation_factor, 0.0)
+    return {'years': years, 'total_years': total_years, 'active': active, 'operating': operating, 'production': production}
+
+
+def stage_price(p, upstream):
+    years = upstream['production']['years']
+    operating = upstream['production']['operating']
+    is_ppa = years <= p['ppa_tenor']
+
+    # PPA price starts at initial rate and escalates annually
+    ppa_price = p['ppa_rate'] * (1 + p['ppa_escalation']) ** (years - 1)
+    avoided_ppa_price = p['avoided_cost_ppa_price'] * (1 + p['avoided_cost_escalation']) ** (years - 1)
+
+    # Merchant price from the state's curve, or from each project's own simulated price path
+    calendar_years = p['construction_start'] + years - 1
+    merchant_prices = upstream.get('merchant_prices')
+    if merchant_prices is None:
+        state_index = np.vectorize(MERCHANT_PRICE_STATE_INDEX.__getitem__, otypes=[int])(p['state'])
+        merchant_price = merchant_price_lookup(state_index, calendar_years)
+    else:
+        path_index = np.clip(calendar_years - merchant_prices['first_year'], 0, merchant_prices['prices'].shape[1] - 1)
+        merchant_price = np.take_along_axis(merchant_prices['prices'], path_index, axis=1)
+
+    energy_price = np.where(operating, np.where(is_ppa, ppa_price, merchant_price), 0.0)
+    # After PPA, avoided cost price equals merchant price
+    avoided_price = np.where(operating, np.where(is_ppa, avoided_ppa_price, merchant_price), 0.0)
+    rec_price = np.select(
+        [(years >= 1) & (years <= 5), (years >= 6) & (years <= 10), (years >= 11) & (years <= 15)],
+        [p['rec_price_years_1_5'], p['rec_price_years_6_10'], p['rec_price_years_11_15']],
+        0.0
+    ) * operating
+    return {'is_ppa': is_ppa & operating, 'energy_price': energy_price, 'rec_price': rec_price, 'avoided_price': avoided_price}
+
+
+def stage_revenue(p, upstream):
+    years = upstream['production']['years']
+    production = upstream['production']['production']
+    price = upstream['price']
+
+    revenue = production * (price['energy_price'] + price['rec_price']) / 1000  # Convert to MWh
+    # Incentive amount at COD (Year 1)
+    revenue = revenue + np.where(years == 1, p['incentive_amount'], 0.0)
+    # Savings calculation (excluding REC price)
+    savings = (price['avoided_price'] - price['energy_price']) * production / 1000
+    return {'revenue': revenue, 'savings': savings}
+
+
+def stage_opex(p, upstream):
+    years = upstream['production']['years']
+    active = upstream['production']['active']
+    dc_kw = p['project_size_dc'] * 1000
+
+    rent_basis = np.select(
+        [p['rent_option'] == "Flat Lease/Year", p['rent_option'] == "$/Acre + Escalation", p['rent_option'] == "$/MW-ac + Escalation"],
+        [1.0, p['site_acres'], p['project_size_ac']]
+    )
+    construction_rent = p['construction_rent'] * rent_basis
+
+    property_tax = p['property_tax'] * p['site_acres'] * (1 + p['property_tax_escalation']) ** (years - 1)
+    rent = p['operating_rent'] * rent_basis * (1 + p['rent_escalation']) ** (years - 1)
+    asset_management = p['asset_management_cost'] * dc_kw * (1 + p['asset_management_escalation']) ** (years - 1)
+    other_asset_management = p['other_asset_management_cost'] * dc_kw * (1 + p['other_asset_management_escalation']) ** (years - 1)
+    insurance = p['insurance_cost'] * dc_kw
+    # O&M Costs start from Year 2 with escalation
+    om_cost = np.where(years >= 2, p['om_cost'] * dc_kw * (1 + p['om_escalation']) ** (years - 2), 0.0)
+    # Inverter Replacement costs apply only between Year 6 and Year 15, based on MW-AC
+    inverter_replacement = np.where((years >= 6) & (years <= 15), p['inverter_replacement_cost'] * p['project_size_ac'] * 1000, 0.0)
+
+    operating_opex = om_cost + asset_management + insurance + property_tax + inverter_replacement + rent + other_asset_management
+    opex = np.where(active, np.where(years == 0, construction_rent, operating_opex), 0.0)
+    return {'opex': opex}
+
+
+def stage_cash_flow(p, upstream):
+    years = upstream['production']['years']
+    active = upstream['production']['active']
+    capex = upstream['capex']['capex']
+    fmv = upstream['tax_equity']['fmv']
+
+    ebitda = upstream['revenue']['revenue'] - upstream['opex']['opex']
+
+    # Tax equity distributions and buyout
+    preferred_return = np.where(active & (years >= 1) & (years <= p['buyout_year']), fmv * p['preferred_return'], 0.0)
+    buyout_cost = np.where(active & (years == p['buyout_year']), fmv * p['buyout_percentage'], 0.0)
+    cash_flows = ebitda - preferred_return - buyout_cost + np.where(years == 0, fmv - capex, 0.0)
+
+    remaining_itc_cash_flows = fmv - preferred_return.sum(axis=1, keepdims=True) - fmv * p['buyout_percentage']
+    return {'ebitda': ebitda, 'cash_flows': cash_flows, 'remaining_itc_cash_flows': remaining_itc_cash_flows}
+
+
+# Depreciation schedules as fractions of the depreciable basis by project year (Year 0 is
+# construction, so depreciation starts at COD): MACRS 5-year (half-year convention) and bonus.
+MACRS_5_YEAR = [0.20, 0.32, 0.192, 0.1152, 0.1152, 0.0576]
+MAX_PROJECT_YEARS = 1 + 30 + 30  # Construction year + longest PPA and post-PPA tenors
+DEPRECIATION_SCHEDULES = np.zeros((2, MAX_PROJECT_YEARS))
+DEPRECIATION_SCHEDULES[0, 1:1 + len(MACRS_5_YEAR)] = MACRS_5_YEAR
+DEPRECIATION_SCHEDULES[1, 1] = 1.0
+
+
+def stage_tax(p, upstream):
+    years = upstream['production']['years']
+    active = upstream['production']['active']
+    capex = upstream['capex']['capex']
+    itc = upstream['tax_equity']['itc']
+
+    schedules = DEPRECIATION_SCHEDULES[:, :len(years)]
+    if schedules.shape[1] < len(years):
+        schedules = np.pad(schedules, ((0, 0), (0, len(years) - schedules.shape[1])))
+
+    # Basis is reduced by half the ITC; the bonus share is expensed at COD, the rest follows MACRS
+    depreciable_basis = capex - 0.5 * itc
+    schedule_weights = np.hstack([1 - p['bonus_depreciation'], p['bonus_depreciation']])
+    depreciation = np.where(active, depreciable_basis * (schedule_weights @ schedules), 0.0)
+
+    # Tax losses are assumed to be used as they arise (negative tax is a benefit)
+    taxable_income = upstream['cash_flow']['ebitda'] - depreciation
+    taxes = np.where(active & p['after_tax'], p['tax_rate'] * taxable_income, 0.0)
+    return {'depreciation': depreciation, 'taxes': taxes, 'cash_flows': upstream['cash_flow']['cash_flows'] - taxes}
+
+
+def stage_flip(p, upstream):
+    years = upstream['production']['years']
+    active = upstream['production']['active']
+    capex = upstream['capex']['capex']
+    tax_equity = upstream['tax_equity']
+    ebitda = upstream['cash_flow']['ebitda']
+    is_flip = p['te_structure'] == 'Partnership Flip'
+
+    # Investor flows with pre-flip allocations: its cash share of EBITDA plus its tax share of the
+    # ITC (claimed at COD) and of the tax effect of taxable income, against its investment at Year 0
+    taxable_income = ebitda - upstream['tax']['depreciation']
+    tax_benefit = np.where(years == 1, tax_equity['itc'], 0.0) - p['tax_rate'] * taxable_income
+    pre_flip_flows = np.where(
+        years == 0,
+        -tax_equity['te_investment'],
+        np.where(active, p['pre_flip_cash_share'] * ebitda + p['pre_flip_tax_share'] * tax_benefit, 0.0)
+    )
+
+    # The investor reaches its target yield in the first year its discounted flows to date turn
+    # non-negative; solved for every project at once
+    discounted = np.cumsum(pre_flip_flows * (1 + p['te_target_yield']) ** -years, axis=1)
+    reached = (discounted.real >= 0) & (years >= 1) & active
+    flip_year = np.where(reached.any(axis=1), reached.argmax(axis=1), -1)[:, None]
+
+    pre_flip = (flip_year < 0) | (years <= flip_year)
+    cash_share = np.where(pre_flip, p['pre_flip_cash_share'], p['post_flip_share'])
+    tax_share = np.where(pre_flip, p['pre_flip_tax_share'], p['post_flip_share'])
+    investor_cash = np.where(active & (years >= 1), cash_share * ebitda, 0.0)
+
+    # Sponsor keeps the rest of the cash and, in after-tax mode, pays its share of the taxes
+    sponsor_taxes = np.where(active & p['after_tax'], (1 - tax_share) * p['tax_rate'] * taxable_income, 0.0)
+    sponsor_cash_flows = ebitda - investor_cash - sponsor_taxes + np.where(years == 0, tax_equity['te_investment'] - capex, 0.0)
+
+    return {
+        'is_flip': is_flip,
+        'flip_year': np.where(is_flip, flip_year, -1),
+        'investor_cash': np.where(is_flip, investor_cash, 0.0),
+        'te_proceeds': np.where(is_flip, tax_equity['te_investment'], tax_equity['fmv']),
+        'cfads': np.where(is_flip, ebitda - investor_cash, ebitda),
+        'cash_flows': np.where(is_flip, sponsor_cash_flows, upstream['tax']['cash_flows']),
+    }
+
+
+def stage_debt(p, upstream):
+    years = upstream['production']['years']
+    operating = upstream['production']['operating']
+
+    # Debt service is sculpted to the target DSCR on EBITDA (CFADS) over the debt tenor, and
+    # the debt size is the present value of that debt service at the debt rate
+    in_tenor = operating & (years <= p['debt_tenor']) & p['include_debt']
+    cfads = upstream['flip']['cfads']
+    debt_service = np.where(in_tenor, np.maximum(cfads, 0.0) / p['target_dscr'], 0.0)
+    debt_discount_factors = (1 + p['debt_rate']) ** -years
+    discounted_debt_service = debt_service * debt_discount_factors
+    debt_size = discounted_debt_service.sum(axis=1, keepdims=True)
+
+    # Opening balance of each year is the PV of the remaining debt service
+    remaining = debt_size - np.cumsum(discounted_debt_service, axis=1) + discounted_debt_service
+    opening_balance = np.where(years >= 1, remaining / debt_discount_factors * (1 + p['debt_rate']) ** -1, 0.0)
+    interest = np.where(in_tenor, opening_balance * p['debt_rate'], 0.0)
+
+    # Interest is tax deductible in after-tax mode
+    interest_tax_shield = np.where(p['after_tax'], p['tax_rate'] * interest, 0.0)
+    levered_cash_flows = upstream['flip']['cash_flows'] - debt_service + interest_tax_shield + np.where(years == 0, debt_size, 0.0)
+    return {
+        'debt_size': debt_size,
+        'debt_service': debt_service,
+        'interest': interest,
+        'cfads': np.where(in_tenor, cfads, 0.0),
+        'levered_cash_flows': levered_cash_flows,
+    }
+
+
+# Marginal emissions
+# Avoided CO₂ uses marginal emissions factors (lbs CO₂ per MWh) of the project's grid region,
+# weighted by when solar produces. Factor tables are .npy files named after the region in
+# EMISSIONS_FACTORS_DIR, either monthly (12), month x hour of day (12 x 24) or hourly (8760), and
+# are memory-mapped. Regions without a file use the flat state_emissions_factors value.
+EMISSIONS_FACTORS_DIR = os.environ.get('EMISSIONS_FACTORS_DIR', 'emissions_factors')
+GRID_REGIONS = {'NY': 'NYISO', 'CA': 'CAISO', 'IL': 'PJM', 'TX': 'ERCOT', 'NJ': 'PJM'}
+HOURS_PER_YEAR = 8760
+DAYS_PER_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+HOUR_MONTH = np.repeat(np.arange(12), DAYS_PER_MONTH * 24)
+HOUR_OF_DAY = np.tile(np.arange(24), HOURS_PER_YEAR // 24)
+
+
+def solar_production_shape(latitude=40.0):
+    """
+    Share of annual solar production in each hour of a typical year, from the sun's elevation
+    on the middle day of each month (no weather).
+    """
+    mid_month_day = np.cumsum(DAYS_PER_MONTH) - DAYS_PER_MONTH / 2
+    declination = np.radians(23.45) * np.sin(2 * np.pi * (284 + mid_month_day) / 365)
+    hour_angle = np.radians(15 * (np.arange(24) + 0.5 - 12))
+    latitude = np.radians(latitude)
+    sin_elevation = (np.sin(latitude) * np.sin(declination)[:, None]
+                     + np.cos(latitude) * np.cos(declination)[:, None] * np.cos(hour_angle)[None, :])
+    shape = np.maximum(sin_elevation, 0.0)[HOUR_MONTH, HOUR_OF_DAY]
+    return shape / shape.sum()
+
+
+SOLAR_PRODUCTION_SHAPE = solar_production_shape()
+# Hourly factors attached from shared memory in worker processes, by region
+SHARED_EMISSIONS_FACTORS = {}
+
+
+def project_grid_region(project_data):
+    return project_data.get('grid_region') or GRID_REGIONS.get(project_data['state'], project_data['state'])
+
+
+def load_emissions_factors(region, factors_dir=EMISSIONS_FACTORS_DIR):
+    """
+    Hourly marginal emissions factors for a grid region (8760 values), or None without a file.
+    """
+    path = os.path.join(factors_dir, f'{region}.npy')
+    if not os.path.exists(path):
+        return None
+    factors = np.load(path, mmap_mode='r')
+    if factors.shape == (12,):
+        return factors[HOUR_MONTH]
+    if factors.shape == (12, 24):
+        return factors[HOUR_MONTH, HOUR_OF_DAY]
+    if factors.shape == (HOURS_PER_YEAR,):
+        return factors
+    raise ValueError(f'Emissions factors for {region} must have 12, 12 x 24 or 8760 values, not {factors.shape}')
+
+
+@lru_cache(maxsize=64)
+def cached_effective_emissions_factor(region, factors_dir, modified):
+    return float(SOLAR_PRODUCTION_SHAPE @ load_emissions_factors(region, factors_dir))
+
+
+def effective_emissions_factor(region, state, factors_dir=EMISSIONS_FACTORS_DIR):
+    """
+    Production-weighted marginal emissions factor of a grid region, re-read only when its file
+    changes. Without a file for the region, the state's flat factor is used.
+    """
+    if region in SHARED_EMISSIONS_FACTORS:
+        return float(SOLAR_PRODUCTION_SHAPE @ SHARED_EMISSIONS_FACTORS[region])
+    path = os.path.join(factors_dir, f'{region}.npy')
+    if not os.path.exists(path):
+        return float(state_emissions_factors.get(state, 1000))  # Default to 1000 if state not found
+    return cached_effective_emissions_factor(region, factors_dir, os.path.getmtime(path))
+
+
+def stage_emissions(p, upstream):
+    sites = [
+        (grid_region or GRID_REGIONS.get(state, state), state)
+        for grid_region, state in zip(p['grid_region'].ravel(), p['state'].ravel())
+    ]
+    factor_by_site = {site: effective_emissions_factor(*site) for site in set(sites)}
+    emissions_factor = np.array([factor_by_site[site] for site in sites])[:, None]
+    co2_avoided = upstream['production']['production'] / 1000 * emissions_factor  # lbs per year
+    return {'emissions_factor': emissions_factor, 'co2_avoided': co2_avoided}
+
+
+# Discount curves
+# NPV, LCOE and discounted payback use the flat discount_rate unless a project has a
+# discount_curve: either per-year spot rates (year 1 first, the last rate held for later years)
+# or the name of a curve in DISCOUNT_CURVES_PATH, a CSV with curve, year and rate columns.
+# Factors are built once per distinct curve and shared by every project in the batch.
+DISCOUNT_CURVES_PATH = os.environ.get('DISCOUNT_CURVES_PATH', 'discount_curves.csv')
+
+
+@lru_cache(maxsize=8)
+def read_discount_curves(path, modified):
+    curves_df = pd.read_csv(path).sort_values(['curve', 'year'])
+    return {name: tuple(curve_df['rate']) for name, curve_df in curves_df.groupby('curve')}
+
+
+def load_discount_curves(path=DISCOUNT_CURVES_PATH):
+    """
+    Named discount curves from file, re-read only when the file changes. Empty if there is no file.
+    """
+    if not os.path.exists(path):
+        return {}
+    return read_discount_curves(path, os.path.getmtime(path))
+
+
+@lru_cache(maxsize=256)
+def curve_discount_factors(rates, n_years):
+    rates = np.asarray(rates + rates[-1:] * max(n_years - 1 - len(rates), 0), dtype=float)[:n_years - 1]
+    return np.concatenate([[1.0], (1 + rates) ** -np.arange(1, n_years)])
+
+
+def discount_factor_table(discount_rate, discount_curve, years):
+    """
+    (projects x years) discount factors from flat rates and optional per-project curves.
+    """
+    factors = (1 + discount_rate) ** -years
+    curves = discount_curve.ravel()
+    if all(curve is None for curve in curves):
+        return factors
+
+    factors = np.array(np.broadcast_to(factors, (len(curves), years.shape[-1])))
+    named_curves = load_discount_curves() if any(isinstance(curve, str) for curve in curves) else {}
+    for curve in set(curves) - {None}:
+        if isinstance(curve, str) and curve not in named_curves:
+            raise ValueError(f"Unknown discount curve '{curve}'")
+        rates = named_curves[curve] if isinstance(curve, str) else curve
+        factors[[row_curve == curve for row_curve in curves]] = curve_discount_factors(tuple(rates), years.shape[-1])
+    return factors
+
+
+def stage_metrics(p, upstream):
+    years = upstream['production']['years']
+    total_years = upstream['production']['total_years'].ravel()
+    cash_flows = upstream['flip']['cash_flows']
+    capex = upstream['capex']['capex']
+    te_proceeds = upstream['flip']['te_proceeds']
+
+    discount_factors = discount_factor_table(p['discount_rate'], p['discount_curve'], years)
+    npv = (cash_flows * discount_factors).sum(axis=1)
+
+    # LCOE: discounted costs (CapEx in year 0 plus OpEx) over discounted production in MWh
+    npv_costs = capex.ravel() + (upstream['opex']['opex'] * discount_factors).sum(axis=1)
+    npv_production = (upstream['production']['production'] / 1000 * discount_factors).sum(axis=1)
+
+    # Saved NPV: NPV without Tax Equity minus NPV with Tax Equity (Tax Equity only affects Year 0)
+    npv_no_tax_equity = npv + te_proceeds.ravel()
+
+    cumulative_cash_flows = np.cumsum(cash_flows, axis=1)
+    positive = cumulative_cash_flows > 0
+    discounted_positive = np.cumsum(cash_flows * discount_factors, axis=1) > 0
+
+    irr, irr_iterations = solve_irr(cash_flows, upstream.get('irr_guess'), total_years)
+
+    # Levered returns, only solved for projects that carry debt
+    debt = upstream['debt']
+    levered_irr = irr.copy()
+    has_debt = debt['debt_size'].ravel() > 0
+    if has_debt.any():
+        levered_irr[has_debt], _ = solve_irr(debt['levered_cash_flows'][has_debt], irr[has_debt], total_years[has_debt])
+    # Sculpted debt service covers CFADS at exactly the target DSCR, so the DSCR itself says
+    # nothing; report how much of the capex the debt funds and how many years it is serviced
+    leverage = debt['debt_size'].ravel() / capex.ravel()
+    debt_service_years = (debt['debt_service'] > 0).sum(axis=1)
+
+    return {
+        'irr': irr,
+        'irr_iterations': irr_iterations,
+        'levered_irr': levered_irr,
+        'debt_size': debt['debt_size'].ravel(),
+        'leverage': leverage,
+        'debt_service_years': debt_service_years,
+        'npv': npv,
+        'lcoe': npv_costs / npv_production,
+        'saved_npv': npv_no_tax_equity - npv,
+        'unlevered_capex': (capex - te_proceeds).ravel(),
+        'flip_year': upstream['flip']['flip_year'].ravel(),
+        'total_revenue': upstream['revenue']['revenue'].sum(axis=1),
+        'total_ebitda': upstream['cash_flow']['ebitda'].sum(axis=1),
+        'total_taxes': upstream['tax']['taxes'].sum(axis=1),
+        'savings_notional': upstream['revenue']['savings'].sum(axis=1),
+        'payback_years': np.where(positive.any(axis=1), positive.argmax(axis=1), -1),
+        'discounted_payback_years': np.where(discounted_positive.any(axis=1), discounted_positive.argmax(axis=1), -1),
+    }
+
+
+MODEL_STAGES = [
+    {
+        'name': 'capex',
+        'inputs': ['epc_cost', 'interconnection_cost', 'developer_fee', 'transaction_costs', 'project_size_dc'],
+        'depends_on': [],
+        'function': stage_capex,
+    },
+    {
+        'name': 'tax_equity',
+        'inputs': ['epc_cost', 'interconnection_cost', 'developer_fee', 'project_size_dc', 'itc_amount',
+                   'itc_eligible_portion', 'fmv_step_up', 'te_investment'],
+        'depends_on': [],
+        'function': stage_tax_equity,
+    },
+    {
+        'name': 'production',
+        'inputs': ['project_size_dc', 'production_yield', 'degradation_rate', 'degradation_start_year',
+                   'ppa_tenor', 'post_ppa_tenor'],
+        'depends_on': [],
+        'function': stage_production,
+    },
+    {
+        'name': 'price',
+        'inputs': ['ppa_rate', 'ppa_escalation', 'ppa_tenor', 'construction_start', 'state',
+                   'avoided_cost_ppa_price', 'avoided_cost_escalation',
+                   'rec_price_years_1_5', 'rec_price_years_6_10', 'rec_price_years_11_15'],
+        'accepts_merchant_prices': True,
+        'depends_on': ['production'],
+        'function': stage_price,
+    },
+    {
+        'name': 'revenue',
+        'inputs': ['incentive_amount'],
+        'depends_on': ['production', 'price'],
+        'function': stage_revenue,
+    },
+    {
+        'name': 'opex',
+        'inputs': ['rent_option', 'construction_rent', 'operating_rent', 'rent_escalation', 'site_acres',
+                   'project_size_dc', 'project_size_ac', 'property_tax', 'property_tax_escalation',
+                   'asset_management_cost', 'asset_management_escalation', 'other_asset_management_cost',
+                   'other_asset_management_escalation', 'insurance_cost', 'om_cost', 'om_escalation',
+                   'inverter_replacement_cost'],
+        'depends_on': ['production'],
+        'function': stage_opex,
+    },
+    {
+        'name': 'cash_flow',
+        'inputs': ['buyout_year', 'preferred_return', 'buyout_percentage'],
+        'depends_on': ['production', 'capex', 'tax_equity', 'revenue', 'opex'],
+        'function': stage_cash_flow,
+    },
+    {
+        'name': 'tax',
+        'inputs': ['after_tax', 'tax_rate', 'bonus_depreciation'],
+        'depends_on': ['production', 'capex', 'tax_equity', 'cash_flow'],
+        'function': stage_tax,
+    },
+    {
+        'name': 'flip',
+        'inputs': ['te_structure', 'te_target_yield', 'pre_flip_cash_share', 'pre_flip_tax_share',
+                   'post_flip_share', 'after_tax', 'tax_rate'],
+        'depends_on': ['production', 'capex', 'tax_equity', 'cash_flow', 'tax'],
+        'function': stage_flip,
+    },
+    {
+        'name': 'debt',
+        'inputs': ['include_debt', 'debt_tenor', 'debt_rate', 'target_dscr', 'after_tax', 'tax_rate'],
+        'depends_on': ['production', 'flip'],
+        'function': stage_debt,
+    },
+    {
+        'name': 'emissions',
+        'inputs': ['state', 'grid_region'],
+        'depends_on': ['production'],
+        'function': stage_emissions,
+    },
+    {
+        'name': 'metrics',
+        'inputs': ['discount_rate', 'discount_curve'],
+        'accepts_irr_guess': True,
+        'depends_on': ['production', 'capex', 'revenue', 'opex', 'cash_flow', 'tax', 'flip', 'debt'],
+        'function': stage_metrics,
+    },
+]
+
+
+def run_model_stages(projects, stage_cache=None, stages=MODEL_STAGES, irr_guess=None, merchant_prices=None):
+    """
+    Evaluate the model stages (all of them, or the given leading subset) for a list of
+    project_data dicts. irr_guess (scalar or one per project) warm-starts the IRR solve.
+    merchant_prices ({'first_year', 'prices': projects x calendar years}, e.g. from
+    merchant_prices_for_projects) replaces the state merchant curves with one price path per project.
+
+    If a stage_cache dict is given, each stage's output is stored under a fingerprint of its
+    input fields and upstream fingerprints, and reused on the next call when nothing it depends
+    on has changed. Returns the stage outputs and a report of reused/recomputed stages.
+    """
+    outputs = {}
+    fingerprints = {}
+    report = {'reused': [], 'recomputed': []}
+
+    for stage in stages:
+        name = stage['name']
+        if stage_cache is not None:
+            fingerprint = hash_project_data({
+                'stage': name,
+                'inputs': [[project_value(project, field) for field in stage['inputs']] for project in projects],
+                'upstream': [fingerprints[dependency] for dependency in stage['depends_on']],
+                'merchant_prices': None if merchant_prices is None or not stage.get('accepts_merchant_prices') else [
+                    merchant_prices['first_year'],
+                    hashlib.sha256(np.ascontiguousarray(merchant_prices['prices']).tobytes()).hexdigest(),
+                ],
+            })
+            fingerprints[name] = fingerprint
+            cached = stage_cache.get(name)
+            if cached is not None and cached[0] == fingerprint:
+                outputs[name] = cached[1]
+                report['reused'].append(name)
+                continue
+
+        upstream = {dependency: outputs[dependency] for dependency in stage['depends_on']}
+        if stage.get('accepts_irr_guess'):
+            upstream['irr_guess'] = irr_guess
+        if stage.get('accepts_merchant_prices'):
+            upstream['merchant_prices'] = merchant_prices
+        outputs[name] = stage['function'](project_arrays(projects, stage['inputs']), upstream)
+        report['recomputed'].append(name)
+        if stage_cache is not None:
+            stage_cache[name] = (fingerprints[name], outputs[name])
+
+    return outputs, report
+
+
+# Forward-mode sensitivities
+# Derivatives are carried through the cash-flow stages with the complex step: each
+# differentiable field gets its own batch row with an imaginary perturbation, which behaves
+# like a dual number (exact first derivatives, no subtractive cancellation). NPV and IRR
+# derivatives then follow analytically from the cash-flow Jacobian.
+SENSITIVITY_STEP = 1e-20
+CASH_FLOW_STAGES = [stage for stage in MODEL_STAGES if stage['name'] not in ('debt', 'metrics')]
+# Integer inputs that move the timeline or switch regimes have no derivative
+DISCRETE_FIELDS = {
+    'ppa_tenor', 'post_ppa_tenor', 'buyout_year', 'degradation_start_year', 'ppa_escalation_start_year', 'debt_tenor'
+}
+
+
+def calculate_sensitivities(project_data):
+    """
+    dNPV/dInput and dIRR/dInput for every numeric project_data field that feeds the cash flows,
+    from one batched evaluation, plus the first-order NPV breakeven value of each input.
+    """
+    cash_flow_fields = {field for stage in CASH_FLOW_STAGES for field in stage['inputs']}
+    fields = [
+        field for field in project_data
+        if field in cash_flow_fields and field not in DISCRETE_FIELDS
+        and isinstance(project_data[field], (int, float)) and not isinstance(project_data[field], bool)
+    ]
+    perturbed = [{**project_data, field: project_data[field] + 1j * SENSITIVITY_STEP} for field in fields]
+    outputs, _ = run_model_stages(perturbed, stages=CASH_FLOW_STAGES)
+
+    total_years = int(outputs['production']['total_years'][0, 0])
+    years = outputs['production']['years'][:total_years]
+    cash_flows_batch = outputs['flip']['cash_flows'][:, :total_years]
+    cash_flows = cash_flows_batch[0].real
+    jacobian = cash_flows_batch.imag / SENSITIVITY_STEP  # (fields x years)
+
+    discount_rate = project_data['discount_rate']
+    # project_arrays keeps a per-year curve as one tuple in a single object cell
+    discount_curve = project_arrays([project_data], ['discount_curve'])['discount_curve']
+    discount_factors = discount_factor_table(np.array([[discount_rate]]), discount_curve, years)[0]
+    npv = np.sum(cash_flows * discount_factors)
+    npv_gradient = jacobian @ discount_factors
+
+    # Implicit function theorem on NPV(irr) = 0
+    irr = solve_irr(cash_flows)[0][0]
+    irr_discount_factors = (1 + irr) ** -years
+    npv_slope_at_irr = np.sum(-years * cash_flows * irr_discount_factors / (1 + irr))
+    irr_gradient = -(jacobian @ irr_discount_factors) / npv_slope_at_irr
+
+    sensitivity_df = pd.DataFrame({
+        'Input': fields,
+        'Value': [project_data[field] for field in fields],
+        'dNPV/dInput': npv_gradient,
+        'dIRR/dInput': irr_gradient,
+    })
+    # The flat discount rate only enters the NPV, and not at all when a discount curve is used
+    if discount_curve[0, 0] is None:
+        sensitivity_df.loc[len(sensitivity_df)] = [
+            'discount_rate', discount_rate, np.sum(-years * cash_flows * (1 + discount_rate) ** (-years - 1)), 0.0
+        ]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sensitivity_df['NPV Breakeven'] = np.where(
+            sensitivity_df['dNPV/dInput'] != 0,
+            sensitivity_df['Value'] - npv / sensitivity_df['dNPV/dInput'],
+            np.nan
+        )
+    return sensitivity_df[sensitivity_df['dNPV/dInput'] != 0].reset_index(drop=True)
+
+
+def results_from_stages(project_data, outputs, row=0):
+    """
+    Build the results dict (metrics, cash flows, annual table, carbon offsets) for one
+    project (row) of the stage outputs.
+    """
+    production_stage = outputs['production']
+    total_years = int(production_stage['total_years'][row, 0])
+    annual = lambda stage, key: outputs[stage][key][row, :total_years]
+
+    years = production_stage['years'][:total_years]
+    price = annual('price', 'energy_price') + annual('price', 'rec_price')
+    rec_price = annual('price', 'rec_price')
+    revenue_type = np.where(annual('price', 'is_ppa'), 'PPA', 'Merchant').astype(object)
+    revenue_type[rec_price > 0] += ' + REC'
+    revenue_type[0] = 'Construction'
+
+    after_tax = bool(project_value(project_data, 'after_tax'))
+    table = {
+        'Year': project_data['construction_start'].year + years,
+        'Net Production (MWh)': annual('production', 'production') / 1000,
+        'Our Price ($/MWh)': price,
+        'Avoided Cost Price ($/MWh)': annual('price', 'avoided_price'),
+        'Revenue Type': revenue_type,
+        'Revenue ($)': annual('revenue', 'revenue'),
+        'Operating Expenses ($)': annual('opex', 'opex'),
+        'EBITDA ($)': annual('cash_flow', 'ebitda'),
+    }
+    if after_tax:
+        table['Depreciation ($)'] = annual('tax', 'depreciation')
+        table['Income Taxes ($)'] = annual('tax', 'taxes')
+    te_structure = project_value(project_data, 'te_structure')
+    if te_structure == 'Partnership Flip':
+        table['Investor Cash ($)'] = annual('flip', 'investor_cash')
+    table['Total Cash Flows ($)'] = annual('flip', 'cash_flows')
+    include_debt = bool(project_value(project_data, 'include_debt'))
+    if include_debt:
+        table['Debt Service ($)'] = annual('debt', 'debt_service')
+        table['Levered Cash Flows ($)'] = annual('debt', 'levered_cash_flows')
+    table['Savings Unlocked ($)'] = annual('revenue', 'savings')
+    revenue_df = append_totals_row(pd.DataFrame(table))
+
+    metrics_stage = outputs['metrics']
+    payback_years = int(metrics_stage['payback_years'][row])
+    discounted_payback_years = int(metrics_stage['discounted_payback_years'][row])
+    metrics = {
+        key: float(metrics_stage[key][row])
+        for key in ['irr', 'npv', 'lcoe', 'total_revenue', 'total_ebitda', 'total_taxes', 'unlevered_capex',
+                    'saved_npv', 'savings_notional', 'levered_irr', 'debt_size', 'leverage', 'debt_service_years']
+    }
+    metrics['after_tax'] = after_tax
+    metrics['include_debt'] = include_debt
+    metrics['te_structure'] = te_structure
+    flip_year = int(metrics_stage['flip_year'][row])
+    metrics['flip_year'] = flip_year if flip_year >= 0 else 'Not reached'
+    metrics['payback_years'] = payback_years if payback_years >= 0 else 'Not achieved'
+    metrics['discounted_payback_years'] = discounted_payback_years if discounted_payback_years >= 0 else 'Not achieved'
+    metrics['remaining_itc_cash_flows'] = float(outputs['cash_flow']['remaining_itc_cash_flows'][row, 0])
+
+    carbon_offsets = carbon_offset_equivalents(
+        revenue_df.loc[revenue_df['Year'] != 'Total', 'Net Production (MWh)'].sum(),
+        outputs['emissions']['co2_avoided'][row, :total_years].sum()
+    )
+    return {
+        'cash_flows': annual('flip', 'cash_flows').copy(),
+        'revenue_df': revenue_df,
+        'metrics': metrics,
+        'carbon_offsets': {key: float(value) for key, value in carbon_offsets.items()},
+    }
+
+
+def evaluate_project(project_data, stage_cache=None, irr_guess=None):
+    """
+    Run the full model for one project and collect everything the results page shows.
+    Pass the same stage_cache dict between calls to only recompute stages whose inputs changed,
+    and the previous IRR as irr_guess to warm-start the IRR solve.
+    """
+    outputs, stage_report = run_model_stages([project_data], stage_cache, irr_guess=irr_guess)
+    return project_results(project_data, outputs, stage_report, irr_guess)
+
+
+def project_results(project_data, outputs, stage_report, irr_guess=None):
+    """
+    results_from_stages() for a single-project run, plus its stage report and IRR convergence.
+    """
+    results = results_from_stages(project_data, outputs)
+    results['stage_report'] = stage_report
+    # Convergence statistics, with the cold-start iteration count for comparison
+    results['irr_stats'] = {
+        'iterations': int(outputs['metrics']['irr_iterations'][0]) if 'metrics' in stage_report['recomputed'] else 0,
+        'cold_start_iterations': int(solve_irr(results['cash_flows'])[1][0]),
+        'warm_start': irr_guess is not None,
+    }
+    return results
+
+
+def sweep_field(project_data, field, values, stage_cache=None):
+    """
+    One-at-a-time sensitivity sweep of a single project_data field. Stages upstream of the
+    field are computed once and reused for every value, and each IRR solve starts from the
+    previous grid point's IRR.
+    """
+    stage_cache = {} if stage_cache is None else stage_cache
+    rows = []
+    irr_guess = None
+    for value in values:
+        outputs, stage_report = run_model_stages([{**project_data, field: value}], stage_cache, irr_guess=irr_guess)
+        irr = outputs['metrics']['irr'][0]
+        rows.append({
+            field: value,
+            'irr': irr,
+            'npv': outputs['metrics']['npv'][0],
+            'lcoe': outputs['metrics']['lcoe'][0],
+            'stages_reused': len(stage_report['reused']),
+            'irr_iterations': outputs['metrics']['irr_iterations'][0],
+        })
+        irr_guess = irr if np.isfinite(irr) else None
+    return pd.DataFrame(rows)
+
+
+def carbon_offsets_batch(projects):
+    """
+    Lifetime production, marginal emissions factor, avoided CO₂ and equivalents for many
+    projects at once (production and emissions stages only), one row per project.
+    """
+    emissions_stages = [stage for stage in MODEL_STAGES if stage['name'] in ('production', 'emissions')]
+    outputs, _ = run_model_stages(projects, stages=emissions_stages)
+    total_net_production_mwh = outputs['production']['production'].sum(axis=1) / 1000
+    total_co2_avoided_lbs = outputs['emissions']['co2_avoided'].sum(axis=1)
+    carbon_df = pd.DataFrame({
+        'state': [project['state'] for project in projects],
+        'grid_region': [project_grid_region(project) for project in projects],
+        'total_net_production_mwh': total_net_production_mwh,
+        'emissions_factor_lbs_per_mwh': outputs['emissions']['emissions_factor'].ravel(),
+    })
+    for key, values in carbon_offset_equivalents(total_net_production_mwh, total_co2_avoided_lbs).items():
+        carbon_df[key] = values
+    return carbon_df
+
+
+# NPV attribution
+# Explains why NPV and IRR moved between two project_data snapshots by switching groups of
+# inputs from their base to their new values. The sequential method switches the groups one at
+# a time in ATTRIBUTION_GROUPS order, so each group's share depends on that order; the Shapley
+# method averages each group's effect over every order, which only needs the 2^k mixes of k
+# changed groups. Either way every mixed scenario is evaluated in one run_model_stages batch.
+ATTRIBUTION_GROUPS = {
+    'CapEx': ['epc_cost', 'interconnection_cost', 'developer_fee', 'transaction_costs'],
+    'Production': ['project_size_dc', 'project_size_ac', 'production_yield', 'degradation_rate',
+                   'degradation_start_year', 'post_ppa_tenor'],
+    'Price': ['ppa_rate', 'ppa_escalation', 'ppa_escalation_start_year', 'ppa_tenor', 'avoided_cost_ppa_price',
+              'avoided_cost_escalation', 'rec_price_years_1_5', 'rec_price_years_6_10', 'rec_price_years_11_15',
+              'incentive_amount'],
+    'OpEx': ['rent_option', 'construction_rent', 'operating_rent', 'rent_escalation', 'site_acres', 'property_tax',
+             'property_tax_escalation', 'asset_management_cost', 'asset_management_escalation',
+             'other_asset_management_cost', 'other_asset_management_escalation', 'insurance_cost', 'om_cost',
+             'om_escalation', 'inverter_replacement_cost'],
+    'Tax Equity': ['itc_amount', 'itc_eligible_portion', 'fmv_step_up', 'te_investment', 'buyout_year',
+                   'preferred_return', 'buyout_percentage', 'te_structure', 'te_target_yield', 'pre_flip_cash_share',
+                   'pre_flip_tax_share', 'post_flip_share'],
+}
+ATTRIBUTION_METRICS = ['npv', 'irr']
+
+
+def attribution_value(project_data, field):
+    # Fields missing from older snapshots take their model defaults
+    return project_value(project_data, field) if field in project_data or field in MODEL_FIELD_DEFAULTS else None
+
+
+def field_changed(base, new, field):
+    base_value, new_value = attribution_value(base, field), attribution_value(new, field)
+    if isinstance(base_value, (list, tuple, np.ndarray)) or isinstance(new_value, (list, tuple, np.ndarray)):
+        return not (isinstance(base_value, (list, tuple, np.ndarray)) and isinstance(new_value, (list, tuple, np.ndarray))
+                    and np.array_equal(base_value, new_value))
+    return base_value != new_value
+
+
+def changed_groups(base, new):
+    """
+    Changed fields by attribution group. Changed fields outside ATTRIBUTION_GROUPS (dates,
+    state, tax, debt, discounting) form an 'Other' group, so the groups explain the whole change.
+    """
+    groups = {}
+    for group, fields in ATTRIBUTION_GROUPS.items():
+        changed = [field for field in fields if field_changed(base, new, field)]
+        if changed:
+            groups[group] = changed
+    grouped_fields = {field for fields in ATTRIBUTION_GROUPS.values() for field in fields}
+    other = [field for field in sorted(set(base) | set(new) | set(MODEL_FIELD_DEFAULTS))
+             if field not in grouped_fields and field_changed(base, new, field)]
+    if other:
+        groups['Other'] = other
+    return groups
+
+
+def attribute_change(base, new, method='sequential'):
+    """
+    Attribute the NPV and IRR change from base to new to the changed input groups. Returns the
+    base and new metrics and one contribution row per group; contributions add up to the change.
+    """
+    groups = changed_groups(base, new)
+    names = list(groups)
+    if method == 'sequential':
+        subsets = [frozenset(names[:count]) for count in range(len(names) + 1)]
+    elif method == 'shapley':
+        subsets = [frozenset(subset) for count in range(len(names) + 1) for subset in itertools.combinations(names, count)]
+    else:
+        raise ValueError(f"Unknown attribution method '{method}'")
+
+    projects = [{**base, **{field: attribution_value(new, field) for group in subset for field in groups[group]}}
+                for subset in subsets]
+    outputs, _ = run_model_stages(projects)
+    values = {
+        subset: {metric: outputs['metrics'][metric][row] for metric in ATTRIBUTION_METRICS}
+        for row, subset in enumerate(subsets)
+    }
+
+    rows = []
+    for index, group in enumerate(names):
+        if method == 'sequential':
+            before = frozenset(names[:index])
+            contributions = {metric: values[before | {group}][metric] - values[before][metric] for metric in ATTRIBUTION_METRICS}
+        else:
+            # Each order adds the group to the groups switched before it; weight by how many orders do so
+            contributions = dict.fromkeys(ATTRIBUTION_METRICS, 0.0)
+            for subset in subsets:
+                if group in subset:
+                    continue
+                weight = math.factorial(len(subset)) * math.factorial(len(names) - len(subset) - 1) / math.factorial(len(names))
+                for metric in ATTRIBUTION_METRICS:
+                    contributions[metric] += weight * (values[subset | {group}][metric] - values[subset][metric])
+        rows.append({'group': group, 'fields': ', '.join(groups[group]), **contributions})
+
+    return {
+        'base': values[frozenset()],
+        'new': values[frozenset(names)],
+        'contributions': pd.DataFrame(rows, columns=['group', 'fields', *ATTRIBUTION_METRICS]),
+        'method': method,
+        'scenarios': len(subsets),
+    }
+
+
+# Structuring optimizer
+def pareto_frontier(options_df, x='savings_notional', y='irr'):
+    """
+    Keep the options not dominated on both x and y (higher is better for both).
+    """
+    ordered = options_df.sort_values([y, x], ascending=False)
+    best_x = np.maximum.accumulate(ordered[x].to_numpy())
+    keep = np.r_[True, ordered[x].to_numpy()[1:] > best_x[:-1]]
+    return ordered[keep].reset_index(drop=True)
+
+
+def optimize_structure(task, project_data, ppa_tenors, buyout_years, ppa_escalations, ppa_rates,
+                       min_savings=None, max_payback=None, batch_size=2000):
+    """
+    Evaluate every combination of PPA tenor, buyout year, PPA escalation and PPA rate in batches,
+    drop options that break the customer savings / payback constraints, and return the Pareto
+    frontier of developer IRR against customer savings with a summary of the search.
+    """
+    grid = list(itertools.product(ppa_tenors, buyout_years, ppa_escalations, ppa_rates))
+    base_irr = run_model_stages([project_data])[0]['metrics']['irr'][0]
+    frontier = pd.DataFrame()
+    feasible_count = 0
+
+    for start in range(0, len(grid), batch_size):
+        if task is not None and not report_progress(task, start / len(grid), f'Evaluated {start:,} of {len(grid):,} options'):
+            return None
+        chunk = grid[start:start + batch_size]
+        projects = [
+            {**project_data, 'ppa_tenor': ppa_tenor, 'buyout_year': buyout_year,
+             'ppa_escalation': ppa_escalation, 'ppa_rate': ppa_rate}
+            for ppa_tenor, buyout_year, ppa_escalation, ppa_rate in chunk
+        ]
+        metrics = run_model_stages(projects, irr_guess=base_irr)[0]['metrics']
+        options_df = pd.DataFrame(chunk, columns=['ppa_tenor', 'buyout_year', 'ppa_escalation', 'ppa_rate'])
+        options_df['irr'] = metrics['irr']
+        options_df['npv'] = metrics['npv']
+        options_df['savings_notional'] = metrics['savings_notional']
+        options_df['payback_years'] = metrics['payback_years']
+
+        feasible = np.isfinite(options_df['irr'].to_numpy())
+        if min_savings is not None:
+            feasible &= options_df['savings_notional'].to_numpy() >= min_savings
+        if max_payback is not None:
+            payback_years = options_df['payback_years'].to_numpy()
+            feasible &= (payback_years >= 0) & (payback_years <= max_payback)
+        feasible_count += int(feasible.sum())
+
+        # Prune dominated options as we go so memory stays bounded by the frontier size
+        frontier = pareto_frontier(pd.concat([frontier, options_df[feasible]], ignore_index=True))
+
+    if task is not None:
+        report_progress(task, 1.0, 'Done')
+    return {'frontier': frontier, 'evaluated': len(grid), 'feasible': feasible_count}
+
+
+# Streaming statistics
+# Simulation and portfolio runs are summarised chunk by chunk instead of keeping every draw.
+# Each statistic keeps a running count, mean and sum of squared deviations (merged with Chan's
+# formula) plus a log-bucketed quantile sketch with fixed bucket bounds: values are counted in
+# buckets whose edges grow by STREAM_SKETCH_GAMMA, so any quantile is within
+# STREAM_SKETCH_ACCURACY relative error, memory does not depend on the number of draws, and
+# two sketches merge by adding their bucket counts.
+STREAM_SKETCH_ACCURACY = 0.01
+STREAM_SKETCH_GAMMA = (1 + STREAM_SKETCH_ACCURACY) / (1 - STREAM_SKETCH_ACCURACY)
+STREAM_SKETCH_MIN_VALUE = 1e-9
+STREAM_SKETCH_MAX_VALUE = 1e15
+STREAM_SKETCH_MIN_KEY = int(np.ceil(np.log(STREAM_SKETCH_MIN_VALUE) / np.log(STREAM_SKETCH_GAMMA)))
+STREAM_SKETCH_BUCKETS = int(np.ceil(np.log(STREAM_SKETCH_MAX_VALUE) / np.log(STREAM_SKETCH_GAMMA))) - STREAM_SKETCH_MIN_KEY + 1
+STREAM_METRICS = ['irr', 'npv', 'lcoe']
+
+
+def new_stream_summary(width=1):
+    """
+    Empty running summary for `width` parallel statistics (e.g. one per project year).
+    """
+    return {
+        'count': np.zeros(width, dtype=np.int64),
+        'mean': np.zeros(width),
+        'm2': np.zeros(width),
+        'min': np.full(width, np.inf),
+        'max': np.full(width, -np.inf),
+        'negative': np.zeros((width, STREAM_SKETCH_BUCKETS), dtype=np.int64),
+        'zero': np.zeros(width, dtype=np.int64),
+        'positive': np.zeros((width, STREAM_SKETCH_BUCKETS), dtype=np.int64),
+    }
+
+
+def sketch_bucket(magnitudes):
+    keys = np.ceil(np.log(np.maximum(magnitudes, STREAM_SKETCH_MIN_VALUE)) / np.log(STREAM_SKETCH_GAMMA))
+    return np.clip(keys.astype(np.int64) - STREAM_SKETCH_MIN_KEY, 0, STREAM_SKETCH_BUCKETS - 1)
+
+
+def update_stream_summary(summary, values):
+    """
+    Fold a chunk of values (n draws x width) into the summary in place. NaNs are skipped, so
+    draws without an IRR or years outside a project's life don't count.
+    """
+    values = np.asarray(values, dtype=float).reshape(len(values), -1)
+    valid = ~np.isnan(values)
+    chunk = {
+        'count': valid.sum(axis=0),
+        'mean': np.zeros(values.shape[1]),
+        'm2': np.zeros(values.shape[1]),
+        'min': np.where(valid, values, np.inf).min(axis=0, initial=np.inf),
+        'max': np.where(valid, values, -np.inf).max(axis=0, initial=-np.inf),
+    }
+    has_values = chunk['count'] > 0
+    chunk['mean'][has_values] = np.nansum(values, axis=0)[has_values] / chunk['count'][has_values]
+    chunk['m2'] = np.nansum((values - chunk['mean']) ** 2, axis=0)
+
+    columns = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+    zero = valid & (np.abs(values) < STREAM_SKETCH_MIN_VALUE)
+    chunk['zero'] = zero.sum(axis=0)
+    for side, mask in [('negative', valid & ~zero & (values < 0)), ('positive', valid & ~zero & (values > 0))]:
+        chunk[side] = np.zeros((values.shape[1], STREAM_SKETCH_BUCKETS), dtype=np.int64)
+        np.add.at(chunk[side], (columns[mask], sketch_bucket(np.abs(values[mask]))), 1)
+
+    summary.update(merge_stream_summaries(summary, chunk))
+    return summary
+
+
+def merge_stream_summaries(first, second):
+    """
+    Combine two summaries (e.g. partial results from different workers) into a new one.
+    """
+    count = first['count'] + second['count']
+    delta = second['mean'] - first['mean']
+    weight = np.divide(second['count'], count, out=np.zeros(len(count)), where=count > 0)
+    return {
+        'count': count,
+        'mean': first['mean'] + delta * weight,
+        'm2': first['m2'] + second['m2'] + delta ** 2 * first['count'] * weight,
+        'min': np.minimum(first['min'], second['min']),
+        'max': np.maximum(first['max'], second['max']),
+        'negative': first['negative'] + second['negative'],
+        'zero': first['zero'] + second['zero'],
+        'positive': first['positive'] + second['positive'],
+    }
+
+
+def stream_summary_quantiles(summary, quantiles):
+    """
+    Estimated quantiles from the sketch, shape (len(quantiles), width). NaN where no values.
+    """
+    bucket_values = 2 * STREAM_SKETCH_GAMMA ** (np.arange(STREAM_SKETCH_BUCKETS) + STREAM_SKETCH_MIN_KEY) / (STREAM_SKETCH_GAMMA + 1)
+    # Buckets in ascending order of value: most negative first, then zero, then positive
+    ordered_values = np.concatenate([-bucket_values[::-1], [0.0], bucket_values])
+    ordered_counts = np.concatenate(
+        [summary['negative'][:, ::-1], summary['zero'][:, None], summary['positive']], axis=1
+    )
+    cumulative = np.cumsum(ordered_counts, axis=1)
+
+    estimates = np.full((len(quantiles), len(summary['count'])), np.nan)
+    for column, count in enumerate(summary['count']):
+        if count == 0:
+            continue
+        ranks = np.asarray(quantiles) * (count - 1)
+        buckets = np.searchsorted(cumulative[column], ranks, side='right')
+        estimates[:, column] = np.clip(ordered_values[buckets], summary['min'][column], summary['max'][column])
+    return estimates
+
+
+def new_stream_stats(n_years=MAX_PROJECT_YEARS):
+    """
+    Empty streaming statistics for the headline metrics and the per-year cash flows.
+    """
+    stats = {metric: new_stream_summary() for metric in STREAM_METRICS}
+    stats['cash_flows'] = new_stream_summary(n_years)
+    return stats
+
+
+def update_stream_stats(stats, outputs):
+    """
+    Fold one chunk of run_model_stages outputs into the streaming statistics in place.
+    """
+    for metric in STREAM_METRICS:
+        update_stream_summary(stats[metric], outputs['metrics'][metric][:, None])
+    cash_flows = np.where(outputs['production']['active'], outputs['flip']['cash_flows'], np.nan)
+    n_years = len(stats['cash_flows']['count'])
+    padded = np.full((len(cash_flows), n_years), np.nan)
+    padded[:, :cash_flows.shape[1]] = cash_flows[:, :n_years]
+    update_stream_summary(stats['cash_flows'], padded)
+    return stats
+
+
+def merge_stream_stats(first, second):
+    return {name: merge_stream_summaries(first[name], second[name]) for name in first}
+
+
+def stream_model_stats(project_chunks, stats=None):
+    """
+    Run the model over an iterable of project_data lists (chunks) and return the streaming
+    statistics. Only one chunk of model outputs is held in memory at a time.
+    """
+    stats = new_stream_stats() if stats is None else stats
+    for projects in project_chunks:
+        update_stream_stats(stats, run_model_stages(projects)[0])
+    return stats
+
+
+def stream_stats_table(summary, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+    """
+    Count, mean, standard deviation, min/max and quantiles of a summary, one row per column.
+    """
+    table = pd.DataFrame({
+        'count': summary['count'],
+        'mean': np.where(summary['count'] > 0, summary['mean'], np.nan),
+        'std': np.sqrt(np.divide(summary['m2'], summary['count'] - 1, out=np.full(len(summary['count']), np.nan),
+                                 where=summary['count'] > 1)),
+        'min': np.where(summary['count'] > 0, summary['min'], np.nan),
+        'max': np.where(summary['count'] > 0, summary['max'], np.nan),
+    })
+    for quantile, estimate in zip(quantiles, stream_summary_quantiles(summary, quantiles)):
+        table[f'p{quantile * 100:g}'] = estimate
+    return table
+
+
+# Stochastic merchant prices
+# Post-PPA merchant prices are simulated as the state curve times a lognormal shock. Log shocks
+# follow a mean-reverting AR(1) process from the first path year, x_t = phi * x_(t-1) + sigma * e_t
+# with phi = exp(-mean_reversion), and the innovations e_t are correlated across states. Each
+# price is scaled by exp(x_t - var(x_t) / 2) so the expected price in every year is the curve.
+MERCHANT_PATH_FIRST_YEAR = int(MERCHANT_PRICE_FIRST_YEARS.min())
+MERCHANT_PATH_YEARS = int(MERCHANT_PRICE_LENGTHS.max()) + MAX_PROJECT_YEARS
+MERCHANT_PATH_VOLATILITY = 0.15
+MERCHANT_PATH_MEAN_REVERSION = 0.5
+MERCHANT_PATH_STATE_CORRELATION = 0.7
+
+
+def merchant_price_rngs(seed, n_streams):
+    """
+    Independent, reproducible random generators (e.g. one per worker or per chunk of paths).
+    """
+    return [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(n_streams)]
+
+
+def generate_merchant_price_paths(rng, n_paths, volatility=MERCHANT_PATH_VOLATILITY,
+                                  mean_reversion=MERCHANT_PATH_MEAN_REVERSION,
+                                  state_correlation=MERCHANT_PATH_STATE_CORRELATION,
+                                  n_years=MERCHANT_PATH_YEARS):
+    """
+    Simulated merchant prices, shape (paths x states x calendar years) with states in
+    MERCHANT_PRICE_STATES order and years starting at MERCHANT_PATH_FIRST_YEAR.
+    """
+    n_states = len(MERCHANT_PRICE_STATES)
+    correlation = np.full((n_states, n_states), state_correlation)
+    np.fill_diagonal(correlation, 1.0)
+    innovations = rng.standard_normal((n_paths, n_years, n_states)) @ np.linalg.cholesky(correlation).T
+
+    phi = np.exp(-mean_reversion)
+    shocks = np.empty((n_paths, n_states, n_years))
+    shocks[:, :, 0] = volatility * innovations[:, 0]
+    for year in range(1, n_years):
+        shocks[:, :, year] = phi * shocks[:, :, year - 1] + volatility * innovations[:, year]
+    variance = volatility ** 2 * np.cumsum(phi ** (2 * np.arange(n_years)))
+
+    calendar_years = MERCHANT_PATH_FIRST_YEAR + np.arange(n_years)
+    mean_prices = merchant_price_lookup(np.arange(n_states)[:, None], calendar_years[None, :])
+    return mean_prices * np.exp(shocks - variance / 2)
+
+
+def merchant_prices_for_projects(price_paths, projects, path_index):
+    """
+    Pick each project's state row out of its simulated path, in the form run_model_stages takes.
+    """
+    state_index = [MERCHANT_PRICE_STATE_INDEX[project['state']] for project in projects]
+    return {'first_year': MERCHANT_PATH_FIRST_YEAR, 'prices': price_paths[path_index, state_index]}
+
+
+def simulate_merchant_risk(task, project_data, n_paths=10000, seed=0, volatility=MERCHANT_PATH_VOLATILITY,
+                           mean_reversion=MERCHANT_PATH_MEAN_REVERSION,
+                           state_correlation=MERCHANT_PATH_STATE_CORRELATION, chunk_size=2000):
+    """
+    Monte Carlo of the project over simulated merchant price paths. Paths are generated and
+    evaluated one chunk at a time, each chunk from its own seeded stream, and summarised with
+    streaming statistics.
+    """
+    stats = new_stream_stats()
+    chunk_starts = range(0, n_paths, chunk_size)
+    base_irr = run_model_stages([project_data])[0]['metrics']['irr'][0]
+    for chunk, (start, rng) in enumerate(zip(chunk_starts, merchant_price_rngs(seed, len(chunk_starts)))):
+        if not report_progress(task, start / n_paths, f'Simulated {start:,} of {n_paths:,} price paths'):
+            return None
+        n_chunk = min(chunk_size, n_paths - start)
+        price_paths = generate_merchant_price_paths(rng, n_chunk, volatility, mean_reversion, state_correlation)
+        projects = [project_data] * n_chunk
+        merchant_prices = merchant_prices_for_projects(price_paths, projects, np.arange(n_chunk))
+        update_stream_stats(stats, run_model_stages(projects, irr_guess=base_irr, merchant_prices=merchant_prices)[0])
+    report_progress(task, 1.0, 'Done')
+    return {'stats': stats, 'construction_start': project_data['construction_start'].year}
+
+
+# What-if surrogate
+# For instant previews, IRR, NPV and LCOE are interpolated from a sparse Latin hypercube design
+# over the project's most sensitive inputs. Each output is a cubic radial basis function
+# interpolant with a linear tail, fitted on inputs scaled to the sampled box. Error bounds are
+# leave-one-out errors, which for RBF interpolants come from one matrix inverse (Rippa's formula).
+SURROGATE_OUTPUTS = ['irr', 'npv', 'lcoe']
+SURROGATE_MAX_INPUTS = 8
+SURROGATE_SWING = 0.20
+SURROGATE_POINTS_PER_INPUT = 40
+
+
+def surrogate_basis(points, centres):
+    distances = np.sqrt(((points[:, None, :] - centres[None, :, :]) ** 2).sum(axis=2))
+    return np.hstack([distances ** 3, np.ones((len(points), 1)), points])
+
+
+def build_surrogate(task, project_data, n_inputs=SURROGATE_MAX_INPUTS, swing=SURROGATE_SWING,
+                    points_per_input=SURROGATE_POINTS_PER_INPUT, seed=0):
+    """
+    Fit the surrogate around project_data over the n_inputs inputs with the largest NPV
+    elasticity, each sampled within +/- swing of its current value and its valid range.
+    """
+    report_progress(task, 0.0, 'Ranking inputs')
+    sensitivity_df = calculate_sensitivities(project_data)
+    sensitivity_df['elasticity'] = (sensitivity_df['dNPV/dInput'] * sensitivity_df['Value']).abs()
+    ranked = sensitivity_df[sensitivity_df['Value'] != 0].sort_values('elasticity', ascending=False)
+    fields = list(ranked['Input'][:n_inputs])
+    values = np.array([project_data[field] for field in fields], dtype=float)
+    # The swing is clipped to each input's valid range (fractions stay within 0-1)
+    bounds = np.array([field_bounds(field) for field in fields], dtype=float).reshape(-1, 2)
+    lower = np.maximum(values - swing * np.abs(values), bounds[:, 0])
+    upper = np.minimum(values + swing * np.abs(values), bounds[:, 1])
+
+    # Latin hypercube: one point per stratum of every input, strata shuffled independently
+    rng = np.random.default_rng(seed)
+    n_points = points_per_input * len(fields)
+    strata = np.argsort(rng.random((n_points, len(fields))), axis=0)
+    points = np.vstack([np.full(len(fields), 0.5), (strata + rng.random((n_points, len(fields)))) / n_points])
+    projects = [
+        {**project_data, **{field: float(value) for field, value in zip(fields, lower + point * (upper - lower))}}
+        for point in points
+    ]
+    if not report_progress(task, 0.2, f'Evaluating {len(projects):,} design points'):
+        return None
+    metrics = run_model_stages(projects)[0]['metrics']
+    targets = np.column_stack([metrics[output] for output in SURROGATE_OUTPUTS])
+    valid = np.isfinite(targets).all(axis=1)
+    points, targets = points[valid], targets[valid]
+
+    if not report_progress(task, 0.8, 'Fitting interpolants'):
+        return None
+    system = surrogate_basis(points, points)
+    polynomial = system[:, len(points):]
+    system = np.block([[system], [polynomial.T, np.zeros((polynomial.shape[1], polynomial.shape[1]))]])
+    inverse = np.linalg.pinv(system)
+    weights = inverse @ np.vstack([targets, np.zeros((polynomial.shape[1], targets.shape[1]))])
+    loo_errors = weights[:len(points)] / np.diag(inverse)[:len(points), None]
+
+    report_progress(task, 1.0, 'Done')
+    return {
+        'base_key': hash_project_data({**project_data, **{field: None for field in fields}}),
+        'fields': fields,
+        'lower': lower,
+        'upper': upper,
+        'points': points,
+        'weights': weights,
+        'errors': {
+            output: {'rms': float(np.sqrt(np.mean(loo_errors[:, column] ** 2))),
+                     'max': float(np.abs(loo_errors[:, column]).max())}
+            for column, output in enumerate(SURROGATE_OUTPUTS)
+        },
+    }
+
+
+def predict_surrogate(surrogate, project_data):
+    """
+    Interpolated metrics for project_data, or None if it differs from the surrogate's project
+    outside the sampled inputs or an input has left the sampled range.
+    """
+    if hash_project_data({**project_data, **{field: None for field in surrogate['fields']}}) != surrogate['base_key']:
+        return None
+    values = np.array([project_data[field] for field in surrogate['fields']], dtype=float)
+    if np.any(values < surrogate['lower']) or np.any(values > surrogate['upper']):
+        return None
+    point = (values - surrogate['lower']) / (surrogate['upper'] - surrogate['lower'])
+    prediction = surrogate_basis(point[None, :], surrogate['points']) @ surrogate['weights']
+    return dict(zip(SURROGATE_OUTPUTS, prediction[0]))
+
+
+def preview_metrics(surrogate, project_data):
+    """
+    IRR, NPV and LCOE from the surrogate when it covers project_data, otherwise from the full model.
+    """
+    metrics = predict_surrogate(surrogate, project_data) if surrogate is not None else None
+    if metrics is not None:
+        return {**metrics, 'source': 'surrogate', 'errors': surrogate['errors']}
+    full_metrics = run_model_stages([project_data])[0]['metrics']
+    return {**{output: full_metrics[output][0] for output in SURROGATE_OUTPUTS}, 'source': 'model', 'errors': None}
+
+
+# Scenario store (SQLite)
+SCENARIO_DB_PATH = os.environ.get('SCENARIO_DB_PATH', 'scenarios.db')
+
+SCENARIO_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenarios (
+    scenario_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    state TEXT NOT NULL,
+    project_size_dc REAL NOT NULL,
+    irr REAL,
+    npv REAL,
+    created_at TEXT NOT NULL,
+    inputs TEXT NOT NULL,
+    metrics TEXT NOT NULL,
+    carbon_offsets TEXT NOT NULL,
+    cash_flows BLOB NOT NULL,
+    annual_table BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_scenarios_state_size ON scenarios (state, project_size_dc);
+CREATE INDEX IF NOT EXISTS idx_scenarios_state_irr ON scenarios (state, irr);
+CREATE INDEX IF NOT EXISTS idx_scenarios_size ON scenarios (project_size_dc);
+CREATE INDEX IF NOT EXISTS idx_scenarios_irr ON scenarios (irr);
+"""
+
+def encode_project_data(project_data):
+    """
+    Convert project_data into JSON-safe values. Dates are tagged so they can be restored.
+    """
+    encoded = {}
+    for key, value in project_data.items():
+        if isinstance(value, date):
+            encoded[key] = {'__date__': value.isoformat()}
+        elif isinstance(value, np.generic):
+            encoded[key] = value.item()
+        else:
+            encoded[key] = value
+    return encoded
+
+
+def decode_project_data(encoded):
+    project_data = {}
+    for key, value in encoded.items():
+        if isinstance(value, dict) and '__date__' in value:
+            project_data[key] = date.fromisoformat(value['__date__'][:10])
+        else:
+            project_data[key] = value
+    return project_data
+
+
+def hash_project_data(project_data):
+    """
+    Content hash of a project_data snapshot. Identical inputs always give the same hash.
+    """
+    payload = json.dumps(encode_project_data(project_data), sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def annual_table_to_blob(revenue_df):
+    """
+    Pack the annual table into compressed NumPy arrays. Numeric columns are stored as one float
+    matrix; the Total row is not stored and is rebuilt on load.
+    """
+    body = revenue_df[revenue_df['Year'] != 'Total']
+    numeric_columns = [column for column in body.columns if column not in ('Year', 'Revenue Type')]
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer,
+        columns=np.array(body.columns, dtype=str),
+        year=body['Year'].to_numpy(dtype=np.int32),
+        revenue_type=body['Revenue Type'].to_numpy(dtype=str),
+        values=body[numeric_columns].to_numpy(dtype=np.float64)
+    )
+    return buffer.getvalue()
+
+
+def annual_table_from_blob(blob):
+    with np.load(io.BytesIO(blob)) as arrays:
+        data = {}
+        numeric_index = 0
+        for column in arrays['columns']:
+            if column == 'Year':
+                data[column] = arrays['year'].astype(int)
+            elif column == 'Revenue Type':
+                data[column] = arrays['revenue_type'].astype(object)
+            else:
+                data[column] = arrays['values'][:, numeric_index]
+                numeric_index += 1
+    return append_totals_row(pd.DataFrame(data))
+
+
+def array_to_blob(values):
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(values, dtype=np.float64), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def array_from_blob(blob):
+    return np.load(io.BytesIO(blob), allow_pickle=False)
+
+
+def encode_results(results):
+    """
+    Encode a results dict as (metrics JSON, carbon offsets JSON, cash flow blob, annual table blob).
+    """
+    return (
+        json.dumps(results['metrics']),
+        json.dumps(results['carbon_offsets']),
+        array_to_blob(results['cash_flows']),
+        annual_table_to_blob(results['revenue_df']),
+    )
+
+
+def decode_results(metrics, carbon_offsets, cash_flows, annual_table):
+    return {
+        'cash_flows': array_from_blob(cash_flows),
+        'revenue_df': annual_table_from_blob(annual_table),
+        'metrics': json.loads(metrics),
+        'carbon_offsets': json.loads(carbon_offsets),
+    }
+
+
+def connect_scenario_store(db_path=SCENARIO_DB_PATH):
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.executescript(SCENARIO_SCHEMA)
+    return conn
+
+
+def scenario_exists(scenario_id, db_path=SCENARIO_DB_PATH):
+    with closing(connect_scenario_store(db_path)) as conn:
+        row = conn.execute('SELECT 1 FROM scenarios WHERE scenario_id = ?', (scenario_id,)).fetchone()
+    return row is not None
+
+
+def save_scenario(project_data, results, name='', db_path=SCENARIO_DB_PATH):
+    """
+    Save a project_data snapshot and its computed results under the snapshot's content hash.
+    Saving the same inputs again only renames the existing scenario.
+    """
+    scenario_id = hash_project_data(project_data)
+    metrics = results['metrics']
+    row = (
+        scenario_id,
+        name or f"{project_data['state']} {project_data['project_size_dc']:g} MW-dc",
+        project_data['state'],
+        float(project_data['project_size_dc']),
+        metrics['irr'],
+        metrics['npv'],
+        datetime.now().isoformat(timespec='seconds'),
+        json.dumps(encode_project_data(project_data), sort_keys=True),
+        *encode_results(results),
+    )
+    with closing(connect_scenario_store(db_path)) as conn, conn:
+        conn.execute(
+            """
+            INSERT INTO scenarios (scenario_id, name, state, project_size_dc, irr, npv, created_at,
+                                   inputs, metrics, carbon_offsets, cash_flows, annual_table)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (scenario_id) DO UPDATE SET name = excluded.name
+            """,
+            row
+        )
+    return scenario_id
+
+
+def load_scenario(scenario_id, db_path=SCENARIO_DB_PATH):
+    """
+    Load a saved scenario's inputs and results without recomputing the model.
+    """
+    with closing(connect_scenario_store(db_path)) as conn:
+        row = conn.execute(
+            """
+            SELECT name, inputs, metrics, carbon_offsets, cash_flows, annual_table
+            FROM scenarios WHERE scenario_id = ?
+            """,
+            (scenario_id,)
+        ).fetchone()
+    if row is None:
+        raise KeyError(f"Scenario {scenario_id} not found")
+    name, inputs = row[:2]
+    return {
+        'scenario_id': scenario_id,
+        'name': name,
+        'project_data': decode_project_data(json.loads(inputs)),
+        'results': decode_results(*row[2:]),
+    }
+
+
+def list_scenarios(state=None, min_size=None, max_size=None, min_irr=None, max_irr=None,
+                   limit=500, db_path=SCENARIO_DB_PATH):
+    """
+    List saved scenarios (summary columns only), best IRR first.
+    """
+    clauses = []
+    params = []
+    for column, operator, value in [
+        ('state', '=', state),
+        ('project_size_dc', '>=', min_size),
+        ('project_size_dc', '<=', max_size),
+        ('irr', '>=', min_irr),
+        ('irr', '<=', max_irr),
+    ]:
+        if value is not None:
+            clauses.append(f'{column} {operator} ?')
+            params.append(value)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    query = f"""
+        SELECT scenario_id, name, state, project_size_dc, irr, npv, created_at
+        FROM scenarios {where}
+        ORDER BY irr DESC
+        LIMIT ?
+    """
+    with closing(connect_scenario_store(db_path)) as conn:
+        return pd.read_sql_query(query, conn, params=params + [limit])
+
+
+def delete_scenario(scenario_id, db_path=SCENARIO_DB_PATH):
+    with closing(connect_scenario_store(db_path)) as conn, conn:
+        conn.execute('DELETE FROM scenarios WHERE scenario_id = ?', (scenario_id,))
+
+
+# Result cache (SQLite, shared by every app replica and batch worker on this machine)
+# Each entry is one project's row of the stage outputs that results pages and batch writers read:
+# the annual arrays over the project's life plus its per-project values, as one float64 blob.
+# Hits and fresh rows stack back into run_model_stages-shaped outputs, so a batch chunk reads the
+# cache and evaluates only its misses without building a results dict per project.
+# Bump MODEL_VERSION whenever a calculation change would alter results for the same inputs.
+MODEL_VERSION = '7'
+RESULT_CACHE_PATH = os.environ.get('RESULT_CACHE_PATH', 'result_cache.db')
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+CACHED_ANNUAL_OUTPUTS = [
+    ('production', 'production', float), ('price', 'is_ppa', bool), ('price', 'energy_price', float),
+    ('price', 'rec_price', float), ('price', 'avoided_price', float), ('revenue', 'revenue', float),
+    ('revenue', 'savings', float), ('opex', 'opex', float), ('cash_flow', 'ebitda', float),
+    ('tax', 'depreciation', float), ('tax', 'taxes', float), ('flip', 'investor_cash', float),
+    ('flip', 'cash_flows', float), ('debt', 'debt_service', float), ('debt', 'levered_cash_flows', float),
+    ('emissions', 'co2_avoided', float),
+]
+CACHED_PROJECT_OUTPUTS = [
+    ('cash_flow', 'remaining_itc_cash_flows', float), ('metrics', 'irr', float), ('metrics', 'irr_iterations', int),
+    ('metrics', 'levered_irr', float), ('metrics', 'debt_size', float), ('metrics', 'leverage', float),
+    ('metrics', 'debt_service_years', int), ('metrics', 'npv', float), ('metrics', 'lcoe', float),
+    ('metrics', 'saved_npv', float), ('metrics', 'unlevered_capex', float), ('metrics', 'flip_year', int),
+    ('metrics', 'total_revenue', float), ('metrics', 'total_ebitda', float), ('metrics', 'total_taxes', float),
+    ('metrics', 'savings_notional', float), ('metrics', 'payback_years', int),
+    ('metrics', 'discounted_payback_years', int),
+]
+
+RESULT_CACHE_SCHEMA = """
+DROP TABLE IF EXISTS results;
+CREATE TABLE IF NOT EXISTS model_outputs (
+    cache_key TEXT PRIMARY KEY,
+    total_years INTEGER NOT NULL,
+    outputs BLOB NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_model_outputs_last_access ON model_outputs (last_access);
+"""
+
+
+def connect_result_cache(cache_path=RESULT_CACHE_PATH):
+    # WAL lets readers in other processes keep reading while one process writes
+    conn = sqlite3.connect(cache_path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(RESULT_CACHE_SCHEMA)
+    return conn
+
+
+def result_cache_key(project_data):
+    return hashlib.sha256(f"{MODEL_VERSION}:{hash_project_data(project_data)}".encode('utf-8')).hexdigest()
+
+
+def output_rows(outputs):
+    """
+    Split run_model_stages outputs into one (total_years, annual values, project values) row
+    per project, with the annual values cut to the project's life.
+    """
+    total_years = outputs['production']['total_years'][:, 0]
+    annual = np.stack([outputs[stage][key] for stage, key, _ in CACHED_ANNUAL_OUTPUTS], axis=1).astype(float)
+    project = np.column_stack([
+        np.asarray(outputs[stage][key], dtype=float).reshape(len(total_years)) for stage, key, _ in CACHED_PROJECT_OUTPUTS
+    ])
+    return [(int(years), annual[row, :, :years], project[row]) for row, years in enumerate(total_years)]
+
+
+def stack_output_rows(rows):
+    """
+    Outputs shaped like run_model_stages' (restricted to the cached arrays) for a list of rows.
+    """
+    n_years = max(row[0] for row in rows)
+    years = np.arange(n_years)
+    total_years = np.array([[row[0]] for row in rows])
+    annual = np.zeros((len(CACHED_ANNUAL_OUTPUTS), len(rows), n_years))
+    project = np.empty((len(rows), len(CACHED_PROJECT_OUTPUTS)))
+    for index, (row_years, row_annual, row_project) in enumerate(rows):
+        annual[:, index, :row_years] = row_annual
+        project[index] = row_project
+    outputs = {'production': {'years': years, 'total_years': total_years, 'active': years < total_years}}
+    for index, (stage, key, dtype) in enumerate(CACHED_ANNUAL_OUTPUTS):
+        outputs.setdefault(stage, {})[key] = annual[index].astype(dtype)
+    for index, (stage, key, dtype) in enumerate(CACHED_PROJECT_OUTPUTS):
+        values = project[:, index].astype(dtype)
+        outputs.setdefault(stage, {})[key] = values if stage == 'metrics' else values[:, None]
+    return outputs
+
+
+def get_cached_outputs_batch(projects, cache_path=RESULT_CACHE_PATH):
+    """
+    Look up output rows for several projects at once. Returns a list with a row, or None on a
+    miss, for each project. Hits are marked as recently used.
+    """
+    keys = [result_cache_key(project_data) for project_data in projects]
+    found = {}
+    with closing(connect_result_cache(cache_path)) as conn, conn:
+        # Stay well below SQLite's limit on query parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = conn.execute(
+                f"SELECT cache_key, total_years, outputs FROM model_outputs WHERE cache_key IN ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall()
+            for cache_key, total_years, blob in rows:
+                values = np.frombuffer(blob, dtype=np.float64)
+                split = len(CACHED_ANNUAL_OUTPUTS) * total_years
+                found[cache_key] = (total_years, values[:split].reshape(-1, total_years), values[split:])
+        if found:
+            now = time.time()
+            conn.executemany('UPDATE model_outputs SET last_access = ? WHERE cache_key = ?', [(now, key) for key in found])
+    return [found.get(key) for key in keys]
+
+
+def put_cached_outputs_batch(projects, rows, cache_path=RESULT_CACHE_PATH, max_bytes=RESULT_CACHE_MAX_BYTES):
+    """
+    Store output rows for several projects, then evict least recently used entries until the
+    cache is back under max_bytes.
+    """
+    now = time.time()
+    records = []
+    for project_data, (total_years, annual, project) in zip(projects, rows):
+        blob = np.concatenate([annual.ravel(), project]).astype(np.float64).tobytes()
+        records.append((result_cache_key(project_data), total_years, blob, len(blob), now))
+
+    with closing(connect_result_cache(cache_path)) as conn, conn:
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO model_outputs (cache_key, total_years, outputs, size_bytes, last_access)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            records
+        )
+        total_bytes = conn.execute('SELECT COALESCE(SUM(size_bytes), 0) FROM model_outputs').fetchone()[0]
+        if total_bytes > max_bytes:
+            evicted_keys = []
+            for cache_key, size_bytes in conn.execute('SELECT cache_key, size_bytes FROM model_outputs ORDER BY last_access'):
+                if total_bytes <= max_bytes:
+                    break
+                evicted_keys.append((cache_key,))
+                total_bytes -= size_bytes
+            conn.executemany('DELETE FROM model_outputs WHERE cache_key = ?', evicted_keys)
+
+
+def get_cached_results(project_data, cache_path=RESULT_CACHE_PATH):
+    """
+    The results dict of one project from the cache, or None on a miss.
+    """
+    row = get_cached_outputs_batch([project_data], cache_path)[0]
+    if row is None:
+        return None
+    return results_from_stages(project_data, stack_output_rows([row]))
+
+
+def evaluate_project_cached(project_data, stage_cache=None, irr_guess=None, cache_path=RESULT_CACHE_PATH):
+    """
+    evaluate_project() behind the shared result cache.
+    """
+    results = get_cached_results(project_data, cache_path)
+    if results is not None:
+        results['from_cache'] = True
+        return results
+    outputs, stage_report = run_model_stages([project_data], stage_cache, irr_guess=irr_guess)
+    put_cached_outputs_batch([project_data], output_rows(outputs), cache_path)
+    return project_results(project_data, outputs, stage_report, irr_guess)
+
+
+def evaluate_batch(projects, cache_path=RESULT_CACHE_PATH):
+    """
+    Outputs for many projects, shaped like run_model_stages' (restricted to the cached arrays):
+    cached rows are read first and the model stages run once over all of the misses. With
+    cache_path None the stages run over every project and nothing is stored.
+    """
+    if cache_path is None:
+        return stack_output_rows(output_rows(run_model_stages(projects)[0]))
+    rows = get_cached_outputs_batch(projects, cache_path)
+    missing = [index for index, row in enumerate(rows) if row is None]
+    if missing:
+        missing_projects = [projects[index] for index in missing]
+        computed = output_rows(run_model_stages(missing_projects)[0])
+        put_cached_outputs_batch(missing_projects, computed, cache_path)
+        for index, row in zip(missing, computed):
+            rows[index] = row
+    return stack_output_rows(rows)
+
+
+# Excel export
+# Workbooks are written with openpyxl's write-only mode, which streams rows to disk (or a
+# buffer) as they are appended, so memory stays flat however many portfolio rows there are.
+PORTFOLIO_METRICS = ['irr', 'levered_irr', 'npv', 'lcoe', 'saved_npv', 'unlevered_capex', 'total_revenue',
+                     'total_ebitda', 'total_taxes', 'savings_notional', 'debt_size', 'leverage', 'debt_service_years',
+                     'payback_years', 'discounted_payback_years', 'flip_year']
+
+
+def excel_value(value):
+    # Cells take plain numbers, text and dates; NaN/inf become empty cells
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float(value) if np.isfinite(value) else None
+    if value is None or isinstance(value, (str, date)):
+        return value
+    return str(value)
+
+
+def append_dataframe(sheet, df):
+    sheet.append(list(df.columns))
+    for row in df.itertuples(index=False):
+        sheet.append([excel_value(value) for value in row])
+
+
+def portfolio_rows(projects, chunk_size=1000, cache_path=RESULT_CACHE_PATH):
+    """
+    Inputs and metrics of each project, evaluated a chunk at a time through the result cache.
+    Yields one dict per project.
+    """
+    projects = iter(projects)
+    while True:
+        chunk = list(itertools.islice(projects, chunk_size))
+        if not chunk:
+            return
+        metrics = evaluate_batch(chunk, cache_path)['metrics']
+        for row, project_data in enumerate(chunk):
+            yield {**project_data, **{metric: metrics[metric][row] for metric in PORTFOLIO_METRICS}}
+
+
+def write_workbook(output, project_data=None, results=None, sensitivity_tables=None, portfolio=None):
+    """
+    Write an .xlsx to output (path or binary file object) with any of: the project inputs, the
+    annual table, the metrics, sensitivity tables ({sheet name: DataFrame}) and portfolio rows
+    (an iterable of dicts with the same keys, e.g. from portfolio_rows). Returns output.
+    """
+    workbook = Workbook(write_only=True)
+    if project_data is not None:
+        sheet = workbook.create_sheet('Inputs')
+        sheet.append(['Input', 'Value'])
+        for field, value in {**MODEL_FIELD_DEFAULTS, **project_data}.items():
+            sheet.append([field, excel_value(value)])
+    if results is not None:
+        append_dataframe(workbook.create_sheet('Annual'), results['revenue_df'])
+        sheet = workbook.create_sheet('Metrics')
+        sheet.append(['Metric', 'Value'])
+        for metric, value in {**results['metrics'], **results['carbon_offsets']}.items():
+            sheet.append([metric, excel_value(value)])
+    for name, table in (sensitivity_tables or {}).items():
+        append_dataframe(workbook.create_sheet(name[:31]), table)
+    if portfolio is not None:
+        sheet = workbook.create_sheet('Portfolio')
+        columns = None
+        for row in portfolio:
+            if columns is None:
+                columns = list(row)
+                sheet.append(columns)
+            sheet.append([excel_value(row.get(column)) for column in columns])
+    if not workbook.worksheets:
+        workbook.create_sheet('Inputs')
+    workbook.save(output)
+    return output
+
+
+def export_portfolio_workbook(projects, output, chunk_size=1000):
+    """
+    Batch export: one Portfolio row (inputs and metrics) per project, streamed to output.
+    """
+    return write_workbook(output, portfolio=portfolio_rows(projects, chunk_size))
+
+
+# Excel import
+# Legacy pro-formas are read with openpyxl's read-only mode, either from workbook-level named
+# cells called after project_data fields (one project per workbook) or from a tabular sheet with
+# one project per row and field names or labels (e.g. "PPA Rate", "REC Price Years 1-5") as
+# headers. Fields missing from the workbook take the values of a base project (the sidebar
+# inputs in the app). Every problem found is reported, not just the first.
+RENT_OPTIONS = ['Flat Lease/Year', '$/Acre + Escalation', '$/MW-ac + Escalation']
+TE_STRUCTURES = ['Fixed Buyout', 'Partnership Flip']
+FRACTION_FIELDS = [
+    'degradation_rate', 'ppa_escalation', 'om_escalation', 'asset_management_escalation', 'property_tax_escalation',
+    'rent_escalation', 'itc_amount', 'itc_eligible_portion', 'preferred_return', 'buyout_percentage',
+    'te_target_yield', 'pre_flip_cash_share', 'pre_flip_tax_share', 'post_flip_share', 'tax_rate',
+    'bonus_depreciation', 'debt_rate', 'avoided_cost_escalation', 'other_asset_management_escalation', 'discount_rate',
+]
+INTEGER_FIELDS = {
+    'ppa_tenor': (1, 40), 'post_ppa_tenor': (0, 40), 'buyout_year': (1, 40), 'degradation_start_year': (0, 60),
+    'ppa_escalation_start_year': (1, 60), 'debt_tenor': (1, 40),
+}
+NUMBER_FIELDS = [
+    'project_size_dc', 'project_size_ac', 'epc_cost', 'developer_fee', 'site_acres', 'construction_rent',
+    'operating_rent', 'production_yield', 'ppa_rate', 'om_cost', 'asset_management_cost', 'insurance_cost',
+    'property_tax', 'inverter_replacement_cost', 'interconnection_cost', 'transaction_costs', 'fmv_step_up',
+    'te_investment', 'target_dscr', 'avoided_cost_ppa_price', 'other_asset_management_cost',
+    'rec_price_years_1_5', 'rec_price_years_6_10', 'rec_price_years_11_15', 'incentive_amount',
+]
+IMPORT_FIELDS = {
+    **{field: ('fraction', None) for field in FRACTION_FIELDS},
+    **{field: ('integer', bounds) for field, bounds in INTEGER_FIELDS.items()},
+    **{field: ('number', None) for field in NUMBER_FIELDS},
+    'cod_date': ('date', None),
+    'construction_start': ('date', None),
+    'after_tax': ('bool', None),
+    'include_debt': ('bool', None),
+    'state': ('choice', MERCHANT_PRICE_STATES),
+    'rent_option': ('choice', RENT_OPTIONS),
+    'te_structure': ('choice', TE_STRUCTURES),
+    'discount_curve': ('text', None),
+    'grid_region': ('text', None),
+}
+def field_bounds(field):
+    """
+    Valid (lower, upper) range of a numeric project_data field, as enforced on import.
+    """
+    kind, spec = IMPORT_FIELDS.get(field, (None, None))
+    if kind == 'fraction':
+        return 0.0, 1.0
+    if kind == 'integer':
+        return spec
+    if kind == 'number' and field != 'incentive_amount':
+        return 0.0, np.inf
+    return -np.inf, np.inf
+
+
+IMPORT_ALIASES = {
+    'rent_calculation_method': 'rent_option',
+    'select_state': 'state',
+    'cod': 'cod_date',
+    'project_size_mw_dc': 'project_size_dc',
+    'project_size_mw_ac': 'project_size_ac',
+    'tax_equity_structure': 'te_structure',
+}
+IMPORT_NAME_COLUMNS = {'name', 'project', 'project_name'}
+
+
+def import_field_name(label):
+    key = re.sub(r'[^0-9a-z]+', '_', str(label).lower()).strip('_')
+    return IMPORT_ALIASES.get(key, key)
+
+
+def parse_import_value(field, value):
+    """
+    Convert a cell value to the project_data type of field. Raises ValueError with a message.
+    """
+    kind, spec = IMPORT_FIELDS[field]
+    if kind == 'text':
+        if isinstance(value, (list, tuple)):
+            return list(value)
+        return None if value is None or value == '' else str(value)
+    if value is None or value == '' or (isinstance(value, float) and np.isnan(value)):
+        raise ValueError('is empty')
+    if kind == 'date':
+        if isinstance(value, datetime):
+            return value.date()
+        if isinstance(value, date):
+            return value
+        return datetime.strptime(str(value).strip(), '%Y-%m-%d').date()
+    if kind == 'bool':
+        if isinstance(value, str) and value.strip().lower() in ('yes', 'true', 'y', '1', 'no', 'false', 'n', '0'):
+            return value.strip().lower() in ('yes', 'true', 'y', '1')
+        if isinstance(value, (bool, int, float)):
+            return bool(value)
+        raise ValueError(f"'{value}' is not yes/no")
+    if kind == 'choice':
+        matches = [choice for choice in spec if choice.lower() == str(value).strip().lower()]
+        if not matches:
+            raise ValueError(f"'{value}' is not one of {', '.join(spec)}")
+        return matches[0]
+
+    try:
+        number = float(str(value).strip().rstrip('%')) / (100 if str(value).strip().endswith('%') else 1)
+    except ValueError:
+        raise ValueError(f"'{value}' is not a number")
+    if not np.isfinite(number):
+        raise ValueError('is not finite')
+    if kind == 'integer':
+        if number != int(number):
+            raise ValueError(f'{number:g} is not a whole number')
+        if not spec[0] <= number <= spec[1]:
+            raise ValueError(f'{number:g} is outside {spec[0]}-{spec[1]}')
+        return int(number)
+    if kind == 'fraction' and not 0 <= number <= 1:
+        raise ValueError(f'{number:g} is not a fraction between 0 and 1 (enter 2% as 0.02)')
+    if field != 'incentive_amount' and number < 0:
+        raise ValueError(f'{number:g} is negative')
+    return number
+
+
+def build_imported_project(values, base_project, source, row):
+    """
+    Validate raw {field: cell value} pairs against the base project. Returns (project_data, errors).
+    """
+    project_data = dict(base_project or {})
+    errors = []
+    for field, value in values.items():
+        try:
+            project_data[field] = parse_import_value(field, value)
+        except ValueError as error:
+            errors.append({'source': source, 'row': row, 'field': field, 'value': str(value), 'error': str(error)})
+    invalid = {error['field'] for error in errors}
+    missing = [field for field in IMPORT_FIELDS
+               if field not in project_data and field not in MODEL_FIELD_DEFAULTS and field not in invalid]
+    for field in missing:
+        errors.append({'source': source, 'row': row, 'field': field, 'value': None, 'error': 'is missing'})
+    if not errors:
+        if 1 + project_data['ppa_tenor'] + project_data['post_ppa_tenor'] > MAX_PROJECT_YEARS:
+            errors.append({'source': source, 'row': row, 'field': 'post_ppa_tenor', 'value': str(project_data['post_ppa_tenor']),
+                           'error': f'project life exceeds {MAX_PROJECT_YEARS - 1} years'})
+        if project_data['cod_date'] < project_data['construction_start']:
+            errors.append({'source': source, 'row': row, 'field': 'cod_date', 'value': str(project_data['cod_date']),
+                           'error': 'is before construction_start'})
+    return project_data, errors
+
+
+def import_workbook(file, base_project=None, source='workbook'):
+    """
+    Projects from one pro-forma workbook (path or file object): named cells if any match
+    project_data fields, otherwise the first sheet as a table. Returns (projects, names, errors).
+    """
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        projects, names, errors = [], [], []
+        named_cells = {}
+        for label, defined_name in workbook.defined_names.items():
+            field = import_field_name(label)
+            if field in IMPORT_FIELDS:
+                for sheet_title, coordinate in defined_name.destinations:
+                    named_cells[field] = workbook[sheet_title][coordinate.replace('$', '')].value
+        if named_cells:
+            project_data, project_errors = build_imported_project(named_cells, base_project, source, None)
+            errors += project_errors
+            if not project_errors:
+                projects.append(project_data)
+                names.append(source)
+            return projects, names, errors
+
+        sheet = workbook['Projects'] if 'Projects' in workbook.sheetnames else workbook.worksheets[0]
+        rows = sheet.iter_rows(values_only=True)
+        header = [import_field_name(label) if label is not None else None for label in next(rows, ())]
+        unknown = [label for label in header if label and label not in IMPORT_FIELDS and label not in IMPORT_NAME_COLUMNS]
+        for label in unknown:
+            errors.append({'source': source, 'row': 1, 'field': label, 'value': None, 'error': 'is not a known input column'})
+        for row_number, row in enumerate(rows, start=2):
+            if all(value is None for value in row):
+                continue
+            values = {field: value for field, value in zip(header, row) if field in IMPORT_FIELDS}
+            name = next((value for field, value in zip(header, row) if field in IMPORT_NAME_COLUMNS and value), None)
+            project_data, project_errors = build_imported_project(values, base_project, source, row_number)
+            errors += project_errors
+            if not project_errors:
+                projects.append(project_data)
+                names.append(str(name) if name else f'{source} row {row_number}')
+        return projects, names, errors
+    finally:
+        workbook.close()
+
+
+def import_projects(files, base_project=None):
+    """
+    Import one or more workbooks ({source name: path or file object}). Returns the valid
+    projects, their names and a DataFrame with every validation error.
+    """
+    projects, names, errors = [], [], []
+    for source, file in files.items():
+        try:
+            file_projects, file_names, file_errors = import_workbook(file, base_project, source)
+        except Exception as error:
+            file_projects, file_names, file_errors = [], [], [
+                {'source': source, 'row': None, 'field': None, 'value': None, 'error': f'could not be read: {error}'}
+            ]
+        projects += file_projects
+        names += file_names
+        errors += file_errors
+    errors_df = pd.DataFrame(errors, columns=['source', 'row', 'field', 'value', 'error'])
+    errors_df['row'] = errors_df['row'].astype('Int64')
+    return {'projects': projects, 'names': names, 'errors': errors_df}
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def import_uploaded_workbooks(uploads, base_project):
+    # uploads are (file name, bytes) pairs, so a rerun with the same files skips parsing
+    return import_projects({name: io.BytesIO(data) for name, data in uploads}, base_project)
+
+
+def evaluate_portfolio(projects, names, chunk_size=2000, cache_path=RESULT_CACHE_PATH):
+    """
+    Metrics (one row per project) and cash flows (projects x years, NaN after each project's
+    life) for a list of projects, evaluated a chunk at a time through the result cache.
+    """
+    metrics_rows, cash_flow_chunks = [], []
+    for start in range(0, len(projects), chunk_size):
+        chunk = projects[start:start + chunk_size]
+        outputs = evaluate_batch(chunk, cache_path)
+        metrics_rows.append(pd.DataFrame({metric: outputs['metrics'][metric] for metric in PORTFOLIO_METRICS}))
+        cash_flows = np.full((len(chunk), MAX_PROJECT_YEARS), np.nan)
+        chunk_cash_flows = np.where(outputs['production']['active'], outputs['flip']['cash_flows'], np.nan)
+        cash_flows[:, :chunk_cash_flows.shape[1]] = chunk_cash_flows
+        cash_flow_chunks.append(cash_flows)
+    metrics_df = pd.concat(metrics_rows, ignore_index=True)
+    metrics_df.insert(0, 'name', names)
+    metrics_df.insert(1, 'state', [project['state'] for project in projects])
+    metrics_df.insert(2, 'project_size_dc', [project['project_size_dc'] for project in projects])
+    return {'metrics': metrics_df, 'cash_flows': np.vstack(cash_flow_chunks)}
+
+
+# Arrow / Parquet output
+# Results for BI tools: one metrics row per project and long-format annual rows keyed by
+# project_id and project year. Categorical columns are dictionary-encoded, and annual rows are
+# written in row groups of whole projects, so readers can memory-map the file and use the
+# project_id statistics to skip row groups when filtering.
+REVENUE_TYPES = ['Construction', 'PPA', 'Merchant', 'PPA + REC', 'Merchant + REC']
+ANNUAL_COLUMNS = {
+    'net_production_mwh': ('production', 'production', 1 / 1000),
+    'avoided_cost_price': ('price', 'avoided_price', 1),
+    'revenue': ('revenue', 'revenue', 1),
+    'operating_expenses': ('opex', 'opex', 1),
+    'ebitda': ('cash_flow', 'ebitda', 1),
+    'depreciation': ('tax', 'depreciation', 1),
+    'income_taxes': ('tax', 'taxes', 1),
+    'investor_cash': ('flip', 'investor_cash', 1),
+    'total_cash_flows': ('flip', 'cash_flows', 1),
+    'debt_service': ('debt', 'debt_service', 1),
+    'levered_cash_flows': ('debt', 'levered_cash_flows', 1),
+    'savings_unlocked': ('revenue', 'savings', 1),
+}
+
+
+def dictionary_array(values):
+    return pa.array(values, type=pa.string()).dictionary_encode()
+
+
+def arrow_tables(projects, project_ids, outputs):
+    """
+    Metrics and long-format annual Arrow tables for projects evaluated by run_model_stages.
+    """
+    metrics = outputs['metrics']
+    metrics_table = pa.table({
+        'project_id': pa.array(project_ids, type=pa.string()),
+        'state': dictionary_array([project['state'] for project in projects]),
+        'rent_option': dictionary_array([project['rent_option'] for project in projects]),
+        'te_structure': dictionary_array([project_value(project, 'te_structure') for project in projects]),
+        'project_size_dc': pa.array([float(project['project_size_dc']) for project in projects]),
+        **{metric: pa.array(metrics[metric]) for metric in PORTFOLIO_METRICS},
+    })
+
+    production = outputs['production']
+    rows, project_years = np.nonzero(production['active'])
+    price = outputs['price']
+    # Revenue type codes index REVENUE_TYPES: PPA/Merchant, + REC, and Year 0 is construction
+    revenue_type = np.where(price['is_ppa'], 1, 2) + 2 * (price['rec_price'] > 0)
+    revenue_type = np.where(production['years'] == 0, 0, revenue_type)
+    construction_start = np.array([project['construction_start'].year for project in projects])
+    annual_table = pa.table({
+        'project_id': pa.array(np.asarray(project_ids, dtype=object)[rows], type=pa.string()),
+        'project_year': pa.array(project_years.astype(np.int16)),
+        'year': pa.array((construction_start[rows] + project_years).astype(np.int16)),
+        'revenue_type': pa.DictionaryArray.from_arrays(
+            pa.array(revenue_type[rows, project_years].astype(np.int8)), pa.array(REVENUE_TYPES)
+        ),
+        'our_price': pa.array((price['energy_price'] + price['rec_price'])[rows, project_years]),
+        **{
+            column: pa.array(outputs[stage][key][rows, project_years] * scale)
+            for column, (stage, key, scale) in ANNUAL_COLUMNS.items()
+        },
+    })
+    return metrics_table, annual_table
+
+
+def default_project_ids(projects):
+    # Row position plus input hash, so identical projects in a portfolio stay distinct
+    return [f'{row}-{hash_project_data(project)[:16]}' for row, project in enumerate(projects)]
+
+
+def write_results_parquet(projects, directory, project_ids=None, chunk_size=2000, cache_path=RESULT_CACHE_PATH):
+    """
+    Evaluate projects a chunk at a time through the result cache and write metrics.parquet and
+    annual.parquet to directory. project_ids default to each project's row position and input hash. Returns the
+    file paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {name: os.path.join(directory, f'{name}.parquet') for name in ('metrics', 'annual')}
+    if project_ids is None:
+        project_ids = default_project_ids(projects)
+    writers = {}
+    try:
+        for start in range(0, len(projects), chunk_size):
+            chunk = projects[start:start + chunk_size]
+            outputs = evaluate_batch(chunk, cache_path)
+            tables = dict(zip(('metrics', 'annual'), arrow_tables(chunk, project_ids[start:start + chunk_size], outputs)))
+            for name, table in tables.items():
+                if name not in writers:
+                    writers[name] = pq.ParquetWriter(
+                        paths[name], table.schema, use_dictionary=['state', 'rent_option', 'te_structure', 'revenue_type', 'project_id']
+                    )
+                writers[name].write_table(table)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return paths
+
+
+def results_to_parquet(project_data):
+    """
+    Parquet bytes of one project's long-format annual rows, for downloads.
+    """
+    outputs = evaluate_batch([project_data])
+    buffer = io.BytesIO()
+    pq.write_table(arrow_tables([project_data], default_project_ids([project_data]), outputs)[1], buffer)
+    return buffer.getvalue()
+
+
+def read_annual_parquet(path, project_ids=None, columns=None):
+    """
+    Annual rows for the given projects only, reading the file through a memory map.
+    """
+    filters = [('project_id', 'in', list(project_ids))] if project_ids is not None else None
+    return pq.read_table(path, columns=columns, filters=filters, memory_map=True)
+
+
+# Streaming portfolio pipeline
+# Screening runs too large for memory go through generators: input projects are read a chunk at
+# a time (from a CSV or Parquet file, or any iterable of project_data dicts), validated like an
+# Excel import, evaluated in one batch, folded into streaming statistics and written as one
+# Parquet part file per chunk. After every chunk a checkpoint (manifest and statistics) is
+# saved, so an interrupted run resumes after the last completed chunk.
+PIPELINE_CHUNK_SIZE = 5000
+
+
+def project_records(source, chunk_size=PIPELINE_CHUNK_SIZE):
+    """
+    Yield lists of raw input records (dicts) from a .csv/.parquet path or an iterable of dicts.
+    """
+    if isinstance(source, str) and source.endswith('.csv'):
+        for chunk_df in pd.read_csv(source, chunksize=chunk_size, dtype=object, keep_default_na=False):
+            yield chunk_df.to_dict('records')
+    elif isinstance(source, str) and source.endswith('.parquet'):
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_size):
+            yield batch.to_pylist()
+    else:
+        records = iter(source)
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def project_chunks(source, chunk_size=PIPELINE_CHUNK_SIZE, base_project=None):
+    """
+    Yield (projects, project_ids, errors) per chunk. Records with validation errors are
+    dropped from projects and reported in errors.
+    """
+    source_name = source if isinstance(source, str) else 'input'
+    row_number = 0
+    for records in project_records(source, chunk_size):
+        projects, project_ids, errors = [], [], []
+        for record in records:
+            row_number += 1
+            fields = {import_field_name(key): value for key, value in record.items()}
+            values = {field: value for field, value in fields.items() if field in IMPORT_FIELDS}
+            project_data, project_errors = build_imported_project(values, base_project, source_name, row_number)
+            errors += project_errors
+            if not project_errors:
+                projects.append(project_data)
+                # Names can repeat, so ids taken from a name column also carry the row number
+                name = next((fields[column] for column in IMPORT_NAME_COLUMNS if fields.get(column)), None)
+                project_ids.append(str(fields.get('project_id') or (f'{row_number}-{name}' if name else row_number)))
+        yield projects, project_ids, errors
+
+
+def save_stream_stats(path, stats):
+    with open(path, 'wb') as file:
+        np.savez(file, **{f'{name}/{key}': value for name, summary in stats.items() for key, value in summary.items()})
+
+
+def load_stream_stats(path):
+    stats = {}
+    with np.load(path) as arrays:
+        for array_key in arrays.files:
+            name, key = array_key.split('/')
+            stats.setdefault(name, {})[key] = arrays[array_key]
+    return stats
+
+
+def load_pipeline_checkpoint(output_dir):
+    """
+    The manifest and statistics of a previous run in output_dir, or (None, None).
+    """
+    manifest_path = os.path.join(output_dir, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None, None
+    with open(manifest_path) as file:
+        manifest = json.load(file)
+    return manifest, load_stream_stats(os.path.join(output_dir, 'stats.npz'))
+
+
+def save_pipeline_checkpoint(output_dir, manifest, stats):
+    # Write-then-rename, so a crash mid-save leaves the previous checkpoint intact
+    save_stream_stats(os.path.join(output_dir, 'stats.npz.tmp'), stats)
+    os.replace(os.path.join(output_dir, 'stats.npz.tmp'), os.path.join(output_dir, 'stats.npz'))
+    with open(os.path.join(output_dir, 'manifest.json.tmp'), 'w') as file:
+        json.dump(manifest, file)
+    os.replace(os.path.join(output_dir, 'manifest.json.tmp'), os.path.join(output_dir, 'manifest.json'))
+
+
+def write_parquet_part(table, directory, chunk):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'part-{chunk:06d}.parquet')
+    pq.write_table(table, path + '.tmp', use_dictionary=True)
+    os.replace(path + '.tmp', path)
+
+
+def write_pipeline_chunk(output_dir, manifest, stats, chunk, projects, project_ids, errors, outputs):
+    """
+    Write one evaluated chunk's part files, fold it into stats and checkpoint the run. outputs
+    may be a pool future, which is waited on.
+    """
+    if isinstance(outputs, Future):
+        outputs = outputs.result()
+    if projects:
+        metrics_table, annual_table = arrow_tables(projects, project_ids, outputs)
+        write_parquet_part(metrics_table, os.path.join(output_dir, 'metrics'), chunk)
+        write_parquet_part(annual_table, os.path.join(output_dir, 'annual'), chunk)
+        update_stream_stats(stats, outputs)
+    if errors:
+        errors_df = pd.DataFrame(errors).astype({'value': str, 'error': str})
+        write_parquet_part(pa.Table.from_pandas(errors_df, preserve_index=False), os.path.join(output_dir, 'errors'), chunk)
+    manifest['completed_chunks'] = chunk + 1
+    manifest['projects'] += len(projects)
+    manifest['errors'] += len(errors)
+    save_pipeline_checkpoint(output_dir, manifest, stats)
+
+
+def run_portfolio_pipeline(source, output_dir, chunk_size=PIPELINE_CHUNK_SIZE, base_project=None, resume=True, task=None,
+                           cache_path=RESULT_CACHE_PATH, max_workers=1):
+    """
+    Evaluate every project in source chunk by chunk through the result cache. Writes metrics/,
+    annual/ and errors/ Parquet part files (one per chunk) to output_dir and returns the manifest
+    and the streaming statistics of all evaluated projects. With resume, chunks completed by an
+    earlier run into the same output_dir are skipped. With max_workers above 1, chunks are
+    evaluated on a shared-memory process pool (where one can start, see shared_pool_supported)
+    while this process writes finished chunks in order.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest, stats = load_pipeline_checkpoint(output_dir) if resume else (None, None)
+    if manifest is not None and manifest['chunk_size'] != chunk_size:
+        raise ValueError(f"output_dir was started with chunk_size {manifest['chunk_size']}, not {chunk_size}")
+    if manifest is None:
+        manifest = {'chunk_size': chunk_size, 'completed_chunks': 0, 'projects': 0, 'errors': 0, 'complete': False}
+        stats = new_stream_stats()
+    elif manifest['complete']:
+        return manifest, stats
+
+    executor, blocks = None, {}
+    if max_workers > 1 and shared_pool_supported():
+        executor, blocks = start_shared_pool(model_shared_tables(), max_workers)
+    # Chunks submitted to the pool but not yet written, oldest first
+    pending = []
+    try:
+        for chunk, (projects, project_ids, errors) in enumerate(project_chunks(source, chunk_size, base_project)):
+            if chunk < manifest['completed_chunks']:
+                continue
+            if task is not None and not report_progress(task, 0.0, f"Chunk {chunk + 1:,}: {manifest['projects']:,} projects done"):
+                return manifest, stats
+            if not projects:
+                outputs = None
+            elif executor is None:
+                outputs = evaluate_batch(projects, cache_path)
+            else:
+                outputs = executor.submit(evaluate_batch, projects, cache_path)
+            pending.append((chunk, projects, project_ids, errors, outputs))
+            # Keep every worker busy with one chunk in hand, without reading the whole source ahead
+            while len(pending) > (0 if executor is None else 2 * max_workers):
+                write_pipeline_chunk(output_dir, manifest, stats, *pending.pop(0))
+        while pending:
+            write_pipeline_chunk(output_dir, manifest, stats, *pending.pop(0))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+            release_shared_arrays(blocks)
+
+    manifest['complete'] = True
+    save_pipeline_checkpoint(output_dir, manifest, stats)
+    if task is not None:
+        report_progress(task, 1.0, 'Done')
+    return manifest, stats
+
+
+# Shared-memory workers
+# Process pools get the lookup tables (merchant price curves, depreciation schedules, the solar
+# production shape, regional emissions factors and any simulated price paths) through
+# multiprocessing shared memory: the parent publishes each array once, workers attach NumPy
+# views to the same memory in their initializer, and tasks only carry project parameters.
+# Job workers run portfolio pipelines on such a pool. Tasks are pickled by reference to this
+# script's functions, which only resolves when the script is an importable module or __main__
+# (a job worker, or `python finance-model.py`), not under `streamlit run`; elsewhere the pipeline
+# evaluates in process. Startup and per-task overhead are measured from the command line with
+# `python finance-model.py --benchmark-shared-workers projects.csv` (the first valid project).
+SHARED_POOL_WORKERS = int(os.environ.get('SHARED_POOL_WORKERS', os.cpu_count() or 1))
+SHARED_TABLE_GLOBALS = ['MERCHANT_PRICE_TABLE', 'MERCHANT_PRICE_FIRST_YEARS', 'MERCHANT_PRICE_LENGTHS',
+                        'DEPRECIATION_SCHEDULES', 'SOLAR_PRODUCTION_SHAPE']
+# Shared blocks attached by this worker process, kept referenced so the views stay valid
+WORKER_SHARED_BLOCKS = {}
+WORKER_SHARED_ARRAYS = {}
+
+
+def model_shared_tables(price_paths=None):
+    """
+    The arrays workers need: model lookup tables, regional hourly emissions factors that have
+    a file, and optionally simulated merchant price paths (paths x states x years).
+    """
+    tables = {name: globals()[name] for name in SHARED_TABLE_GLOBALS}
+    for region in set(GRID_REGIONS.values()):
+        factors = load_emissions_factors(region)
+        if factors is not None:
+            tables[f'emissions/{region}'] = np.asarray(factors, dtype=float)
+    if price_paths is not None:
+        tables['merchant_price_paths'] = price_paths
+    return tables
+
+
+def publish_shared_arrays(arrays):
+    """
+    Copy arrays into new shared memory blocks. Returns the blocks (the owner must release them
+    with release_shared_arrays) and a small picklable spec for attach_shared_arrays.
+    """
+    blocks, spec = {}, {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks[name] = block
+        spec[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, spec
+
+
+def attach_shared_arrays(spec):
+    """
+    Read-only NumPy views onto published arrays (no copy), and the blocks backing them.
+    """
+    blocks, arrays = {}, {}
+    for name, (block_name, shape, dtype) in spec.items():
+        blocks[name] = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=blocks[name].buf)
+        arrays[name].flags.writeable = False
+    return blocks, arrays
+
+
+def release_shared_arrays(blocks):
+    for block in blocks.values():
+        block.close()
+        block.unlink()
+
+
+def init_shared_worker(spec):
+    """
+    Process pool initializer: attach the published tables and point the model at them.
+    """
+    blocks, arrays = attach_shared_arrays(spec)
+    WORKER_SHARED_BLOCKS.update(blocks)
+    WORKER_SHARED_ARRAYS.update(arrays)
+    for name in SHARED_TABLE_GLOBALS:
+        if name in arrays:
+            globals()[name] = arrays[name]
+    SHARED_EMISSIONS_FACTORS.update({
+        name.split('/', 1)[1]: array for name, array in arrays.items() if name.startswith('emissions/')
+    })
+
+
+def evaluate_shared_chunk(projects, path_index=None, cache_path=RESULT_CACHE_PATH):
+    """
+    Worker task: headline metrics for a chunk of projects, using the attached price paths
+    (path_index picks one per project) when given. Returns only the metric arrays.
+    """
+    if path_index is None:
+        metrics = evaluate_batch(projects, cache_path)['metrics']
+    else:
+        # Results on simulated prices aren't determined by project_data alone, so skip the cache
+        merchant_prices = merchant_prices_for_projects(WORKER_SHARED_ARRAYS['merchant_price_paths'], projects, path_index)
+        metrics = run_model_stages(projects, merchant_prices=merchant_prices)[0]['metrics']
+    return {metric: metrics[metric] for metric in PORTFOLIO_METRICS}
+
+
+def shared_pool_supported():
+    """
+    Whether pool workers can run this module's functions: they are forked (the Streamlit script
+    can't be re-imported by a spawned process) and pickled function references resolve back here.
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return False
+    try:
+        return pickle.loads(pickle.dumps(evaluate_batch)) is evaluate_batch
+    except (pickle.PicklingError, AttributeError, ImportError, TypeError):
+        return False
+
+
+def start_shared_pool(tables, max_workers=SHARED_POOL_WORKERS):
+    """
+    Publish tables and start a forked process pool whose workers attach to them. Check
+    shared_pool_supported() first. Returns (executor, blocks); shut the executor down before
+    releasing the blocks.
+    """
+    blocks, spec = publish_shared_arrays(tables)
+    executor = ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=init_shared_worker,
+        initargs=(spec,),
+    )
+    return executor, blocks
+
+
+def benchmark_shared_workers(project_data, n_projects=20000, n_paths=2000, chunk_size=2000, max_workers=SHARED_POOL_WORKERS, seed=0):
+    """
+    Startup and per-task overhead of the shared-memory pool, against pickling the tables into
+    every task. Returns a DataFrame of timings (seconds) and payload sizes (bytes).
+    """
+    rng = merchant_price_rngs(seed, 1)[0]
+    price_paths = generate_merchant_price_paths(rng, n_paths)
+    tables = model_shared_tables(price_paths)
+    projects = [project_data] * n_projects
+    path_index = np.arange(n_projects) % n_paths
+    chunk = projects[:chunk_size]
+
+    started = time.perf_counter()
+    blocks, spec = publish_shared_arrays(tables)
+    publish_seconds = time.perf_counter() - started
+    release_shared_arrays(blocks)
+
+    started = time.perf_counter()
+    executor, blocks = start_shared_pool(tables, max_workers)
+    try:
+        # The first round of tasks also waits for every worker to start and attach
+        list(executor.map(len, [[]] * max_workers))
+        startup_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        list(executor.map(len, [[]] * 200))
+        empty_task_seconds = (time.perf_counter() - started) / 200
+
+        started = time.perf_counter()
+        futures = [executor.submit(evaluate_shared_chunk, projects[start:start + chunk_size], path_index[start:start + chunk_size])
+                   for start in range(0, n_projects, chunk_size)]
+        [future.result() for future in futures]
+        run_seconds = time.perf_counter() - started
+    finally:
+        executor.shutdown()
+        release_shared_arrays(blocks)
+
+    started = time.perf_counter()
+    pickled_tables = pickle.dumps(tables)
+    pickle_seconds = time.perf_counter() - started
+    return pd.DataFrame([
+        {'measure': 'publish tables to shared memory (s)', 'value': publish_seconds},
+        {'measure': 'pool startup incl. attach (s)', 'value': startup_seconds},
+        {'measure': 'per-task overhead, empty task (s)', 'value': empty_task_seconds},
+        {'measure': f'evaluate {n_projects:,} projects (s)', 'value': run_seconds},
+        {'measure': 'task payload with shared tables (bytes)', 'value': len(pickle.dumps((chunk, path_index[:chunk_size])))},
+        {'measure': 'tables pickled into each task instead (bytes)', 'value': len(pickled_tables)},
+        {'measure': 'pickling tables per task (s)', 'value': pickle_seconds},
+    ])
+
+
+# Background analytics
+# Heavy analytics run on one bounded thread pool per server, so "Calculate IRR" can show the
+# Key Metrics straight away. A session never has more than ANALYTICS_WORKERS_PER_SESSION tasks
+# running at once; further tasks wait in the session's queue.
+ANALYTICS_MAX_WORKERS = int(os.environ.get('ANALYTICS_MAX_WORKERS', 4))
+ANALYTICS_WORKERS_PER_SESSION = int(os.environ.get('ANALYTICS_WORKERS_PER_SESSION', 1))
+ANALYTICS_POLL_SECONDS = 1.0
+
+
+@st.cache_resource
+def get_analytics_executor():
+    return ThreadPoolExecutor(max_workers=ANALYTICS_MAX_WORKERS, thread_name_prefix='analytics')
+
+
+def submit_analytics(session_tasks, name, input_key, function, *args):
+    """
+    Queue function(task, *args) as this session's `name` analytic for the inputs identified by
+    input_key. Resubmitting for the same inputs returns the existing task; for different inputs
+    the old task is cancelled.
+    """
+    existing = session_tasks.get(name)
+    if existing is not None and existing['input_key'] == input_key and not existing['cancel'].is_set():
+        return existing
+    if existing is not None:
+        stop_analytics(session_tasks, name)
+
+    task = {
+        'name': name,
+        'input_key': input_key,
+        'function': function,
+        'args': args,
+        'cancel': threading.Event(),
+        'future': None,
+        'progress': 0.0,
+        'message': 'Queued',
+        'submitted_at': time.time(),
+    }
+    session_tasks[name] = task
+    dispatch_analytics(session_tasks)
+    return task
+
+
+def dispatch_analytics(session_tasks):
+    """
+    Start queued tasks while the session is below its share of the worker pool. Cancelled tasks
+    that are still running count towards that share until they return.
+    """
+    for key, task in list(session_tasks.items()):
+        if task['cancel'].is_set() and task['future'] is not None and task['future'].done():
+            del session_tasks[key]
+    running = sum(1 for task in session_tasks.values() if task['future'] is not None and not task['future'].done())
+    queued = [task for task in session_tasks.values() if task['future'] is None and not task['cancel'].is_set()]
+    for task in sorted(queued, key=lambda task: task['submitted_at']):
+        if running >= ANALYTICS_WORKERS_PER_SESSION:
+            break
+        task['future'] = get_analytics_executor().submit(task['function'], task, *task['args'])
+        running += 1
+
+
+def stop_analytics(session_tasks, name):
+    """
+    Cancel the session's `name` task. A task that has not started is taken off the executor's
+    queue; one that is running stops at its next progress checkpoint and stays in session_tasks
+    under a separate key until then, so it still counts towards the session's workers.
+    """
+    task = session_tasks.pop(name)
+    task['cancel'].set()
+    future = task['future']
+    if future is not None and not future.cancel() and not future.done():
+        session_tasks[('cancelled', id(task))] = task
+
+
+def cancel_analytics(session_tasks, input_key=None):
+    """
+    Cancel every task of the session, or only those computed for inputs other than input_key.
+    """
+    for name, task in list(session_tasks.items()):
+        if task['cancel'].is_set():
+            continue
+        if input_key is None or task['input_key'] != input_key:
+            stop_analytics(session_tasks, name)
+
+
+def report_progress(task, fraction, message=''):
+    """
+    Record a task's progress. Returns False once the task has been cancelled, so long-running
+    analytics can stop at the next checkpoint.
+    """
+    task['progress'] = min(max(fraction, 0.0), 1.0)
+    task['message'] = message
+    return not task['cancel'].is_set()
+
+
+SENSITIVITY_FIELDS = {
+    'ppa_rate': 'PPA Rate',
+    'ppa_escalation': 'PPA Escalation',
+    'production_yield': 'Production Yield',
+    'degradation_rate': 'Degradation Rate',
+    'epc_cost': 'EPC Cost',
+    'om_cost': 'O&M Cost',
+    'insurance_cost': 'Insurance Cost',
+    'itc_amount': 'ITC Amount',
+    'preferred_return': 'Preferred Return',
+    'rec_price_years_1_5': 'REC Price (Years 1-5)',
+    'discount_rate': 'Discount Rate',
+}
+
+
+def run_sensitivity_analysis(task, project_data, swing=0.10):
+    """
+    One-at-a-time sensitivity of IRR and NPV to a +/- swing in each SENSITIVITY_FIELDS input.
+    """
+    base_outputs, _ = run_model_stages([project_data])
+    base_irr = base_outputs['metrics']['irr'][0]
+    base_npv = base_outputs['metrics']['npv'][0]
+
+    rows = []
+    for index, (field, label) in enumerate(SENSITIVITY_FIELDS.items()):
+        if not report_progress(task, index / len(SENSITIVITY_FIELDS), f'Varying {label}'):
+            return None
+        low = {**project_data, field: project_data[field] * (1 - swing)}
+        high = {**project_data, field: project_data[field] * (1 + swing)}
+        outputs, _ = run_model_stages([low, high], irr_guess=base_irr)
+        rows.append({
+            'Input': label,
+            'IRR Low (%)': (outputs['metrics']['irr'][0] - base_irr) * 100,
+            'IRR High (%)': (outputs['metrics']['irr'][1] - base_irr) * 100,
+            'NPV Low ($)': outputs['metrics']['npv'][0] - base_npv,
+            'NPV High ($)': outputs['metrics']['npv'][1] - base_npv,
+        })
+    report_progress(task, 1.0, 'Done')
+
+    sensitivity_df = pd.DataFrame(rows)
+    swing_size = (sensitivity_df['IRR High (%)'] - sensitivity_df['IRR Low (%)']).abs()
+    return sensitivity_df.loc[swing_size.sort_values().index].reset_index(drop=True)
+
+
+def plot_tornado_chart(sensitivity_df):
+    fig = go.Figure()
+    fig.add_trace(go.Bar(
+        y=sensitivity_df['Input'],
+        x=sensitivity_df['IRR Low (%)'],
+        orientation='h',
+        name='-10%',
+        marker_color='lightgreen',
+        hovertemplate='%{y}: %{x:.2f}pp<extra></extra>'
+    ))
+    fig.add_trace(go.Bar(
+        y=sensitivity_df['Input'],
+        x=sensitivity_df['IRR High (%)'],
+        orientation='h',
+        name='+10%',
+        marker_color='green',
+        hovertemplate='%{y}: %{x:.2f}pp<extra></extra>'
+    ))
+    fig.update_layout(
+        barmode='overlay',
+        title='IRR Sensitivity (change in percentage points)',
+        xaxis_title='Change in IRR (pp)',
+        legend=dict(
+            orientation="h",
+            yanchor="bottom",
+            y=1.02,
+            xanchor="right",
+            x=1
+        )
+    )
+    return fig
+
+
+def plot_structuring_frontier(frontier_df):
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=frontier_df['savings_notional'],
+        y=frontier_df['irr'] * 100,
+        mode='lines+markers',
+        name='Pareto Frontier',
+        marker_color='green',
+        customdata=frontier_df[['ppa_tenor', 'buyout_year', 'ppa_escalation', 'ppa_rate']].to_numpy() * [1, 1, 100, 1],
+        hovertemplate=(
+            'Savings: $%{x:,.0f}<br>IRR: %{y:.2f}%<br>PPA Tenor: %{customdata[0]} years<br>'
+            'Buyout Year: %{customdata[1]}<br>Escalation: %{customdata[2]:.2f}%<br>'
+            'PPA Rate: $%{customdata[3]:,.2f}/MWh<extra></extra>'
+        )
+    ))
+    fig.update_layout(
+        title='Developer IRR vs Customer Savings',
+        xaxis_title='Customer Savings ($)',
+        yaxis_title='Unlevered IRR (%)',
+        xaxis=dict(tickformat='$,'),
+    )
+    return fig
+
+
+def plot_attribution_waterfall(attribution, metric='npv'):
+    contributions = attribution['contributions']
+    base, new = attribution['base'][metric], attribution['new'][metric]
+    values = [base, *contributions[metric], new]
+    if metric == 'irr':
+        text = [f'{value:+.2%}' if 0 < index < len(values) - 1 else f'{value:.2%}' for index, value in enumerate(values)]
+    else:
+        text = [('+' if 0 < index < len(values) - 1 and value > 0 else '') + format_hover_value(value)
+                for index, value in enumerate(values)]
+    fig = go.Figure(go.Waterfall(
+        x=['Base', *contributions['group'], 'New'],
+        y=values,
+        measure=['absolute', *['relative'] * len(contributions), 'total'],
+        text=text,
+        textposition='outside',
+        customdata=['', *contributions['fields'], ''],
+        hovertemplate='%{x}: %{text}<br>%{customdata}<extra></extra>',
+        increasing=dict(marker_color='green'),
+        decreasing=dict(marker_color='firebrick'),
+        totals=dict(marker_color='steelblue'),
+    ))
+    label = 'IRR' if metric == 'irr' else 'NPV'
+    fig.update_layout(
+        title=f'{label} Change by Input Group',
+        yaxis_title=label,
+        yaxis_tickformat='.1%' if metric == 'irr' else '$,.3s',
+        showlegend=False,
+    )
+    return fig
+
+
+def render_sensitivity_analysis(result, key_prefix=''):
+    st.plotly_chart(plot_tornado_chart(result), key=f'{key_prefix}chart_sensitivity_analysis')
+
+
+def render_structuring_optimizer(result, key_prefix=''):
+    st.caption(f"{result['evaluated']:,} options evaluated, {result['feasible']:,} met the constraints, "
+               f"{len(result['frontier']):,} on the Pareto frontier.")
+    if result['frontier'].empty:
+        st.warning('No structuring option met the constraints.')
+        return
+    st.plotly_chart(plot_structuring_frontier(result['frontier']), key=f'{key_prefix}chart_structuring_optimizer')
+    st.dataframe(result['frontier'], column_config={
+        'ppa_escalation': st.column_config.NumberColumn(format='percent'),
+        'ppa_rate': st.column_config.NumberColumn(format='dollar'),
+        'irr': st.column_config.NumberColumn(format='percent'),
+        'npv': st.column_config.NumberColumn(format='dollar'),
+        'savings_notional': st.column_config.NumberColumn(format='dollar'),
+    })
+
+
+# Large charts
+# Portfolio and simulation charts use WebGL traces and are reduced on the server to at most
+# CHART_MAX_POINTS points: long series keep each bucket's first, min, max and last point, and
+# overlays with too many curves show percentile bands plus a sample of the curves. Figures are
+# memoized on a hash of their input data, so reruns with unchanged data don't rebuild them.
+CHART_MAX_POINTS = 20000
+CHART_MAX_CURVES = 200
+
+
+def downsample_min_max(x, y, max_points=CHART_MAX_POINTS):
+    """
+    Reduce a series to about max_points points, keeping the extremes of every bucket.
+    """
+    n = len(x)
+    if n <= max_points:
+        return np.asarray(x), np.asarray(y)
+    n_buckets = max(max_points // 4, 1)
+    bucket_size = int(np.ceil(n / n_buckets))
+    n_buckets = int(np.ceil(n / bucket_size))
+    padded = np.full(n_buckets * bucket_size, np.nan)
+    padded[:n] = y
+    buckets = padded.reshape(n_buckets, bucket_size)
+    filled_low = np.where(np.isnan(buckets), np.inf, buckets)
+    filled_high = np.where(np.isnan(buckets), -np.inf, buckets)
+    starts = np.arange(n_buckets) * bucket_size
+    keep = np.concatenate([
+        starts,
+        starts + filled_low.argmin(axis=1),
+        starts + filled_high.argmax(axis=1),
+        np.minimum(starts + bucket_size, n) - 1,
+    ])
+    keep = np.unique(keep)
+    return np.asarray(x)[keep], np.asarray(y)[keep]
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def plot_cash_flow_overlay(years, cash_flows, title='Portfolio Cash Flows', max_points=CHART_MAX_POINTS):
+    """
+    Cash-flow curves of many projects or draws (rows of cash_flows) on one chart.
+    """
+    cash_flows = np.atleast_2d(cash_flows)
+    fig = go.Figure()
+    if cash_flows.size > max_points:
+        # Too many points to draw every curve: percentile bands plus an evenly spaced sample
+        percentiles = np.nanpercentile(cash_flows, [5, 25, 50, 75, 95], axis=0)
+        for lower, upper, label in [(0, 4, '5th-95th Percentile'), (1, 3, '25th-75th Percentile')]:
+            fig.add_trace(go.Scattergl(x=years, y=percentiles[upper], mode='lines', line=dict(width=0),
+                                       showlegend=False, hoverinfo='skip'))
+            fig.add_trace(go.Scattergl(x=years, y=percentiles[lower], mode='lines', line=dict(width=0),
+                                       fill='tonexty', fillcolor='rgba(0, 128, 0, 0.2)', name=label))
+        n_sample = min(CHART_MAX_CURVES, max(max_points // cash_flows.shape[1] - 5, 0))
+        cash_flows = cash_flows[np.linspace(0, len(cash_flows) - 1, n_sample).astype(int)] if n_sample else cash_flows[:0]
+        fig.add_trace(go.Scattergl(x=years, y=percentiles[2], mode='lines', line=dict(color='green'), name='Median'))
+
+    if len(cash_flows):
+        # All curves in one trace, separated by gaps, so the payload carries one set of styles
+        separated = np.hstack([cash_flows, np.full((len(cash_flows), 1), np.nan)])
+        fig.add_trace(go.Scattergl(
+            x=np.tile(np.append(np.asarray(years, dtype=float), np.nan), len(cash_flows)),
+            y=separated.ravel(),
+            mode='lines',
+            line=dict(width=1, color='rgba(0, 100, 0, 0.3)'),
+            name=f'{len(cash_flows):,} Curves',
+            hovertemplate='Year: %{x}<br>Cash Flow: $%{y:,.0f}<extra></extra>',
+        ))
+    fig.update_layout(title=title, xaxis_title='Year', yaxis_title='Cash Flow ($)', yaxis=dict(tickformat='$,'))
+    return fig
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def plot_cash_flow_fan_chart(cash_flow_table, construction_start):
+    cash_flow_table = cash_flow_table[cash_flow_table['count'] > 0]
+    years = construction_start + cash_flow_table.index
+    fig = go.Figure()
+    for lower, upper, label in [('p5', 'p95', '5th-95th Percentile'), ('p25', 'p75', '25th-75th Percentile')]:
+        fig.add_trace(go.Scattergl(x=years, y=cash_flow_table[upper], mode='lines', line=dict(width=0),
+                                   showlegend=False, hoverinfo='skip'))
+        fig.add_trace(go.Scattergl(x=years, y=cash_flow_table[lower], mode='lines', line=dict(width=0),
+                                   fill='tonexty', fillcolor='rgba(0, 128, 0, 0.2)', name=label))
+    fig.add_trace(go.Scattergl(x=years, y=cash_flow_table['p50'], mode='lines', line=dict(color='green'), name='Median'))
+    fig.update_layout(
+        title='Total Cash Flows Across Merchant Price Paths',
+        xaxis_title='Year',
+        yaxis_title='Cash Flow ($)',
+        yaxis=dict(tickformat='$,'),
+    )
+    return fig
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def plot_hourly_profile(profiles, title, yaxis_title, start=None, max_points=CHART_MAX_POINTS):
+    """
+    Hourly series ({name: values}) on a shared time axis, downsampled per series.
+    """
+    fig = go.Figure()
+    per_series = max(max_points // max(len(profiles), 1), 4)
+    for name, values in profiles.items():
+        hours = np.arange(len(values))
+        x = hours if start is None else pd.Timestamp(start) + pd.to_timedelta(hours, unit='h')
+        x, y = downsample_min_max(x, np.asarray(values, dtype=float), per_series)
+        fig.add_trace(go.Scattergl(x=x, y=y, mode='lines', name=name))
+    fig.update_layout(title=title, xaxis_title='Hour' if start is None else 'Date', yaxis_title=yaxis_title)
+    return fig
+
+
+def render_stream_metrics(stats):
+    metrics_df = pd.concat(
+        [stream_stats_table(stats[metric]) for metric in STREAM_METRICS], ignore_index=True
+    )
+    metrics_df.insert(0, 'Metric', ['IRR', 'NPV ($)', 'LCOE ($/MWh)'])
+    st.dataframe(metrics_df.drop(columns=['count']).style.format({
+        column: '{:,.4f}' for column in metrics_df.columns if column not in ('Metric', 'count')
+    }))
+
+
+def render_merchant_price_risk(result, key_prefix=''):
+    stats = result['stats']
+    st.caption(f"{int(stats['npv']['count'][0]):,} merchant price paths simulated.")
+    render_stream_metrics(stats)
+    st.plotly_chart(
+        plot_cash_flow_fan_chart(stream_stats_table(stats['cash_flows']), result['construction_start']),
+        key=f'{key_prefix}chart_merchant_price_risk'
+    )
+
+
+def render_what_if_surrogate(result, key_prefix=''):
+    st.caption(f"Surrogate fitted on {len(result['points']):,} design points over: {', '.join(result['fields'])}. "
+               'Previews update instantly while these inputs stay within the sampled range.')
+    st.dataframe(pd.DataFrame({
+        'Input': result['fields'],
+        'Lower': result['lower'],
+        'Upper': result['upper'],
+    }).style.format({'Lower': '{:,.4g}', 'Upper': '{:,.4g}'}))
+
+
+def render_preview(preview):
+    st.subheader('What-If Preview')
+    errors = preview['errors']
+    col1, col2, col3 = st.columns(3)
+    col1.metric('Unlevered IRR', f"{preview['irr']:.2%}" if np.isfinite(preview['irr']) else 'N/A',
+                help=f"± {errors['irr']['max']:.2%} (largest leave-one-out error)" if errors else None)
+    col2.metric('Net Present Value', format_hover_value(preview['npv']),
+                help=f"± {format_hover_value(errors['npv']['max'])} (largest leave-one-out error)" if errors else None)
+    col3.metric('LCOE', f"${preview['lcoe']:,.2f}/MWh",
+                help=f"± ${errors['lcoe']['max']:,.2f}/MWh (largest leave-one-out error)" if errors else None)
+    if preview['source'] == 'surrogate':
+        st.caption('Interpolated by the what-if surrogate. Click Calculate IRR for the full results.')
+    else:
+        st.caption('Inputs are outside the surrogate\'s sampled region, so this preview comes from the full model.')
+
+
+ANALYTICS_RENDERERS = {
+    'Sensitivity Analysis': render_sensitivity_analysis,
+    'Structuring Optimizer': render_structuring_optimizer,
+    'Merchant Price Risk': render_merchant_price_risk,
+    'What-If Surrogate': render_what_if_surrogate,
+}
+
+
+@st.fragment(run_every=ANALYTICS_POLL_SECONDS)
+def render_background_analytics(session_tasks):
+    dispatch_analytics(session_tasks)
+    for name, task in list(session_tasks.items()):
+        if task['cancel'].is_set():
+            continue
+        future = task['future']
+        if future is None or not future.done():
+            st.progress(task['progress'], text=f"{name}: {task['message']}")
+            if st.button('Cancel', key=f'cancel_{name}'):
+                stop_analytics(session_tasks, name)
+            continue
+
+        if future.exception() is not None:
+            st.error(f'{name} failed: {future.exception()}')
+        elif future.result() is not None:
+            st.subheader(name)
+            ANALYTICS_RENDERERS[name](future.result())
+
 
-def plot_stacked_savings_chart(df):
-    df = df[df['Year'] != 'Total']  # Exclude 'Total' row
+def annual_table_column_config(revenue_df):
+    """
+    Column formats for the annual table, applied by the browser instead of per-cell Python formatting.
+    """
+    column_config = {
+        'Net Production (MWh)': st.column_config.NumberColumn(format='localized'),
+        'Our Price ($/MWh)': st.column_config.NumberColumn(format='dollar'),
+        'Avoided Cost Price ($/MWh)': st.column_config.NumberColumn(format='dollar'),
+    }
+    for column in revenue_df.columns:
+        if column.endswith('($)'):
+            column_config[column] = st.column_config.NumberColumn(format='dollar')
+    return column_config
+
+
+def render_attribution(attribution):
+    st.subheader('NPV Change Attribution')
+    method = 'Order-averaged (Shapley)' if attribution['method'] == 'shapley' else 'Sequential'
+    st.caption(f"{method} attribution from {attribution['scenarios']:,} scenarios evaluated in one batch.")
+    if attribution['contributions'].empty:
+        st.info('The two scenarios have the same inputs.')
+        return
+    col1, col2 = st.columns(2)
+    col1.plotly_chart(plot_attribution_waterfall(attribution, 'npv'), key='chart_attribution_npv')
+    col2.plotly_chart(plot_attribution_waterfall(attribution, 'irr'), key='chart_attribution_irr')
+    st.dataframe(attribution['contributions'], hide_index=True, column_config={
+        'npv': st.column_config.NumberColumn('NPV Change', format='dollar'),
+        'irr': st.column_config.NumberColumn('IRR Change', format='percent'),
+    })
+
+
+def render_portfolio(portfolio, key_prefix=''):
+    metrics_df = portfolio['metrics']
+    st.subheader("Imported Portfolio")
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Projects", f"{len(metrics_df):,}")
+    col2.metric("Median IRR", f"{metrics_df['irr'].median():.2%}")
+    col3.metric("Total NPV", format_hover_value(metrics_df['npv'].sum()))
+    st.dataframe(metrics_df, column_config={
+        'irr': st.column_config.NumberColumn(format='percent'),
+        'levered_irr': st.column_config.NumberColumn(format='percent'),
+        'npv': st.column_config.NumberColumn(format='dollar'),
+        'lcoe': st.column_config.NumberColumn(format='dollar'),
+        'saved_npv': st.column_config.NumberColumn(format='dollar'),
+        'unlevered_capex': st.column_config.NumberColumn(format='dollar'),
+        'total_revenue': st.column_config.NumberColumn(format='dollar'),
+        'total_ebitda': st.column_config.NumberColumn(format='dollar'),
+        'total_taxes': st.column_config.NumberColumn(format='dollar'),
+        'savings_notional': st.column_config.NumberColumn(format='dollar'),
+        'debt_size': st.column_config.NumberColumn(format='dollar'),
+        'leverage': st.column_config.NumberColumn(format='percent'),
+    })
+    cash_flows = portfolio['cash_flows']
+    st.plotly_chart(plot_cash_flow_overlay(np.arange(cash_flows.shape[1]), cash_flows, 'Portfolio Cash Flows by Project Year'),
+                    key=f'{key_prefix}chart_portfolio')
+    st.download_button(
+        label="Download Portfolio as Excel",
+        key=f'{key_prefix}download_portfolio',
+        data=write_workbook(io.BytesIO(), portfolio=(row._asdict() for row in metrics_df.itertuples(index=False))).getvalue(),
+        file_name='portfolio.xlsx',
+        mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    )
 
-    # Calculate total avoided cost in dollars
-    df['Total Avoided Cost ($)'] = df['Avoided Cost Price ($/MWh)'] * df['Net Production (MWh)']
-    df['Our Cost ($)'] = df['Our Price ($/MWh)'] * df['Net Production (MWh)']
-    df['Savings ($)'] = df['Savings Unlocked ($)']
 
-    # Create the stacked bar chart
-    fig = go.Figure()
+# Job queue (SQLite)
+# Long optimizer, simulation and portfolio runs can be queued as jobs instead of running in the
+# session, so they keep going when the browser tab disconnects. Jobs live in a local SQLite
+# database and are run by worker processes on the same machine (`python finance-model.py
+# --job-worker`, started by the app when too few are alive). A worker claims the highest-priority
+# queued job whose user is below their concurrency limit, reports progress through a heartbeat
+# and retries failed jobs with backoff. Jobs of a worker that stops heartbeating are requeued.
+JOB_QUEUE_PATH = os.environ.get('JOB_QUEUE_PATH', 'jobs.db')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_WORKER_AUTOSTART = os.environ.get('JOB_WORKER_AUTOSTART', '1') == '1'
+JOB_MAX_RUNNING_PER_USER = int(os.environ.get('JOB_MAX_RUNNING_PER_USER', 1))
+# Shared-memory pool processes per pipeline job, so concurrent jobs split the cores between them
+JOB_PIPELINE_WORKERS = int(os.environ.get('JOB_PIPELINE_WORKERS', max(1, SHARED_POOL_WORKERS // JOB_WORKERS)))
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY_SECONDS = 10.0
+JOB_POLL_SECONDS = 1.0
+JOB_HEARTBEAT_SECONDS = 2.0
+JOB_STALE_SECONDS = 60.0
+JOB_LIST_LIMIT = 20
+
+JOB_QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    label TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT NOT NULL DEFAULT 'Queued',
+    error TEXT,
+    args BLOB NOT NULL,
+    result BLOB,
+    submitted_at REAL NOT NULL,
+    run_after REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    heartbeat_at REAL,
+    worker_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_priority ON jobs (status, priority DESC, submitted_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_user_status ON jobs (username, status);
+CREATE TABLE IF NOT EXISTS job_user_limits (
+    username TEXT PRIMARY KEY,
+    max_running INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_workers (
+    worker_id TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    heartbeat_at REAL NOT NULL
+);
+"""
+
+
+def evaluate_portfolio_job(task, projects, names, chunk_size=2000):
+    report_progress(task, 0.0, f'Evaluating {len(projects):,} projects')
+    return evaluate_portfolio(projects, names, chunk_size)
+
+
+def run_pipeline_job(task, source, output_dir, chunk_size=PIPELINE_CHUNK_SIZE, base_project=None):
+    # A retried pipeline job resumes after the last chunk the failed attempt completed
+    manifest, stats = run_portfolio_pipeline(source, output_dir, chunk_size, base_project, resume=True, task=task,
+                                             max_workers=JOB_PIPELINE_WORKERS)
+    if not manifest['complete']:
+        return None
+    return {'manifest': manifest, 'stats': stats, 'output_dir': output_dir}
+
+
+# Functions a job may run, by kind; each is called as function(task, *args)
+JOB_FUNCTIONS = {
+    'Structuring Optimizer': optimize_structure,
+    'Merchant Price Risk': simulate_merchant_risk,
+    'Portfolio': evaluate_portfolio_job,
+    'Portfolio Pipeline': run_pipeline_job,
+}
 
-    # Our Cost
-    fig.add_trace(go.Bar(
-        x=df['Year'],
-        y=df['Our Cost ($)'],
-        name='Our Cost',
-        marker_color='green',
-        hovertemplate='Year: %{x}<br>Our Cost: %{customdata}<extra></extra>',
-        customdata=df['Our Cost ($)'].apply(format_hover_value)
-    ))
 
-    # Savings
-    fig.add_trace(go.Bar(
-        x=df['Year'],
-        y=df['Savings ($)'],
-        name='Savings',
-        marker_color='lightgreen',
-        hovertemplate='Year: %{x}<br>Savings: %{customdata}<extra></extra>',
-        customdata=df['Savings ($)'].apply(format_hover_value)
-    ))
+def connect_job_queue(db_path=JOB_QUEUE_PATH):
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(JOB_QUEUE_SCHEMA)
+    return conn
 
-    fig.update_layout(
-        barmode='stack',
-        title='Total Avoided Cost Breakdown',
-        xaxis_title='Year',
-        yaxis_title='Cost ($)',
-        hovermode='x unified',
-        yaxis=dict(
-            tickformat='$,',
-            tickprefix='',
-        ),
-        legend=dict(
-            orientation="h",
-            yanchor="bottom",
-            y=1.02,
-            xanchor="right",
-            x=1
+
+def submit_job(username, kind, args, priority=0, label='', max_attempts=JOB_MAX_ATTEMPTS, db_path=JOB_QUEUE_PATH):
+    """
+    Queue JOB_FUNCTIONS[kind](task, *args) for username. Higher priorities start first; jobs of
+    equal priority start in submission order. Returns the job_id.
+    """
+    if kind not in JOB_FUNCTIONS:
+        raise ValueError(f"Unknown job kind '{kind}'")
+    now = time.time()
+    with closing(connect_job_queue(db_path)) as conn, conn:
+        cursor = conn.execute(
+            """
+            INSERT INTO jobs (username, kind, label, priority, status, max_attempts, args, submitted_at, run_after)
+            VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?)
+            """,
+            (username, kind, label or kind, int(priority), int(max_attempts), pickle.dumps(tuple(args)), now, now)
         )
-    )
+    return cursor.lastrowid
 
-    return fig
 
-# Calculation functions
-def calculate_capex(project_data):
-    return (project_data['epc_cost'] + project_data['interconnection_cost'] + 
-            project_data['developer_fee'] + project_data['transaction_costs']) * project_data['project_size_dc'] * 1e6
-
-def calculate_annual_production(project_data, year):
-    initial_production = project_data['project_size_dc'] * project_data['production_yield'] * 1000
-    # Adjust degradation start year if necessary
-    if year >= project_data['degradation_start_year']:
-        degradation_factor = (1 - project_data['degradation_rate']) ** (year - project_data['degradation_start_year'])
-    else:
-        degradation_factor = 1.0
-    net_production = initial_production * degradation_factor
-    return net_production
-
-def calculate_revenue(project_data, year, state):
-    net_production = calculate_annual_production(project_data, year)
-    if year <= project_data['ppa_tenor']:
-        # PPA price starts at initial rate and escalates annually
-        price = project_data['ppa_rate'] * (1 + project_data['ppa_escalation']) ** (year - 1)
-    else:
-        # Use merchant price from the selected state's price curve
-        merchant_year = project_data['construction_start'].year + year - 1
-        try:
-            index = merchant_price_curves[state]['years'].index(merchant_year)
-            price = merchant_price_curves[state]['prices'][index]
-        except ValueError:
-            # If the year is not in the merchant price curve, use the last available price
-            price = merchant_price_curves[state]['prices'][-1]
-    
-    # Get REC price based on the year
-    if year >= 1:
-        if 1 <= year <= 5:
-            rec_price = project_data['rec_price_years_1_5']
-        elif 6 <= year <= 10:
-            rec_price = project_data['rec_price_years_6_10']
-        elif 11 <= year <= 15:
-            rec_price = project_data['rec_price_years_11_15']
+def set_job_user_limit(username, max_running, db_path=JOB_QUEUE_PATH):
+    """
+    Override JOB_MAX_RUNNING_PER_USER for one user; None removes the override.
+    """
+    with closing(connect_job_queue(db_path)) as conn, conn:
+        if max_running is None:
+            conn.execute('DELETE FROM job_user_limits WHERE username = ?', (username,))
         else:
-            rec_price = 0  # No REC revenue after year 15
-    else:
-        rec_price = 0  # No production in construction year
-    print(f"Year {year}: REC price is {rec_price}")
+            conn.execute(
+                'INSERT OR REPLACE INTO job_user_limits (username, max_running) VALUES (?, ?)',
+                (username, int(max_running))
+            )
 
-    total_price = price + rec_price
-    revenue = net_production * total_price / 1000  # Convert to MWh
 
-    if year == 1:
-        revenue += project_data['incentive_amount']
+def requeue_stale_jobs(conn, now):
+    # Jobs whose worker stopped heartbeating count as a failed attempt
+    conn.execute(
+        """
+        UPDATE jobs SET
+            status = CASE WHEN status = 'cancelling' THEN 'cancelled'
+                          WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+            finished_at = CASE WHEN status = 'running' AND attempts < max_attempts THEN NULL ELSE ? END,
+            error = 'Worker stopped responding',
+            message = 'Worker stopped responding',
+            run_after = ?,
+            worker_id = NULL
+        WHERE status IN ('running', 'cancelling') AND heartbeat_at < ?
+        """,
+        (now, now, now - JOB_STALE_SECONDS)
+    )
+    conn.execute('DELETE FROM job_workers WHERE heartbeat_at < ?', (now - JOB_STALE_SECONDS,))
 
-    return revenue
 
+def claim_job(worker_id, db_path=JOB_QUEUE_PATH):
+    """
+    Atomically take the next job for worker_id. Returns (job_id, kind, args) or None.
+    """
+    now = time.time()
+    with closing(connect_job_queue(db_path)) as conn, conn:
+        # Take the write lock up front so two workers can't claim the same job
+        conn.execute('BEGIN IMMEDIATE')
+        requeue_stale_jobs(conn, now)
+        row = conn.execute(
+            """
+            SELECT job_id, kind, args FROM jobs AS job
+            WHERE status = 'queued' AND run_after <= ?
+              AND (SELECT COUNT(*) FROM jobs AS running
+                   WHERE running.username = job.username AND running.status IN ('running', 'cancelling'))
+                  < COALESCE((SELECT max_running FROM job_user_limits AS limits
+                              WHERE limits.username = job.username), ?)
+            ORDER BY priority DESC, submitted_at, job_id
+            LIMIT 1
+            """,
+            (now, JOB_MAX_RUNNING_PER_USER)
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                """
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, progress = 0, message = 'Starting',
+                                started_at = ?, heartbeat_at = ?, worker_id = ?
+                WHERE job_id = ?
+                """,
+                (now, now, worker_id, row[0])
+            )
+    return row
 
 
-def calculate_operating_expenses(project_data, year, rent_option):
-    if year == 0:
-        # Construction Rent based on the selected rent option for Year 0
-        if rent_option == "Flat Lease/Year":
-            construction_rent = project_data['construction_rent']
-        elif rent_option == "$/Acre + Escalation":
-            construction_rent = project_data['construction_rent'] * project_data['site_acres']
-        elif rent_option == "$/MW-ac + Escalation":
-            construction_rent = project_data['construction_rent'] * project_data['project_size_ac']
-        
-        # Return total operating expenses for Year 0 (only construction rent)
-        return construction_rent
-    
-    # Initialize other expenses to zero for Year 1 onwards
-    om_cost = 0
-    asset_management = 0
-    insurance = 0
-    property_tax = 0
-    inverter_replacement = 0
-    rent = 0
-    
-    # Property Tax and Rent start from Year 1
-    property_tax_escalation_factor = (1 + project_data['property_tax_escalation']) ** (year - 1)
-    property_tax = project_data['property_tax'] * project_data['site_acres'] * property_tax_escalation_factor
+def heartbeat_job(job_id, worker_id, progress, message, db_path=JOB_QUEUE_PATH):
+    """
+    Record a running job's progress. Returns the job's status, or None if the job is no longer
+    held by this worker.
+    """
+    now = time.time()
+    with closing(connect_job_queue(db_path)) as conn, conn:
+        conn.execute(
+            """
+            UPDATE jobs SET progress = ?, message = ?, heartbeat_at = ?
+            WHERE job_id = ? AND worker_id = ? AND status = 'running'
+            """,
+            (progress, message, now, job_id, worker_id)
+        )
+        conn.execute('UPDATE job_workers SET heartbeat_at = ? WHERE worker_id = ?', (now, worker_id))
+        row = conn.execute('SELECT status FROM jobs WHERE job_id = ? AND worker_id = ?', (job_id, worker_id)).fetchone()
+    return None if row is None else row[0]
 
-    # Rent calculation based on the selected operating rent option
-    if rent_option == "Flat Lease/Year":
-        rent_escalation = (1 + project_data['rent_escalation']) ** (year - 1)
-        rent = project_data['operating_rent'] * rent_escalation
 
-    elif rent_option == "$/Acre + Escalation":
-        rent_escalation_factor = (1 + project_data['rent_escalation']) ** (year - 1)
-        rent = project_data['operating_rent'] * project_data['site_acres'] * rent_escalation_factor
+def finish_job(job_id, worker_id, result=None, error=None, db_path=JOB_QUEUE_PATH):
+    """
+    Store a job's outcome. Jobs returning None were cancelled; failed jobs are requeued with
+    exponential backoff until they run out of attempts.
+    """
+    now = time.time()
+    with closing(connect_job_queue(db_path)) as conn, conn:
+        if error is not None:
+            conn.execute(
+                """
+                UPDATE jobs SET
+                    status = CASE WHEN status = 'cancelling' THEN 'cancelled'
+                                  WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                    finished_at = CASE WHEN status = 'running' AND attempts < max_attempts THEN NULL ELSE ? END,
+                    run_after = ? + ? * (1 << (attempts - 1)),
+                    error = ?,
+                    message = CASE WHEN status = 'running' AND attempts < max_attempts THEN 'Waiting to retry'
+                                   ELSE 'Failed' END,
+                    worker_id = NULL
+                WHERE job_id = ? AND worker_id = ?
+                """,
+                (now, now, JOB_RETRY_DELAY_SECONDS, error, job_id, worker_id)
+            )
+        elif result is None:
+            conn.execute(
+                """
+                UPDATE jobs SET status = 'cancelled', message = 'Cancelled', finished_at = ?, worker_id = NULL
+                WHERE job_id = ? AND worker_id = ?
+                """,
+                (now, job_id, worker_id)
+            )
+        else:
+            conn.execute(
+                """
+                UPDATE jobs SET status = 'succeeded', progress = 1, message = 'Done', result = ?, error = NULL,
+                                finished_at = ?, worker_id = NULL
+                WHERE job_id = ? AND worker_id = ?
+                """,
+                (pickle.dumps(result), now, job_id, worker_id)
+            )
 
-    elif rent_option == "$/MW-ac + Escalation":
-        rent_escalation = (1 + project_data['rent_escalation']) ** (year - 1)
-        rent = project_data['operating_rent'] * project_data['project_size_ac'] * rent_escalation
 
-    # Asset management cost escalates annually
-    asset_management_escalation_factor = (1 + project_data['asset_management_escalation']) ** (year - 1)
-    asset_management = project_data['asset_management_cost'] * project_data['project_size_dc'] * 1000 * asset_management_escalation_factor
+def cancel_job(job_id, username, db_path=JOB_QUEUE_PATH):
+    """
+    Cancel one of username's jobs. Queued jobs are cancelled straight away; running jobs stop
+    at their next progress checkpoint.
+    """
+    with closing(connect_job_queue(db_path)) as conn, conn:
+        conn.execute(
+            """
+            UPDATE jobs SET
+                status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE 'cancelling' END,
+                finished_at = CASE WHEN status = 'queued' THEN ? END,
+                message = CASE WHEN status = 'queued' THEN 'Cancelled' ELSE 'Cancelling' END
+            WHERE job_id = ? AND username = ? AND status IN ('queued', 'running')
+            """,
+            (time.time(), job_id, username)
+        )
 
-    # Other Asset Management cost escalates annually
-    other_asset_management_escalation_factor = (1 + project_data['other_asset_management_escalation']) ** (year - 1)
-    other_asset_management = project_data['other_asset_management_cost'] * project_data['project_size_dc'] * 1000 * other_asset_management_escalation_factor
 
-    
-    # Insurance cost per MW-DC, no escalation assumed
-    insurance = project_data['insurance_cost'] * project_data['project_size_dc'] * 1000  # Assuming insurance cost starts from Year 1
-    
-    if year >= 2:
-        # O&M Costs start from Year 2 with escalation
-        om_escalation_factor = (1 + project_data['om_escalation']) ** (year - 2)
-        om_cost = project_data['om_cost'] * project_data['project_size_dc'] * 1000 * om_escalation_factor
-        
-    # Inverter Replacement costs apply only between Year 6 and Year 15, based on MW-AC
-    if 6 <= year <= 15:
-        inverter_replacement = project_data['inverter_replacement_cost'] * project_data['project_size_ac'] * 1000
-    
-    # Sum up all operating expenses
-    total_opex = om_cost + asset_management + insurance + property_tax + inverter_replacement + rent + other_asset_management
-    
-    return total_opex
+def retry_job(job_id, username, db_path=JOB_QUEUE_PATH):
+    """
+    Queue one of username's failed or cancelled jobs again, with a fresh set of attempts.
+    """
+    now = time.time()
+    with closing(connect_job_queue(db_path)) as conn, conn:
+        conn.execute(
+            """
+            UPDATE jobs SET status = 'queued', attempts = 0, progress = 0, message = 'Queued', error = NULL,
+                            run_after = ?, started_at = NULL, finished_at = NULL
+            WHERE job_id = ? AND username = ? AND status IN ('failed', 'cancelled')
+            """,
+            (now, job_id, username)
+        )
 
 
+def list_jobs(username=None, limit=JOB_LIST_LIMIT, db_path=JOB_QUEUE_PATH):
+    """
+    Summary of the most recent jobs, of one user or of everyone.
+    """
+    where = 'WHERE username = ?' if username is not None else ''
+    params = [username] if username is not None else []
+    query = f"""
+        SELECT job_id, username, kind, label, priority, status, attempts, max_attempts, progress, message,
+               error, submitted_at, started_at, finished_at
+        FROM jobs {where}
+        ORDER BY job_id DESC
+        LIMIT ?
+    """
+    with closing(connect_job_queue(db_path)) as conn:
+        return pd.read_sql_query(query, conn, params=params + [limit])
 
 
-def calculate_tax_equity(project_data):
-    # Calculate Total CapEx (including all components)
-    total_capex = calculate_capex(project_data)
-    
-    # Calculate ITC Eligible CapEx (excluding Transaction Costs)
-    itc_eligible_capex = (project_data['epc_cost'] + project_data['interconnection_cost'] + 
-                          project_data['developer_fee']) * project_data['project_size_dc'] * 1e6
-    
-    # Calculate ITC (Investment Tax Credit)
-    itc = itc_eligible_capex * project_data['itc_amount'] * project_data['itc_eligible_portion']
-    
-    # Calculate FMV (Fair Market Value) with step-up
-    fmv = itc * (1 + project_data['fmv_step_up'])  # FMV Step-up applied on ITC
-    
-    # Calculate Tax Equity Investment based on ITC and a multiplier
-    te_investment = itc * project_data['te_investment']
-    
-    # Display ITC and FMV values for debugging or informational purposes
-    print(f"Calculated ITC Eligible CapEx: ${itc_eligible_capex:,.2f}")
-    print(f"Calculated ITC: ${itc:,.2f}")
-    print(f"Calculated FMV: ${fmv:,.2f}")
-    
-    # Return the calculated values
-    return {'itc': itc, 'fmv': fmv, 'te_investment': te_investment}
+def fetch_job_result(job_id, username, db_path=JOB_QUEUE_PATH):
+    """
+    Return (kind, result) of one of username's succeeded jobs.
+    """
+    with closing(connect_job_queue(db_path)) as conn:
+        row = conn.execute(
+            "SELECT kind, result FROM jobs WHERE job_id = ? AND username = ? AND status = 'succeeded'",
+            (job_id, username)
+        ).fetchone()
+    if row is None:
+        raise KeyError(f"Job {job_id} has no result")
+    return row[0], pickle.loads(row[1])
 
 
-def calculate_cash_flows(project_data, rent_option, state):
-    capex = calculate_capex(project_data)
-    tax_equity = calculate_tax_equity(project_data)
-    
-    cash_flows = []
-    total_years = 1 + project_data['ppa_tenor'] + project_data['post_ppa_tenor']
-    total_preferred_return = 0
-
-    for year in range(total_years):
-        if year == 0:
-            # Construction year
-            revenue = 0
-            opex = calculate_operating_expenses(project_data, year, rent_option)
-            EBITDA = revenue - opex
-            cash_flow = EBITDA - capex + tax_equity['fmv']
-        else:
-            revenue = calculate_revenue(project_data, year, state)
-            opex = calculate_operating_expenses(project_data, year, rent_option)
-            EBITDA = revenue - opex
+def run_job(job_id, kind, args, worker_id, db_path=JOB_QUEUE_PATH):
+    """
+    Run one claimed job. A heartbeat thread copies the task's progress to the queue and sets
+    its cancel flag when the job is cancelled, so report_progress() stops the job.
+    """
+    task = {'name': kind, 'cancel': threading.Event(), 'progress': 0.0, 'message': 'Starting'}
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(JOB_HEARTBEAT_SECONDS):
+            if heartbeat_job(job_id, worker_id, task['progress'], task['message'], db_path) != 'running':
+                task['cancel'].set()
+
+    thread = threading.Thread(target=heartbeat, name=f'job-{job_id}-heartbeat', daemon=True)
+    thread.start()
+    result, error = None, None
+    try:
+        result = JOB_FUNCTIONS[kind](task, *pickle.loads(args))
+    except Exception as exception:
+        error = f'{type(exception).__name__}: {exception}'
+    finally:
+        stopped.set()
+        thread.join()
+    finish_job(job_id, worker_id, result, error, db_path)
+
+
+def run_job_worker(worker_id=None, db_path=JOB_QUEUE_PATH, poll_seconds=JOB_POLL_SECONDS, stop_event=None):
+    """
+    Worker loop: claim and run jobs one at a time until stop_event is set.
+    """
+    worker_id = worker_id or f'{os.getpid()}-{os.urandom(4).hex()}'
+    stop_event = stop_event or threading.Event()
+    try:
+        while not stop_event.is_set():
+            with closing(connect_job_queue(db_path)) as conn, conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO job_workers (worker_id, pid, heartbeat_at) VALUES (?, ?, ?)',
+                    (worker_id, os.getpid(), time.time())
+                )
+            job = claim_job(worker_id, db_path)
+            if job is None:
+                stop_event.wait(poll_seconds)
+            else:
+                run_job(*job, worker_id, db_path)
+    finally:
+        with closing(connect_job_queue(db_path)) as conn, conn:
+            conn.execute('DELETE FROM job_workers WHERE worker_id = ?', (worker_id,))
 
-            # CapEx is zero in operating years
-            capex_year = 0
 
-            # Tax equity distributions
-            if year <= project_data['buyout_year']:
-                te_distribution = -tax_equity['fmv'] * project_data['preferred_return']
-                total_preferred_return += -te_distribution
-            else:
-                te_distribution = 0
+def ensure_job_workers(workers=JOB_WORKERS, db_path=JOB_QUEUE_PATH):
+    """
+    Start worker processes until `workers` are alive. Workers run detached from the app, so
+    queued jobs keep running when the app or the browser session goes away.
+    """
+    if not JOB_WORKER_AUTOSTART:
+        return
+    now = time.time()
+    with closing(connect_job_queue(db_path)) as conn, conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM job_workers WHERE heartbeat_at < ?', (now - JOB_STALE_SECONDS,))
+        alive = conn.execute('SELECT COUNT(*) FROM job_workers').fetchone()[0]
+        for _ in range(workers - alive):
+            worker_id = f'{os.getpid()}-{os.urandom(4).hex()}'
+            process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--job-worker', worker_id],
+                env={**os.environ, 'JOB_QUEUE_PATH': os.path.abspath(db_path)},
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+            # Registered here, so reruns before the worker has started don't start another one
+            conn.execute(
+                'INSERT INTO job_workers (worker_id, pid, heartbeat_at) VALUES (?, ?, ?)',
+                (worker_id, process.pid, now)
+            )
 
-            if year == project_data['buyout_year']:
-                buyout_cost = -tax_equity['fmv'] * project_data['buyout_percentage']
-            else:
-                buyout_cost = 0
 
-            tax_equity_cash_flow = te_distribution + buyout_cost
-            cash_flow = EBITDA - capex_year + tax_equity_cash_flow
+def render_pipeline_job(result, key_prefix=''):
+    manifest = result['manifest']
+    st.caption(f"{manifest['projects']:,} projects evaluated and {manifest['errors']:,} rejected; "
+               f"Parquet output in {result['output_dir']}.")
+    render_stream_metrics(result['stats'])
 
-        cash_flows.append(cash_flow)
 
-    remaining_itc_cash_flows = tax_equity['fmv'] - total_preferred_return - (tax_equity['fmv'] * project_data['buyout_percentage'])
+JOB_RENDERERS = {
+    **ANALYTICS_RENDERERS,
+    'Portfolio': render_portfolio,
+    'Portfolio Pipeline': render_pipeline_job,
+}
 
-    return cash_flows, remaining_itc_cash_flows
 
+@st.fragment(run_every=ANALYTICS_POLL_SECONDS)
+def render_job_queue(username):
+    st.subheader('Queued Jobs')
+    for job in list_jobs(username).itertuples(index=False):
+        col1, col2 = st.columns([4, 1])
+        if job.status in ('queued', 'running', 'cancelling'):
+            col1.progress(job.progress, text=f"#{job.job_id} {job.label}: {job.message}")
+            if job.status != 'cancelling' and col2.button('Cancel', key=f'cancel_job_{job.job_id}'):
+                cancel_job(job.job_id, username)
+        elif job.status == 'succeeded':
+            col1.success(f"#{job.job_id} {job.label}: done")
+            if col2.button('Show', key=f'show_job_{job.job_id}'):
+                st.session_state['job_result'] = (job.job_id, *fetch_job_result(job.job_id, username))
+                st.rerun()
+        else:
+            col1.error(f"#{job.job_id} {job.label}: {job.status} after {job.attempts} attempt(s). {job.error or ''}")
+            if col2.button('Retry', key=f'retry_job_{job.job_id}'):
+                retry_job(job.job_id, username)
+
+
+# Scenario comparison
+# Up to COMPARE_MAX_SCENARIOS results can be pinned side by side. A pinned scenario keeps the
+# results dict it was pinned with (the last result shown, a saved scenario or a result cache
+# hit), so the comparison never runs the model. Annual rows are aligned by calendar year, and
+# deltas are taken against a chosen baseline scenario.
+COMPARE_MAX_SCENARIOS = 4
+COMPARE_METRICS = [
+    ('irr', 'Unlevered IRR', 'percent'),
+    ('levered_irr', 'Levered IRR', 'percent'),
+    ('npv', 'NPV', 'dollar'),
+    ('saved_npv', 'Saved NPV', 'dollar'),
+    ('lcoe', 'LCOE ($/MWh)', 'price'),
+    ('unlevered_capex', 'Unlevered CapEx', 'dollar'),
+    ('total_revenue', 'Total Revenue', 'dollar'),
+    ('total_ebitda', 'Total EBITDA', 'dollar'),
+    ('total_taxes', 'Total Taxes', 'dollar'),
+    ('savings_notional', 'Savings Notional', 'dollar'),
+    ('payback_years', 'Payback (years)', 'years'),
+    ('discounted_payback_years', 'Discounted Payback (years)', 'years'),
+]
+
+
+def scenario_label(project_data):
+    return f"{project_data['state']} {project_data['project_size_dc']:g} MW-dc, PPA ${project_data['ppa_rate']:,.2f}"
+
+
+def pin_scenario(pinned, project_data, results, label=None, max_pinned=COMPARE_MAX_SCENARIOS):
+    """
+    Pin a result for comparison. Pinning the same inputs again only relabels the pin. Returns
+    False when max_pinned scenarios are already pinned.
+    """
+    scenario_id = hash_project_data(project_data)
+    for scenario in pinned:
+        if scenario['scenario_id'] == scenario_id:
+            scenario['label'] = label or scenario['label']
+            return True
+    if len(pinned) >= max_pinned:
+        return False
+    pinned.append({
+        'scenario_id': scenario_id,
+        'label': label or scenario_label(project_data),
+        'project_data': project_data,
+        'results': results,
+    })
+    return True
+
+
+def comparison_names(pinned):
+    # Numbered, so scenarios with the same label stay separate columns
+    return [f"{index + 1}. {scenario['label']}" for index, scenario in enumerate(pinned)]
+
+
+def format_comparison_value(value, kind, delta=False):
+    if value is None or not np.isfinite(value):
+        return 'N/A'
+    if kind == 'percent':
+        return f'{value:+.2%}' if delta else f'{value:.2%}'
+    if kind == 'price':
+        return f'{value:+,.2f}' if delta else f'${value:,.2f}'
+    if kind == 'years':
+        return f'{value:+.0f}' if delta else f'{value:.0f}'
+    if delta:
+        return ('+' if value > 0 else '-' if value < 0 else '') + format_hover_value(abs(value))
+    return format_hover_value(value)
+
+
+def comparison_metrics_table(pinned, baseline=0):
+    """
+    Key metrics of the pinned scenarios (one column each) and their differences from the
+    baseline scenario, formatted for display.
+    """
+    names = comparison_names(pinned)
+    table = {'Metric': [label for _, label, _ in COMPARE_METRICS]}
+    values = []
+    for scenario in pinned:
+        metrics = scenario['results']['metrics']
+        scenario_values = []
+        for metric, _, kind in COMPARE_METRICS:
+            value = metrics.get(metric)
+            # Paybacks and the flip year are text ('Not achieved') when they never happen
+            if value is None or isinstance(value, str):
+                value = np.nan
+            scenario_values.append(float(value))
+        values.append(scenario_values)
+    for name, scenario_values in zip(names, values):
+        table[name] = [format_comparison_value(value, kind) for value, (_, _, kind) in zip(scenario_values, COMPARE_METRICS)]
+    for index, (name, scenario_values) in enumerate(zip(names, values)):
+        if index == baseline:
+            continue
+        table[f'Δ {name}'] = [
+            format_comparison_value(value - base, kind, delta=True)
+            for value, base, (_, _, kind) in zip(scenario_values, values[baseline], COMPARE_METRICS)
+        ]
+    return pd.DataFrame(table)
 
-def calculate_irr(cash_flows):
-    return npf.irr(cash_flows)
 
-def plot_cash_flows(df):
+def comparison_annual_table(pinned, column, baseline=0):
+    """
+    One annual column of every pinned scenario, aligned by calendar year, with differences from
+    the baseline scenario. Years outside a scenario's life are empty.
+    """
+    names = comparison_names(pinned)
+    series = []
+    for name, scenario in zip(names, pinned):
+        revenue_df = scenario['results']['revenue_df']
+        body = revenue_df[revenue_df['Year'] != 'Total']
+        series.append(pd.Series(body[column].to_numpy(dtype=float), index=body['Year'].astype(int), name=name))
+    table = pd.concat(series, axis=1).sort_index()
+    table.index.name = 'Year'
+    for index, name in enumerate(names):
+        if index != baseline:
+            table[f'Δ {name}'] = table[name] - table[names[baseline]]
+    return table
+
+
+def plot_comparison_annual(annual_table, names, column):
     fig = go.Figure()
-    fig.add_trace(go.Scatter(x=df['Year'], y=df['Cash Flow'], mode='lines+markers', name='Annual Cash Flow'))
-    fig.add_trace(go.Scatter(x=df['Year'], y=df['Cumulative Cash Flow'], mode='lines+markers', name='Cumulative Cash Flow'))
+    for name in names:
+        fig.add_trace(go.Scatter(
+            x=annual_table.index,
+            y=annual_table[name],
+            mode='lines+markers',
+            name=name,
+            hovertemplate='%{x}: %{y:,.2f}<extra>%{fullData.name}</extra>'
+        ))
     fig.update_layout(
-        title='Project Cash Flows',
+        title=f'{column} by Year',
         xaxis_title='Year',
-        yaxis_title='Cash Flow ($)',
-        hovermode='x unified'
+        yaxis_title=column,
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1)
     )
     return fig
 
-def generate_revenue_table(project_data, rent_option, state):
-    data = []
-    start_year = project_data['construction_start'].year
-    total_years = 1 + project_data['ppa_tenor'] + project_data['post_ppa_tenor']
-    capex = calculate_capex(project_data)
-    tax_equity = calculate_tax_equity(project_data)
-    total_preferred_return = 0
-
-    for year in range(total_years):
-        current_year = start_year + year
-
-        if year == 0:
-            # Year 0 (Construction Year)
-            net_production = 0
-            price = 0
-            rec_price = 0
-            total_price = 0
-            avoided_price = 0
-            revenue_type = 'Construction'
-            savings = 0
-            opex = calculate_operating_expenses(project_data, year, rent_option)
-            EBITDA = -opex
-            total_cash_flow = EBITDA - capex + tax_equity['fmv']
-        else:
-            net_production = calculate_annual_production(project_data, year)
-
-            # Determine base price (PPA or Merchant)
-            if year <= project_data['ppa_tenor']:
-                # PPA term
-                price = project_data['ppa_rate'] * (1 + project_data['ppa_escalation']) ** (year - 1)
-                avoided_price = project_data['avoided_cost_ppa_price'] * (1 + project_data['avoided_cost_escalation']) ** (year - 1)
-                revenue_type = 'PPA'
-            else:
-                # Merchant years
-                merchant_year = start_year + year - 1
-                try:
-                    index = merchant_price_curves[state]['years'].index(merchant_year)
-                    price = merchant_price_curves[state]['prices'][index]
-                except ValueError:
-                    price = merchant_price_curves[state]['prices'][-1]
-                avoided_price = price  # After PPA, avoided cost price equals merchant price
-                revenue_type = 'Merchant'
-
-            # Get REC price based on the year
-            if 1 <= year <= 5:
-                rec_price = project_data['rec_price_years_1_5']
-            elif 6 <= year <= 10:
-                rec_price = project_data['rec_price_years_6_10']
-            elif 11 <= year <= 15:
-                rec_price = project_data['rec_price_years_11_15']
-            else:
-                rec_price = 0  # No REC revenue after year 15
 
-            # Adjust revenue type if REC is included
-            if rec_price > 0:
-                revenue_type += ' + REC'
+def render_comparison(pinned):
+    st.subheader('Scenario Comparison')
+    names = comparison_names(pinned)
+    baseline = st.selectbox('Baseline Scenario', range(len(pinned)), format_func=lambda index: names[index],
+                            help='Deltas are shown against this scenario.')
+    st.dataframe(comparison_metrics_table(pinned, baseline), hide_index=True)
 
-            # Total price including REC
-            total_price = price + rec_price
+    annual_columns = [column for column in pinned[0]['results']['revenue_df'].columns
+                      if column not in ('Year', 'Revenue Type')
+                      and all(column in scenario['results']['revenue_df'] for scenario in pinned)]
+    annual_column = st.selectbox('Annual Values', annual_columns, index=annual_columns.index('Total Cash Flows ($)'))
+    annual_table = comparison_annual_table(pinned, annual_column, baseline)
+    st.plotly_chart(plot_comparison_annual(annual_table, names, annual_column), key='chart_comparison')
+    st.dataframe(annual_table, column_config={
+        column: st.column_config.NumberColumn(format='localized') for column in annual_table.columns
+    })
 
-            # Revenue calculation
-            revenue = net_production * total_price / 1000  # Convert kWh to MWh
-            # Add incentive amount at COD (Year 1)
-            if year == 1:
-                revenue += project_data['incentive_amount']
 
-            # Operating Expenses
-            opex = calculate_operating_expenses(project_data, year, rent_option)
-            EBITDA = revenue - opex
+def render_results(results):
+    metrics = results['metrics']
+    carbon_offsets = results['carbon_offsets']
+    revenue_df = results['revenue_df']
+    cash_flows = results['cash_flows']
+    irr = metrics['irr']
+    irr_label = 'After-Tax Unlevered IRR' if metrics.get('after_tax') else 'Unlevered IRR'
 
-            # CapEx is zero in operating years
-            capex_year = 0
+    st.success(f'The project {irr_label} is: {irr*100:.2f}%')
 
-            # Tax equity distributions
-            if year <= project_data['buyout_year']:
-                te_distribution = -tax_equity['fmv'] * project_data['preferred_return']
-                total_preferred_return += -te_distribution
-            else:
-                te_distribution = 0
+    # Display Key Metrics
 
-            if year == project_data['buyout_year']:
-                buyout_cost = -tax_equity['fmv'] * project_data['buyout_percentage']
-            else:
-                buyout_cost = 0
-
-            tax_equity_cash_flow = te_distribution + buyout_cost
-            total_cash_flow = EBITDA - capex_year + tax_equity_cash_flow
-
-            # Savings calculation (excluding REC price)
-            savings = (avoided_price - price) * net_production / 1000
-
-        data.append({
-            'Year': current_year,
-            'Net Production (MWh)': net_production / 1000 if year > 0 else 0,
-            'Our Price ($/MWh)': total_price if year > 0 else 0,
-            'Avoided Cost Price ($/MWh)': avoided_price if year > 0 else 0,
-            'Revenue Type': revenue_type,
-            'Revenue ($)': revenue if year > 0 else 0,
-            'Operating Expenses ($)': opex,
-            'EBITDA ($)': EBITDA,
-            'Total Cash Flows ($)': total_cash_flow,
-            'Savings Unlocked ($)': savings
-        })
+    st.subheader("Key Metrics")
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric(irr_label, f"{irr*100:.2f}%", help='Internal Rate of Return without considering debt financing.')
+    with col2:
+        st.metric("Total Revenue", f"${metrics['total_revenue'] / 1e6:,.2f}MM", help='Total revenue over the project lifetime.')
+    with col3:
+        st.metric("Total EBITDA", f"${metrics['total_ebitda'] / 1e6:,.2f}MM", help='Earnings Before Interest, Taxes, Depreciation, and Amortization over the project lifetime.')
+    with col4:
+        st.metric("Unlevered CapEx", f"${metrics['unlevered_capex'] / 1e6:,.2f}MM", help='Total capital expenditure minus tax equity FMV.')
+
+    col5, col6, col7, col8 = st.columns(4)
+    with col5:
+        st.metric("NPV", f"${metrics['npv'] / 1e6:,.2f}MM", help='Net Present Value of the project.')
+    with col6:
+        st.metric("Saved NPV", f"${metrics['saved_npv'] / 1e6:,.2f}MM", help='Increase in NPV due to tax equity financing.')
+    with col7:
+        st.metric("Savings Notional", f"${metrics['savings_notional'] / 1e6:,.2f}MM", help='Total savings unlocked for the customer.')
+    with col8:
+        st.metric("Payback Period", f"{metrics['payback_years']} years", help='Number of years to recover the initial investment.')
+
+    col9, col10, col11, col12 = st.columns(4)
+    with col9:
+        st.metric("LCOE ($/MWh)", f"${metrics['lcoe']:,.2f}", help='Levelized Cost of Energy.')
+    if 'discounted_payback_years' in metrics:
+        with col12:
+            st.metric("Discounted Payback", f"{metrics['discounted_payback_years']} years", help='Number of years to recover the initial investment from discounted cash flows.')
+    if metrics.get('te_structure') == 'Partnership Flip':
+        with col11:
+            st.metric("Flip Year", f"{metrics['flip_year']}", help='Year in which the tax equity investor reaches its target yield and allocations flip.')
+    if metrics.get('after_tax'):
+        with col10:
+            st.metric("Total Income Taxes", f"${metrics['total_taxes'] / 1e6:,.2f}MM", help='Income taxes net of MACRS and bonus depreciation over the project lifetime.')
+
+    if metrics.get('include_debt'):
+        col13, col14, col15, col16 = st.columns(4)
+        with col13:
+            st.metric("Levered IRR", f"{metrics['levered_irr']*100:.2f}%", help='Equity IRR after sculpted term debt.')
+        with col14:
+            st.metric("Debt Size", f"${metrics['debt_size'] / 1e6:,.2f}MM", help='Term debt sized by sculpting debt service to the target DSCR.')
+        # Scenarios saved before these metrics existed don't have them
+        with col15:
+            st.metric("Leverage", f"{metrics['leverage']:.1%}" if 'leverage' in metrics else 'N/A',
+                      help='Debt size as a share of total capex.')
+        with col16:
+            st.metric("Debt Service Years", f"{metrics['debt_service_years']:.0f}" if 'debt_service_years' in metrics else 'N/A',
+                      help='Years with debt service: the debt tenor, cut short by the end of operations.')
+
+
+    st.divider()
+
+
+    st.subheader("Environmental Impact")
+
+    # First row of metrics
+    col_env1, col_env2, col_env3 = st.columns(3)
+    with col_env1:
+        st.metric(
+            label="Total CO₂ Avoided",
+            value=f"{carbon_offsets['total_co2_avoided_metric_tons']:,.2f} metric tons",
+            help="Total CO₂ emissions avoided over the project lifetime."
+        )
+    with col_env2:
+        st.metric(
+            label="Equivalent Trees Planted",
+            value=f"{int(carbon_offsets['equivalent_trees']):,}",
+            help="Equivalent number of mature trees needed to absorb the same amount of CO₂."
+        )
+    with col_env3:
+        st.metric(
+            label="Equivalent Cars Off the Road",
+            value=f"{carbon_offsets['equivalent_cars']:,.2f}",
+            help="Equivalent number of cars taken off the road for one year."
+        )
+
+    # Second row of metrics
+    col_env4, col_env5, col_env6 = st.columns(3)
+    with col_env4:
+        st.metric(
+            label="Households Powered for a Year",
+            value=f"{int(carbon_offsets['equivalent_households']):,}",
+            help="Equivalent number of households powered for one year."
+        )
+    with col_env5:
+        st.metric(
+            label="Miles Not Driven",
+            value=f"{int(carbon_offsets['equivalent_miles']):,} miles",
+            help="Equivalent miles not driven by an average passenger vehicle."
+        )
 
-    revenue_df = pd.DataFrame(data)
 
-    # Add totals row
-    totals = revenue_df.select_dtypes(include=[np.number]).sum()
-    totals['Year'] = 'Total'
-    totals['Revenue Type'] = ''
-    revenue_df = pd.concat([revenue_df, totals.to_frame().T], ignore_index=True)
+    if 'Net Production (MWh)' in revenue_df and len(revenue_df) > 2:
+        with st.expander("Hourly Production Profile (Year 1)", expanded=False):
+            year_one_production = revenue_df['Net Production (MWh)'].iloc[1]
+            st.plotly_chart(plot_hourly_profile(
+                {'Net Production': year_one_production * SOLAR_PRODUCTION_SHAPE},
+                'Typical Year 1 Hourly Production',
+                'Production (MWh)',
+                start=f"{revenue_df['Year'].iloc[1]}-01-01",
+            ))
 
-    return revenue_df
-    
- #flag
 
-def calculate_lcoe(project_data, discount_rate, revenue_df):
-    npv_costs = 0
-    npv_production = 0
-    for index, row in revenue_df.iterrows():
-        if row['Year'] == 'Total':
-            continue
-        year = row['Year'] - project_data['construction_start'].year
-        discount_factor = (1 + discount_rate) ** year
-        # Costs include operating expenses
-        opex = row['Operating Expenses ($)']
-        # Add capex in year 0
-        if year == 0:
-            capex = calculate_capex(project_data)
-            total_cost = capex + opex
-        else:
-            total_cost = opex
-        npv_costs += total_cost / discount_factor
-        # Net production in MWh
-        net_production = row['Net Production (MWh)']
-        npv_production += net_production / discount_factor
-    # Now calculate LCOE
-    lcoe = npv_costs / npv_production  # $/MWh
-    return lcoe
+    st.divider()
+
+
+
+    # Display Revenue Table at the Bottom
+    st.subheader("Annual Project Details")
+    st.dataframe(revenue_df, column_config=annual_table_column_config(revenue_df))
+
+
+
+    # Plot Cash Flows
+    cash_flow_df = pd.DataFrame({
+        'Year': revenue_df['Year'][:-1],  # Exclude 'Total' row for plotting
+        'Cash Flow': cash_flows,
+        'Cumulative Cash Flow': np.cumsum(cash_flows)
+    })
+    st.plotly_chart(plot_cash_flows(cash_flow_df))
+
+    # Plot Stacked Savings Chart
+    st.plotly_chart(plot_stacked_savings_chart(revenue_df))
+
+
+    # Optional: Provide a download button for the revenue table
+    csv = revenue_df.to_csv(index=False)
+    st.download_button(
+        label="Download Revenue Table as CSV",
+        data=csv,
+        file_name='revenue_table.csv',
+        mime='text/csv',
+    )
 
 
 def main():
@@ -746,6 +4207,25 @@ def main():
                 disabled=False,
                 help='Enter the discount rate used for NPV and LCOE calculations.'
             ) / 100
+            discount_curve_names = list(load_discount_curves())
+            discount_curve_option = st.selectbox(
+                'Discount Curve',
+                ['Flat Discount Rate'] + discount_curve_names + ['Custom (per year)'],
+                help='Discount NPV, LCOE and payback with a per-year curve instead of the flat rate.'
+            )
+            discount_curve = None
+            if discount_curve_option == 'Custom (per year)':
+                custom_rates = st.text_input(
+                    'Discount Rates by Year (%)',
+                    value='',
+                    help='Comma-separated spot rates for year 1, 2, ...; the last rate is used for later years.'
+                )
+                try:
+                    discount_curve = [float(rate) / 100 for rate in custom_rates.split(',') if rate.strip()] or None
+                except ValueError:
+                    st.error('Discount rates must be comma-separated numbers.')
+            elif discount_curve_option != 'Flat Discount Rate':
+                discount_curve = discount_curve_option
             production_yield = st.number_input(
                 'Production Yield (kWh/kWp)',
                 value=1350,
@@ -984,6 +4464,20 @@ def main():
                 disabled=disabled_input,
                 help='Enter the applicable tax rate.'
             ) / 100
+            after_tax = st.checkbox(
+                'After-Tax Cash Flows',
+                value=False,
+                disabled=disabled_input,
+                help='Deduct income taxes (with MACRS 5-year and bonus depreciation) from project cash flows.'
+            )
+            bonus_depreciation = st.number_input(
+                'Bonus Depreciation (%)',
+                value=0.0,
+                min_value=0.0,
+                max_value=100.0,
+                disabled=disabled_input or not after_tax,
+                help='Enter the share of the depreciable basis expensed at COD; the rest follows MACRS 5-year.'
+            ) / 100
 
 
         with st.sidebar.expander("CapEx Inputs", expanded=False):
@@ -1071,6 +4565,79 @@ def main():
                 disabled=disabled_input,
                 help='Enter the percentage of FMV for the buyout price.'
             ) / 100
+            te_structure = st.radio(
+                'Tax Equity Structure',
+                options=['Fixed Buyout', 'Partnership Flip'],
+                index=0,
+                disabled=disabled_input,
+                help='Fixed Buyout uses FMV, preferred return and buyout; Partnership Flip splits cash and tax benefits until the investor reaches its target yield.'
+            )
+            flip_disabled = disabled_input or te_structure != 'Partnership Flip'
+            te_target_yield = st.number_input(
+                'Investor Target Yield (%)',
+                value=7.0,
+                min_value=0.0,
+                max_value=30.0,
+                disabled=flip_disabled,
+                help='Enter the after-tax yield at which the partnership flips.'
+            ) / 100
+            pre_flip_cash_share = st.number_input(
+                'Pre-Flip Investor Cash Share (%)',
+                value=30.0,
+                min_value=0.0,
+                max_value=100.0,
+                disabled=flip_disabled,
+                help='Enter the share of cash distributed to the investor before the flip.'
+            ) / 100
+            pre_flip_tax_share = st.number_input(
+                'Pre-Flip Investor Tax Share (%)',
+                value=99.0,
+                min_value=0.0,
+                max_value=100.0,
+                disabled=flip_disabled,
+                help='Enter the share of the ITC and taxable income allocated to the investor before the flip.'
+            ) / 100
+            post_flip_share = st.number_input(
+                'Post-Flip Investor Share (%)',
+                value=5.0,
+                min_value=0.0,
+                max_value=100.0,
+                disabled=flip_disabled,
+                help='Enter the investor share of cash and tax items after the flip.'
+            ) / 100
+
+        with st.sidebar.expander("Debt Inputs", expanded=False):
+            # Term debt sculpted to a target DSCR
+            include_debt = st.checkbox(
+                'Include Term Debt',
+                value=False,
+                disabled=disabled_input,
+                help='Size term debt by sculpting debt service to the target DSCR and report levered returns.'
+            )
+            debt_tenor = st.number_input(
+                'Debt Tenor (years)',
+                value=15,
+                min_value=1,
+                max_value=30,
+                disabled=disabled_input or not include_debt,
+                help='Enter the term of the debt in years from COD.'
+            )
+            debt_rate = st.number_input(
+                'Debt Interest Rate (%)',
+                value=6.0,
+                min_value=0.0,
+                max_value=20.0,
+                disabled=disabled_input or not include_debt,
+                help='Enter the annual interest rate on the term debt.'
+            ) / 100
+            target_dscr = st.number_input(
+                'Target DSCR (x)',
+                value=1.30,
+                min_value=1.0,
+                max_value=5.0,
+                disabled=disabled_input or not include_debt,
+                help='Enter the debt service coverage ratio the debt service is sculpted to.'
+            )
 
         with st.sidebar.expander("Other Parameters", expanded=False):
             # Additional Parameters
@@ -1132,17 +4699,29 @@ def main():
             'preferred_return': preferred_return,
             'buyout_year': buyout_year,
             'buyout_percentage': buyout_percentage,
+            'te_structure': te_structure,
+            'te_target_yield': te_target_yield,
+            'pre_flip_cash_share': pre_flip_cash_share,
+            'pre_flip_tax_share': pre_flip_tax_share,
+            'post_flip_share': post_flip_share,
             'cod_date': cod_date,
             'construction_start': construction_start,
             'degradation_start_year': degradation_start_year,
             'ppa_escalation_start_year': ppa_escalation_start_year,
             'tax_rate': tax_rate,
+            'after_tax': after_tax,
+            'bonus_depreciation': bonus_depreciation,
+            'include_debt': include_debt,
+            'debt_tenor': debt_tenor,
+            'debt_rate': debt_rate,
+            'target_dscr': target_dscr,
             'rent_option': rent_option,
             'avoided_cost_ppa_price': avoided_cost_ppa_price,
             'avoided_cost_escalation': avoided_cost_escalation,
             'other_asset_management_cost': other_asset_management_cost,
             'other_asset_management_escalation': other_asset_management_escalation,
             'discount_rate': discount_rate,
+            'discount_curve': discount_curve,
             'state': state,
             'rec_price_years_1_5': rec_price_years_1_5,
             'rec_price_years_6_10': rec_price_years_6_10,
@@ -1150,159 +4729,327 @@ def main():
             'incentive_amount': incentive_amount
         }
 
-        if st.button('Calculate IRR'):
-            # Step 1: Calculate Cash Flows and IRR
-            cash_flows, remaining_itc_cash_flows = calculate_cash_flows(project_data, rent_option, state)
-            irr = calculate_irr(cash_flows)
-            st.success(f'The project Unlevered IRR is: {irr*100:.2f}%')
-            
-            # Step 2: Generate Revenue Table
-            revenue_df = generate_revenue_table(project_data, rent_option, state)
-            # After generating revenue_df
-            lcoe = calculate_lcoe(project_data, discount_rate, revenue_df)
-            carbon_offsets = calculate_carbon_offsets(revenue_df, project_data)
-
+        # Background analytics computed for earlier inputs are cancelled as soon as the inputs change
+        input_key = hash_project_data(project_data)
+        session_tasks = st.session_state.setdefault('analytics_tasks', {})
+        # A fitted surrogate outlives the inputs it was built for, so keep it before stale tasks are dropped
+        surrogate_task = session_tasks.get('What-If Surrogate')
+        if surrogate_task is not None and surrogate_task['future'] is not None and surrogate_task['future'].done() \
+                and surrogate_task['future'].exception() is None and surrogate_task['future'].result() is not None:
+            st.session_state['surrogate'] = surrogate_task['future'].result()
+        cancel_analytics(session_tasks, input_key)
 
+        # Stage outputs are cached per session, so a change to one input only recomputes downstream stages
+        stage_cache = st.session_state.setdefault('stage_cache', {})
 
-            # Step 3: Calculate NPV
-            NPV = npf.npv(discount_rate, cash_flows)
-            
-            # Step 4: Calculate Unlevered CapEx
-            total_capex = calculate_capex(project_data)
-            tax_equity = calculate_tax_equity(project_data)
-            tax_equity_fmv = tax_equity['fmv']
-            unlevered_capex = total_capex - tax_equity_fmv
-
-            # Step 5: Calculate Saved NPV (Assuming Saved NPV is NPV without Tax Equity minus NPV with Tax Equity)
-            # To calculate NPV without Tax Equity, we need to adjust cash flows
-            # Assuming that Tax Equity affects only the initial cash flow (Year 0)
-            # Hence, we subtract tax_equity['fmv'] from Year 0 cash flow
-            cash_flows_no_tax = cash_flows.copy()
-            cash_flows_no_tax[0] += tax_equity_fmv  # Remove the effect of Tax Equity FMV
-            NPV_no_tax = npf.npv(discount_rate, cash_flows_no_tax)
-            saved_NPV = NPV_no_tax - NPV
-
-            # Step 6: Calculate Savings Notional
-            savings_notional = revenue_df.loc[revenue_df['Year'] != 'Total', 'Savings Unlocked ($)'].sum()
-
-            # Step 7: Calculate Payback Period
-            cumulative_cash_flows = np.cumsum(cash_flows)
-            payback_years = next((year for year, cum_cf in enumerate(cumulative_cash_flows) if cum_cf > 0), 'Not achieved')
-
-            # Step 8: Calculate Additional Metrics if needed
-            # (If 'Saved NPV' has a different definition, adjust accordingly)
-
-            # Display Key Metrics
-            
-            st.subheader("Key Metrics")
-            col1, col2, col3, col4 = st.columns(4)
-            with col1:
-                st.metric("Unlevered IRR", f"{irr*100:.2f}%", help='Internal Rate of Return without considering debt financing.')
-            with col2:
-                total_revenue = revenue_df.loc[revenue_df['Year'] == 'Total', 'Revenue ($)'].values[0]
-                st.metric("Total Revenue", f"${total_revenue / 1e6:,.2f}MM", help='Total revenue over the project lifetime.')
-            with col3:
-                total_ebitda = revenue_df.loc[revenue_df['Year'] == 'Total', 'EBITDA ($)'].values[0]
-                st.metric("Total EBITDA", f"${total_ebitda / 1e6:,.2f}MM", help='Earnings Before Interest, Taxes, Depreciation, and Amortization over the project lifetime.')
-            with col4:
-                st.metric("Unlevered CapEx", f"${unlevered_capex / 1e6:,.2f}MM", help='Total capital expenditure minus tax equity FMV.')
-
-            col5, col6, col7, col8 = st.columns(4)
-            with col5:
-                st.metric("NPV", f"${NPV / 1e6:,.2f}MM", help='Net Present Value of the project.')
-            with col6:
-                st.metric("Saved NPV", f"${saved_NPV / 1e6:,.2f}MM", help='Increase in NPV due to tax equity financing.')
-            with col7:
-                st.metric("Savings Notional", f"${savings_notional / 1e6:,.2f}MM", help='Total savings unlocked for the customer.')
-            with col8:
-                st.metric("Payback Period", f"{payback_years} years", help='Number of years to recover the initial investment.')
-            
-            col9, col10, col11, col12 = st.columns(4)
-            with col9:
-                st.metric("LCOE ($/MWh)", f"${lcoe:,.2f}", help='Levelized Cost of Energy.')
-           
-
-            st.divider()
-            
+        results = None
+        results_project_data = project_data
+        # The last IRR shown in this session warm-starts the next solve
+        irr_guess = st.session_state.get('irr_warm_start')
 
-            st.subheader("Environmental Impact")
-            
-            # First row of metrics
-            col_env1, col_env2, col_env3 = st.columns(3)
-            with col_env1:
-                st.metric(
-                    label="Total CO₂ Avoided",
-                    value=f"{carbon_offsets['total_co2_avoided_metric_tons']:,.2f} metric tons",
-                    help="Total CO₂ emissions avoided over the project lifetime."
+        if st.button('Calculate IRR'):
+            results = evaluate_project_cached(project_data, stage_cache, irr_guess)
+
+        with st.sidebar.expander("What-If Preview", expanded=False):
+            # Surrogate over the most sensitive inputs, for instant previews while inputs change
+            surrogate_inputs = st.slider('Inputs to Sample', min_value=5, max_value=10, value=SURROGATE_MAX_INPUTS)
+            surrogate_swing = st.number_input(
+                'Sampled Range (± %)',
+                value=SURROGATE_SWING * 100,
+                min_value=1.0,
+                max_value=50.0
+            ) / 100
+            if st.button('Build Surrogate'):
+                submit_analytics(session_tasks, 'What-If Surrogate', input_key, build_surrogate, project_data,
+                                 surrogate_inputs, surrogate_swing)
+            if st.session_state.get('surrogate') is not None and st.button('Clear Surrogate'):
+                del st.session_state['surrogate']
+
+        if results is None and st.session_state.get('surrogate') is not None:
+            render_preview(preview_metrics(st.session_state['surrogate'], project_data))
+
+        username = st.session_state['username']
+        with st.sidebar.expander("Job Queue", expanded=False):
+            # Queued jobs run in local worker processes and keep running if this tab disconnects
+            queue_jobs = st.checkbox(
+                'Run as Queued Jobs',
+                help='Optimizer, simulation and portfolio runs go to the job queue instead of this session.'
+            )
+            job_priority = st.number_input('Job Priority', value=0, min_value=-10, max_value=10,
+                                           help='Higher priority jobs start first.')
+            pipeline_source = st.text_input('Pipeline Input File (CSV or Parquet)')
+            pipeline_output = st.text_input('Pipeline Output Folder', value='pipeline_output')
+            if pipeline_source and st.button('Queue Portfolio Pipeline'):
+                ensure_job_workers()
+                submit_job(username, 'Portfolio Pipeline', (pipeline_source, pipeline_output, PIPELINE_CHUNK_SIZE, project_data),
+                           job_priority, f'Pipeline {os.path.basename(pipeline_source)}')
+
+        with st.sidebar.expander("Structuring Optimizer", expanded=False):
+            # Discrete grid of structuring options, evaluated in batches in the background
+            optimizer_tenors = st.slider('PPA Tenor Range (years)', min_value=1, max_value=30, value=(10, 25))
+            optimizer_tenor_step = st.number_input('PPA Tenor Step (years)', value=5, min_value=1, max_value=10)
+            optimizer_buyouts = st.slider('Buyout Year Range', min_value=1, max_value=20, value=(5, 10))
+            optimizer_escalations = st.slider('PPA Escalation Range (%)', min_value=0.0, max_value=10.0, value=(0.0, 3.0), step=0.5)
+            optimizer_escalation_step = st.number_input('PPA Escalation Step (%)', value=0.5, min_value=0.1, max_value=5.0)
+            optimizer_rates = st.slider('PPA Rate Range ($/MWh)', min_value=0.0, max_value=300.0, value=(80.0, 140.0), step=5.0)
+            optimizer_rate_step = st.number_input('PPA Rate Step ($/MWh)', value=5.0, min_value=0.5, max_value=50.0)
+            optimizer_min_savings = st.number_input(
+                'Minimum Customer Savings ($MM)',
+                value=0.0,
+                help='Only keep options that save the customer at least this much over the project life.'
+            ) * 1e6
+            optimizer_max_payback = st.number_input(
+                'Maximum Payback (years)',
+                value=15,
+                min_value=1,
+                max_value=60,
+                help='Only keep options that pay back within this many years.'
+            )
+            if st.button('Run Optimizer'):
+                optimizer_args = (
+                    project_data,
+                    list(range(optimizer_tenors[0], optimizer_tenors[1] + 1, optimizer_tenor_step)),
+                    list(range(optimizer_buyouts[0], optimizer_buyouts[1] + 1)),
+                    list(np.arange(optimizer_escalations[0], optimizer_escalations[1] + 1e-9, optimizer_escalation_step) / 100),
+                    list(np.arange(optimizer_rates[0], optimizer_rates[1] + 1e-9, optimizer_rate_step)),
+                    optimizer_min_savings,
+                    optimizer_max_payback,
                 )
-            with col_env2:
-                st.metric(
-                    label="Equivalent Trees Planted",
-                    value=f"{int(carbon_offsets['equivalent_trees']):,}",
-                    help="Equivalent number of mature trees needed to absorb the same amount of CO₂."
+                if queue_jobs:
+                    ensure_job_workers()
+                    submit_job(username, 'Structuring Optimizer', optimizer_args, job_priority,
+                               f"Optimizer {project_data['state']} {project_data['project_size_dc']:g} MW-dc")
+                else:
+                    submit_analytics(session_tasks, 'Structuring Optimizer', input_key, optimize_structure, *optimizer_args)
+
+        with st.sidebar.expander("Merchant Price Risk", expanded=False):
+            # Monte Carlo over correlated, mean-reverting merchant price paths around the state curves
+            risk_paths = st.number_input('Price Paths', value=10000, min_value=100, max_value=1000000, step=1000)
+            risk_seed = st.number_input('Random Seed', value=0, min_value=0)
+            risk_volatility = st.number_input(
+                'Annual Price Volatility (%)',
+                value=MERCHANT_PATH_VOLATILITY * 100,
+                min_value=0.0,
+                max_value=100.0
+            ) / 100
+            risk_mean_reversion = st.number_input(
+                'Mean Reversion Speed',
+                value=MERCHANT_PATH_MEAN_REVERSION,
+                min_value=0.0,
+                max_value=5.0,
+                help='How quickly price shocks fade; shocks halve in about 0.69 / speed years.'
+            )
+            risk_correlation = st.number_input(
+                'Correlation Between States',
+                value=MERCHANT_PATH_STATE_CORRELATION,
+                min_value=0.0,
+                max_value=0.99
+            )
+            if st.button('Run Simulation'):
+                risk_args = (project_data, int(risk_paths), int(risk_seed), risk_volatility, risk_mean_reversion,
+                             risk_correlation)
+                if queue_jobs:
+                    ensure_job_workers()
+                    submit_job(username, 'Merchant Price Risk', risk_args, job_priority,
+                               f"{int(risk_paths):,} price paths {project_data['state']} {project_data['project_size_dc']:g} MW-dc")
+                else:
+                    submit_analytics(session_tasks, 'Merchant Price Risk', input_key, simulate_merchant_risk, *risk_args)
+
+        with st.sidebar.expander("Import from Excel", expanded=False):
+            uploaded_files = st.file_uploader(
+                'Pro-forma Workbooks (.xlsx)',
+                type=['xlsx'],
+                accept_multiple_files=True,
+                help='Named cells called after the inputs, or a sheet with one project per row. '
+                     'Inputs missing from a workbook take the values set above.'
+            )
+            imported = None
+            if uploaded_files:
+                imported = import_uploaded_workbooks(
+                    tuple((uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files), project_data
                 )
-            with col_env3:
-                st.metric(
-                    label="Equivalent Cars Off the Road",
-                    value=f"{carbon_offsets['equivalent_cars']:,.2f}",
-                    help="Equivalent number of cars taken off the road for one year."
+                st.caption(f"{len(imported['projects']):,} projects imported.")
+                if not imported['errors'].empty:
+                    st.error(f"{len(imported['errors']):,} validation errors; the affected projects were skipped.")
+                    st.dataframe(imported['errors'])
+            if imported is not None and imported['projects']:
+                selected_import = st.selectbox(
+                    'Imported Project',
+                    range(len(imported['projects'])),
+                    format_func=lambda index: imported['names'][index]
                 )
-            
-            # Second row of metrics
-            col_env4, col_env5, col_env6 = st.columns(3)
-            with col_env4:
-                st.metric(
-                    label="Households Powered for a Year",
-                    value=f"{int(carbon_offsets['equivalent_households']):,}",
-                    help="Equivalent number of households powered for one year."
+                if st.button('Evaluate Imported Project'):
+                    results_project_data = imported['projects'][selected_import]
+                    results = evaluate_project_cached(results_project_data, irr_guess=irr_guess)
+                    st.info(f"Showing imported project '{imported['names'][selected_import]}'.")
+                if st.button('Evaluate Imported Portfolio'):
+                    if queue_jobs:
+                        ensure_job_workers()
+                        submit_job(username, 'Portfolio', (imported['projects'], imported['names']), job_priority,
+                                   f"Portfolio of {len(imported['projects']):,} projects")
+                    else:
+                        st.session_state['portfolio'] = evaluate_portfolio(imported['projects'], imported['names'])
+
+        # Pinned scenarios keep their results, so the comparison never recomputes them
+        pinned = st.session_state.setdefault('pinned_scenarios', [])
+        pin_limit_message = f'Up to {COMPARE_MAX_SCENARIOS} scenarios can be pinned; unpin one first.'
+
+        with st.sidebar.expander("Saved Scenarios", expanded=False):
+            scenario_name = st.text_input(
+                'Scenario Name',
+                value='',
+                help='Optional name for the saved scenario.'
+            )
+            if st.button('Save Scenario'):
+                if results is None:
+                    results = evaluate_project_cached(project_data, stage_cache, irr_guess)
+                save_scenario(project_data, results, name=scenario_name)
+                st.success('Scenario saved.')
+
+            filter_state = st.selectbox(
+                'Filter by State',
+                ['All', 'NY', 'CA', 'IL', 'TX', 'NJ'],
+                help='Only list saved scenarios in this state.'
+            )
+            min_irr = st.number_input(
+                'Minimum IRR (%)',
+                value=-100.0,
+                help='Only list saved scenarios with at least this IRR.'
+            ) / 100
+            saved_scenarios = list_scenarios(
+                state=None if filter_state == 'All' else filter_state,
+                min_irr=min_irr
+            )
+            scenario_labels = {
+                row.scenario_id: f"{row.name} ({row.state}, {row.project_size_dc:g} MW-dc, IRR {row.irr*100:.2f}%)"
+                for row in saved_scenarios.itertuples()
+            }
+            selected_scenario = st.selectbox(
+                'Saved Scenario',
+                list(scenario_labels),
+                format_func=lambda scenario_id: scenario_labels[scenario_id],
+                help='Saved scenarios load instantly without recomputing.'
+            )
+            if st.button('Load Scenario', disabled=selected_scenario is None):
+                scenario = load_scenario(selected_scenario)
+                results = scenario['results']
+                results_project_data = scenario['project_data']
+                st.info(f"Showing saved scenario '{scenario['name']}'.")
+            if st.button('Pin Scenario', disabled=selected_scenario is None):
+                scenario = load_scenario(selected_scenario)
+                if not pin_scenario(pinned, scenario['project_data'], scenario['results'], scenario['name']):
+                    st.warning(pin_limit_message)
+            shapley_attribution = st.checkbox(
+                'Order-Averaged Attribution',
+                help='Average each input group\'s effect over every order of changes (Shapley values) '
+                     'instead of changing the groups one after another.'
+            )
+            if st.button('Explain Change from Saved Scenario', disabled=selected_scenario is None):
+                st.session_state['attribution'] = attribute_change(
+                    load_scenario(selected_scenario)['project_data'], project_data,
+                    'shapley' if shapley_attribution else 'sequential'
                 )
-            with col_env5:
-                st.metric(
-                    label="Miles Not Driven",
-                    value=f"{int(carbon_offsets['equivalent_miles']):,} miles",
-                    help="Equivalent miles not driven by an average passenger vehicle."
+
+        # The last result shown stays pinnable on reruns that don't recompute it
+        if results is not None:
+            st.session_state['last_result'] = (results_project_data, results)
+        last_result = st.session_state.get('last_result')
+
+        with st.sidebar.expander("Scenario Comparison", expanded=False):
+            pin_label = st.text_input('Pin Label', value='', help='Optional label for the next pinned scenario.')
+            if st.button('Pin Last Result', disabled=last_result is None,
+                         help='Pin the result shown most recently in this session.'):
+                if not pin_scenario(pinned, *last_result, label=pin_label):
+                    st.warning(pin_limit_message)
+            if st.button('Pin Current Inputs', help='Pin the cached result for the inputs above, if there is one.'):
+                cached_results = get_cached_results(project_data)
+                if cached_results is None:
+                    st.warning('These inputs have no cached result yet; click Calculate IRR first.')
+                elif not pin_scenario(pinned, project_data, cached_results, pin_label):
+                    st.warning(pin_limit_message)
+            if pinned:
+                pinned_names = comparison_names(pinned)
+                unpin_index = st.selectbox('Pinned Scenario', range(len(pinned)), format_func=lambda index: pinned_names[index])
+                if st.button('Unpin'):
+                    del pinned[unpin_index]
+                if st.button('Clear Pinned'):
+                    pinned.clear()
+
+        if results is not None:
+            render_results(results)
+            if results.get('from_cache'):
+                st.caption('Loaded from the shared result cache.')
+            elif 'stage_report' in results and results['stage_report']['reused']:
+                st.caption(f"Reused model stages: {', '.join(results['stage_report']['reused'])}")
+            if results.get('irr_stats', {}).get('iterations'):
+                irr_stats = results['irr_stats']
+                start = 'warm start from the previous result' if irr_stats['warm_start'] else 'cold start'
+                st.caption(
+                    f"IRR converged in {irr_stats['iterations']} Newton iterations ({start}); "
+                    f"{irr_stats['cold_start_iterations']} from a cold start."
                 )
+            if np.isfinite(results['metrics']['irr']):
+                st.session_state['irr_warm_start'] = results['metrics']['irr']
+
+            sensitivity_df = calculate_sensitivities(results_project_data)
+            with st.expander("First-Order Sensitivities", expanded=False):
+                st.dataframe(sensitivity_df, column_config={
+                    'Value': st.column_config.NumberColumn(format='%.4g'),
+                    'dNPV/dInput': st.column_config.NumberColumn(format='dollar'),
+                    'dIRR/dInput': st.column_config.NumberColumn(format='%.6f'),
+                    'NPV Breakeven': st.column_config.NumberColumn(format='%.4g'),
+                })
+                st.caption('Change in NPV and IRR per unit change of each input, and the input value at which NPV reaches zero to first order.')
+
+            sensitivity_tables = {'First-Order Sensitivities': sensitivity_df}
+            tornado_task = session_tasks.get('Sensitivity Analysis')
+            if tornado_task is not None and tornado_task['future'] is not None and tornado_task['future'].done() \
+                    and tornado_task['future'].exception() is None and tornado_task['future'].result() is not None:
+                sensitivity_tables['Sensitivity Analysis'] = tornado_task['future'].result()
+            st.download_button(
+                label="Download Full Model as Excel",
+                data=write_workbook(io.BytesIO(), results_project_data, results, sensitivity_tables).getvalue(),
+                file_name='project_model.xlsx',
+                mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            )
+            st.download_button(
+                label="Download Annual Rows as Parquet",
+                data=results_to_parquet(results_project_data),
+                file_name='annual.parquet',
+                mime='application/vnd.apache.parquet',
+            )
 
+            # Heavier analytics run in the background once the Key Metrics are on screen
+            if results_project_data is project_data:
+                submit_analytics(session_tasks, 'Sensitivity Analysis', input_key, run_sensitivity_analysis, project_data)
 
+        if pinned:
             st.divider()
+            render_comparison(pinned)
 
+        if st.session_state.get('attribution') is not None:
+            st.divider()
+            render_attribution(st.session_state['attribution'])
 
+        if st.session_state.get('portfolio') is not None:
+            st.divider()
+            render_portfolio(st.session_state['portfolio'])
 
-             # Step 12: Display Revenue Table at the Bottom
-            st.subheader("Annual Project Details")
-            st.dataframe(revenue_df.style.format({
-                'Net Production (MWh)': '{:,.0f}',
-                'Our Price ($/MWh)': '${:,.2f}',
-                'Avoided Cost Price ($/MWh)': '${:,.2f}',
-                'Revenue ($)': lambda x: format_hover_value(x),
-                'Operating Expenses ($)': lambda x: format_hover_value(x),
-                'EBITDA ($)': lambda x: format_hover_value(x),
-                'Total Cash Flows ($)': lambda x: format_hover_value(x),
-                'Savings Unlocked ($)': lambda x: format_hover_value(x),
-            }))
-
-
-           
-            # Step 10: Plot Cash Flows
-            cash_flow_df = pd.DataFrame({
-                'Year': revenue_df['Year'][:-1],  # Exclude 'Total' row for plotting
-                'Cash Flow': cash_flows,
-                'Cumulative Cash Flow': np.cumsum(cash_flows)
-            })
-            st.plotly_chart(plot_cash_flows(cash_flow_df))
+        if session_tasks:
+            st.divider()
+            render_background_analytics(session_tasks)
 
-            # Step 11: Plot Stacked Savings Chart
-            st.plotly_chart(plot_stacked_savings_chart(revenue_df))
+        if not list_jobs(username, limit=1).empty:
+            st.divider()
+            render_job_queue(username)
 
-           
-            # Optional: Provide a download button for the revenue table
-            csv = revenue_df.to_csv(index=False)
-            st.download_button(
-                label="Download Revenue Table as CSV",
-                data=csv,
-                file_name='revenue_table.csv',
-                mime='text/csv',
-            )
+        if st.session_state.get('job_result') is not None:
+            job_id, kind, job_result = st.session_state['job_result']
+            st.subheader(f'Job #{job_id}: {kind}')
+            JOB_RENDERERS[kind](job_result, key_prefix=f'job_{job_id}_')
+            if st.button('Close Job Result'):
+                del st.session_state['job_result']
+                st.rerun()
 
     elif st.session_state['authentication_status'] == False:
         st.error('Username/password is incorrect')
@@ -1314,4 +5061,10 @@ def main():
 
    
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ['--job-worker']:
+        run_job_worker(worker_id=sys.argv[2] if len(sys.argv) > 2 else None)
+    elif sys.argv[1:2] == ['--benchmark-shared-workers']:
+        benchmark_projects = next(projects for projects, _, _ in project_chunks(sys.argv[2], 1) if projects)
+        print(benchmark_shared_workers(benchmark_projects[0]).to_string(index=False))
+    else:
+        main()